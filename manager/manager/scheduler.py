@@ -3,8 +3,10 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import json
+import time
 import logging
 import datetime
+import threading
 
 from django.conf import settings
 
@@ -22,6 +24,9 @@ ACCESS_TOKEN = None
 ACCESS_TOKEN_EXPIRY = None
 REFRESH_TOKEN = None
 REFRESH_TOKEN_EXPIRY = None
+TOKEN_LOCK = threading.RLock()  # one token shared by all threads
+TOKEN_RENEWAL_MARGIN = datetime.timedelta(minutes=5)
+TOKEN_RENEWAL_THREAD = None
 ROLES = {
     "manager": "Manager (WebUI)",
     "creator": "Creator Worker",
@@ -46,32 +51,87 @@ def get_token(username, password):
             "password": password,
             "Content-type": "application/json",
         },
+        timeout=30,
     )
     req.raise_for_status()
     return req.json().get("access_token"), req.json().get("refresh_token")
 
 
-def authenticate(force=False):
-    global ACCESS_TOKEN, REFRESH_TOKEN, ACCESS_TOKEN_EXPIRY, REFRESH_TOKEN_EXPIRY
+def refresh_token(token):
+    """ new (access_token, refresh_token) from a (single-use) refresh token """
+    req = requests.post(
+        url=get_url("/auth/token"),
+        headers={"refresh-token": token, "Content-type": "application/json"},
+        timeout=30,
+    )
+    req.raise_for_status()
+    return req.json().get("access_token"), req.json().get("refresh_token")
 
-    if (
-        not force
-        and ACCESS_TOKEN is not None
-        and ACCESS_TOKEN_EXPIRY
-        > datetime.datetime.now() + datetime.timedelta(minutes=2)
-    ):
-        return
 
-    logger.debug("authenticate() with force={}".format(force))
+def renew_tokens():
+    """ tokens from refresh token if still valid, from credentials otherwise """
+    if REFRESH_TOKEN is not None and REFRESH_TOKEN_EXPIRY > datetime.datetime.now():
+        try:
+            return refresh_token(REFRESH_TOKEN)
+        except Exception as exp:
+            logger.warning("unable to refresh token, logging-in: {}".format(exp))
+    return get_token(username=USERNAME, password=PASSWORD)
 
-    try:
-        access_token, refresh_token = get_token(username=USERNAME, password=PASSWORD)
-    except Exception as exp:
-        ACCESS_TOKEN = REFRESH_TOKEN = ACCESS_TOKEN_EXPIRY = None
-    else:
-        ACCESS_TOKEN, REFRESH_TOKEN = access_token, refresh_token
-        ACCESS_TOKEN_EXPIRY = datetime.datetime.now() + datetime.timedelta(minutes=59)
-        REFRESH_TOKEN_EXPIRY = datetime.datetime.now() + datetime.timedelta(days=29)
+
+def authenticate(force=False, min_validity=TOKEN_RENEWAL_MARGIN):
+    """ ensure ACCESS_TOKEN is valid for at least min_validity """
+    global ACCESS_TOKEN, REFRESH_TOKEN, ACCESS_TOKEN_EXPIRY, REFRESH_TOKEN_EXPIRY
+
+    with TOKEN_LOCK:
+        if (
+            not force
+            and ACCESS_TOKEN is not None
+            and ACCESS_TOKEN_EXPIRY > datetime.datetime.now() + min_validity
+        ):
+            return
+
+        logger.debug("authenticate() with force={}".format(force))
+
+        try:
+            access_token, refresh_token = renew_tokens()
+        except Exception as exp:
+            logger.error(exp)
+            ACCESS_TOKEN = REFRESH_TOKEN = ACCESS_TOKEN_EXPIRY = None
+        else:
+            now = datetime.datetime.now()
+            ACCESS_TOKEN, REFRESH_TOKEN = access_token, refresh_token
+            ACCESS_TOKEN_EXPIRY = now + datetime.timedelta(minutes=59)
+            REFRESH_TOKEN_EXPIRY = now + datetime.timedelta(days=29)
+
+        start_token_renewal()
+
+
+def reauthenticate(rejected_token):
+    """ renew token rejected by scheduler, unless another thread already did """
+    with TOKEN_LOCK:
+        if ACCESS_TOKEN == rejected_token:
+            authenticate(force=True)
+
+
+def start_token_renewal():
+    """ renew token in background before it expires so requests never wait """
+    global TOKEN_RENEWAL_THREAD
+
+    def renew():
+        while True:
+            expiry = ACCESS_TOKEN_EXPIRY
+            if expiry is None:  # last renewal failed
+                delay = 60
+            else:
+                delay = (
+                    expiry - TOKEN_RENEWAL_MARGIN - datetime.datetime.now()
+                ).total_seconds()
+            time.sleep(max(delay, 1))
+            authenticate(min_validity=TOKEN_RENEWAL_MARGIN * 2)
+
+    if TOKEN_RENEWAL_THREAD is None:
+        TOKEN_RENEWAL_THREAD = threading.Thread(target=renew, daemon=True)
+        TOKEN_RENEWAL_THREAD.start()
 
 
 def auth_required(func):
@@ -82,15 +142,23 @@ def auth_required(func):
     return wrapper
 
 
-def get_token_headers():
-    return {"token": ACCESS_TOKEN, "Content-type": "application/json"}
+def get_access_token():
+    return ACCESS_TOKEN
+
+
+def get_token_headers(token=None):
+    return {"token": token or ACCESS_TOKEN, "Content-type": "application/json"}
 
 
 @auth_required
 def query_api(method, path, payload=None, params=None):
+    token = get_access_token()
     try:
         req = getattr(requests, method.lower(), "get")(
-            url=get_url(path), headers=get_token_headers(), json=payload, params=params
+            url=get_url(path),
+            headers=get_token_headers(token),
+            json=payload,
+            params=params,
         )
     except Exception as exp:
         return (False, "ConnectionError", "ConnectionErrorL -- {}".format(exp))
@@ -113,9 +181,9 @@ def query_api(method, path, payload=None, params=None):
     if req.status_code in (200, 201):
         return True, req.status_code, resp
 
-    # Unauthorised error: attempt to re-auth as scheduler might have restarted?
+    # Unauthorised error: token might have been revoked or signing key retired
     if req.status_code == 401:
-        authenticate(True)
+        reauthenticate(token)
 
     return (False, req.status_code, resp["error"] if "error" in resp else str(resp))
 
@@ -216,6 +284,18 @@ def get_workers_list():
     return success, response
 
 
+@auth_required
+def get_fleet_stats():
+    success, code, response = query_api(GET, "/stats/fleet")
+    return success, response
+
+
+@auth_required
+def get_queues_stats():
+    success, code, response = query_api(GET, "/stats/queues")
+    return success, response
+
+
 @auth_required
 def get_channels_list():
     success, code, response = query_api(GET, "/channels/")
@@ -343,6 +423,20 @@ def get_order(order_id, with_logs=False):
     return success, response
 
 
+@auth_required
+def get_task_log(task_type, task_id, kind, offset=0, limit=None):
+    """ (success, response) with response["data"] being log[offset:offset+limit] """
+    params = {"offset": offset}
+    if limit is not None:
+        params["limit"] = limit
+    success, code, response = query_api(
+        GET,
+        "/tasks/{type}/{id}/logs/{kind}".format(type=task_type, id=task_id, kind=kind),
+        params=params,
+    )
+    return success, response
+
+
 @auth_required
 def add_order_shipment(order_id, shipment_details):
     payload = {"shipment_details": shipment_details}
@@ -17,6 +17,7 @@ from manager.scheduler import (
     test_connection,
     delete_order,
     get_order,
+    get_task_log,
 )
 from manager.views.common import APIQuerySet
 
@@ -125,16 +126,22 @@ def order_log(request, order_id, step, kind, index=None, fmt="txt"):
     ):
         raise Http404("`{}` log does not exists".format(kind))
 
-    retrieved, order = get_order(order_id, with_logs=True)
+    # only fetch the requested log, not all logs of all tasks
+    retrieved, order = get_order(order_id)
     if not retrieved:
         raise Http404(order)
 
     try:
         if step == "write":
             index = int(index) - 1
-            content = order["tasks"][step][index]["logs"][kind]
+            task = order["tasks"][step][index]
         else:
-            content = order["tasks"][step]["logs"][kind]
+            task = order["tasks"][step]
+        task_type = {"create": "creator", "download": "downloader", "write": "writer"}
+        retrieved, log = get_task_log(task_type[step], task["_id"], kind)
+        if not retrieved:
+            raise ValueError(log)
+        content = log["data"]
     except Exception as exp:
         logger.exception(exp)
         raise Http404(
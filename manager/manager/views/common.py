@@ -6,26 +6,51 @@ from manager.scheduler import query_api, GET, fix_id
 
 
 class APIQuerySet(object):
-    """ QuerySet-like object for an API request's results """
+    """ QuerySet-like object for an API request's results
 
-    def __init__(self, query, method=GET, params={}):
+        remembers the cursor returned after each page so that browsing pages
+        in sequence uses the API's keyset pagination instead of a deep skip """
+
+    # (query, params, count, offset) -> cursor of the page starting at offset
+    cursors = {}
+    max_cursors = 1000
+
+    def __init__(self, query, method=GET, params=None):
         self.method = method
         self.query = query
-        self.params = params
+        self.params = params or {}
         self.count = 0
-        self.execute()
+        self.execute(limit=1)
 
     def execute(self, skip=None, limit=None):
-        success, code, response = query_api(
-            GET, self.query, params={"skip": skip, "limit": limit}
-        )
+        params = dict(self.params)
+        params.update({"skip": skip, "limit": limit})
+        cursor = self.cursors.get(self.cursor_key(skip)) if skip else None
+        if cursor:
+            params.update({"skip": None, "cursor": cursor})
+
+        success, code, response = query_api(GET, self.query, params=params)
         if success and "items" in response:
             self.count = response["meta"]["count"]
+            if limit:
+                self.remember_cursor((skip or 0) + limit, response["meta"].get("next"))
             return self.process(response.get("items", []))
         else:
             self.count = 0
             return []
 
+    def cursor_key(self, offset):
+        # listings of a same query with different filters have their own cursors
+        params = repr(sorted(self.params.items()))
+        return (self.query, params, self.count, offset)
+
+    def remember_cursor(self, offset, cursor):
+        if not cursor:
+            return
+        if len(self.cursors) >= self.max_cursors:
+            self.cursors.clear()
+        self.cursors[self.cursor_key(offset)] = cursor
+
     def __len__(self):
         return self.count
 
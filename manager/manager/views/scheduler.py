@@ -16,6 +16,8 @@ from manager.scheduler import (
     get_channels_list,
     get_users_list,
     get_workers_list,
+    get_queues_stats,
+    get_fleet_stats,
     as_items_or_none,
     add_channel,
     add_warehouse,
@@ -30,7 +32,7 @@ from manager.scheduler import (
     enable_user,
     disable_user,
     authenticate,
-    ACCESS_TOKEN,
+    get_access_token,
     get_channel_choices,
 )
 
@@ -169,6 +171,17 @@ def dashboard(request):
         "users": as_items_or_none(*get_users_list()) or None,
         "workers": as_items_or_none(*get_workers_list()) or None,
     }
+    success_queues, queues = get_queues_stats()
+    context["queues"] = (
+        [
+            (task_type, queues[task_type])
+            for task_type in ("creator", "downloader", "writer")
+        ]
+        if success_queues
+        else None
+    )
+    success_fleet, fleet = get_fleet_stats()
+    context["fleet"] = fleet if success_fleet else None
 
     forms_map = {
         "channel_form": ChannelForm,
@@ -293,9 +306,12 @@ def user_disable(request, user_id):
 @staff_required
 def refresh_token(request):
     authenticate(force=True)
-    logger.info("Re-authenticated against the scheduler: `{}`".format(ACCESS_TOKEN))
+    access_token = get_access_token() or ""
+    logger.info("Re-authenticated against the scheduler: `{}`".format(access_token))
     messages.info(
         request,
-        "Re-authenticated against the scheduler: <code>{}</code>".format(ACCESS_TOKEN[:20]),
+        "Re-authenticated against the scheduler: <code>{}</code>".format(
+            access_token[:20]
+        ),
     )
     return redirect("scheduler")
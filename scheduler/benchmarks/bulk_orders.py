@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" compare importing orders one by one (POST /orders/) and in bulk
+
+    creates 100 and 500 orders (with their creator task and email) in a
+    throwaway database using both code paths of the orders routes.
+    Requires a reachable mongod (MONGODB_URI).
+
+    MONGODB_URI=mongodb://localhost python bulk_orders.py """
+
+import os
+import sys
+import time
+
+os.environ.setdefault("MONGODB_DBNAME", "Cardshop_benchmark")
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+os.chdir(SRC_DIR)  # for email templates
+
+from flask import Flask  # noqa: E402
+
+from utils.mongo import (  # noqa: E402
+    get_client,
+    Channels,
+    Orders,
+    CreatorTasks,
+    EmailOutbox,
+)
+from emailing import (  # noqa: E402
+    send_order_created_email,
+    send_orders_created_emails,
+)
+
+SIZES = [100, 500]
+
+
+def get_order(index):
+    person = {
+        "name": "client {}".format(index),
+        "email": "client{}@example.org".format(index),
+    }
+    return {
+        "config": {"name": "benchmark {}".format(index)},
+        "sd_card": {"name": "64GB", "type": "physical", "size": 64},
+        "quantity": 1,
+        "units": 1,
+        "channel": "kiwix",
+        "client": person,
+        "recipient": dict(person, address="somewhere", country="fr"),
+        "warehouse": {
+            "upload_uri": "ftp://warehouse/",
+            "download_uri": "ftp://warehouse/",
+        },
+    }
+
+
+def create_one_by_one(orders):
+    """ what POST /orders/ does, once per order """
+    for order in orders:
+        order_id = Orders().insert_one(Orders.prepare(order)).inserted_id
+        send_order_created_email(order_id)
+        Orders.create_creator_task(order_id)
+
+
+def create_in_bulk(orders):
+    """ what POST /orders/bulk does """
+    documents = [Orders.prepare(order) for order in orders]
+    created = [
+        dict(document, _id=order_id)
+        for document, (order_id, error) in zip(documents, Orders.create_many(documents))
+        if not error
+    ]
+    send_orders_created_emails([order["_id"] for order in created])
+    Orders.create_creator_tasks(created)
+
+
+def measure(func, size):
+    get_client().drop_database(os.environ["MONGODB_DBNAME"])
+    Channels().insert_one({"slug": "kiwix", "name": "Kiwix", "private": False})
+    orders = [get_order(index) for index in range(size)]
+    with Flask(__name__).app_context():
+        start = time.perf_counter()
+        func(orders)
+        duration = time.perf_counter() - start
+    assert Orders().count_documents({}) == size
+    assert CreatorTasks().count_documents({}) == size
+    assert EmailOutbox().count_documents({}) == size
+    return duration
+
+
+def main():
+    dbname = os.environ["MONGODB_DBNAME"]
+    try:
+        print(
+            "{:>7} {:>16} {:>16} {:>8}".format(
+                "orders", "one by one (s)", "bulk (s)", "speedup"
+            )
+        )
+        for size in SIZES:
+            single = measure(create_one_by_one, size)
+            bulk = measure(create_in_bulk, size)
+            print(
+                "{:>7} {:>16.2f} {:>16.2f} {:>7.1f}x".format(
+                    size, single, bulk, single / bulk
+                )
+            )
+    finally:
+        get_client().drop_database(dbname)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" compare legacy (one query per task) and aggregated Orders.get_with_tasks
+
+    seeds orders of 1, 10 and 100 cards in a throwaway database then times
+    both implementations. Requires a reachable mongod (MONGODB_URI).
+
+    MONGODB_URI=mongodb://localhost python order_with_tasks.py """
+
+import os
+import sys
+import time
+import datetime
+import statistics
+
+os.environ.setdefault("MONGODB_DBNAME", "Cardshop_benchmark")
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from utils.mongo import (  # noqa: E402
+    get_client,
+    Orders,
+    CreatorTasks,
+    DownloaderTasks,
+    WriterTasks,
+)
+
+QUANTITIES = [1, 10, 100]
+REPEAT = int(os.getenv("REPEAT", 50))
+LOG = "x" * 20000  # tasks logs, excluded from both implementations
+
+
+def legacy_get_with_tasks(order_id, with_logs=False):
+    """ Orders.get_with_tasks before aggregation: 3 + quantity queries """
+    order = Orders.get(order_id, with_logs=with_logs)
+    tasks = Orders.get(order_id)["tasks"]
+    order["tasks"].update(
+        {
+            "create": CreatorTasks.get(tasks.get("create"), with_logs=with_logs),
+            "download": DownloaderTasks.get(tasks.get("download"), with_logs=with_logs),
+            "write": [
+                WriterTasks.get(task, with_logs=with_logs)
+                for task in tasks.get("write", [])
+            ],
+        }
+    )
+    return order
+
+
+def seed_order(quantity):
+    now = datetime.datetime.now()
+    statuses = [{"status": "pending", "on": now, "payload": None}]
+    order_id = (
+        Orders()
+        .insert_one(
+            {
+                "config": {"name": "benchmark"},
+                "sd_card": {"name": "sd", "type": "physical", "size": 64},
+                "quantity": quantity,
+                "units": quantity,
+                "channel": "kiwix",
+                "status": Orders.writing,
+                "statuses": statuses,
+                "tasks": {},
+            }
+        )
+        .inserted_id
+    )
+    task = {"order": order_id, "status": "written", "statuses": statuses}
+    tasks = {
+        "create": CreatorTasks()
+        .insert_one(dict(task, logs={"installer": LOG}))
+        .inserted_id,
+        "download": DownloaderTasks()
+        .insert_one(dict(task, logs={"downloader": LOG}))
+        .inserted_id,
+        "write": WriterTasks()
+        .insert_many([dict(task, logs={"writer": LOG}) for _ in range(quantity)])
+        .inserted_ids,
+    }
+    Orders().update_one({"_id": order_id}, {"$set": {"tasks": tasks}})
+    return order_id
+
+
+def measure(func, order_id):
+    durations = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(order_id)
+        durations.append((time.perf_counter() - start) * 1000)
+    durations.sort()
+    return statistics.median(durations), durations[int(len(durations) * 0.95) - 1]
+
+
+def main():
+    dbname = os.environ["MONGODB_DBNAME"]
+    get_client().drop_database(dbname)
+    try:
+        print(
+            "{:>6} {:>22} {:>22} {:>8}".format(
+                "cards", "legacy ms (med/p95)", "aggregate ms (med/p95)", "speedup"
+            )
+        )
+        for quantity in QUANTITIES:
+            order_id = seed_order(quantity)
+            assert legacy_get_with_tasks(order_id) == Orders.get_with_tasks(order_id)
+            legacy = measure(legacy_get_with_tasks, order_id)
+            aggregate = measure(Orders.get_with_tasks, order_id)
+            print(
+                "{:>6} {:>13.2f}/{:<8.2f} {:>13.2f}/{:<8.2f} {:>7.1f}x".format(
+                    quantity, *legacy, *aggregate, legacy[0] / aggregate[0]
+                )
+            )
+    finally:
+        get_client().drop_database(dbname)
+
+
+if __name__ == "__main__":
+    main()
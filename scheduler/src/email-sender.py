@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" deliver emails queued in email_outbox
+
+    single resident process (see email-sender.conf) keeping one SMTP/Mailgun
+    session open while there are messages to send. failed messages are
+    retried with exponential backoff. """
+
+import os
+import time
+import signal
+import logging
+import datetime
+import statistics
+
+from emailing import Mailer
+from utils.mongo import EmailOutbox
+from utils.metrics import email_send_duration, email_queue_latency
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", 20))
+POLL_INTERVAL = int(os.getenv("EMAIL_POLL_INTERVAL", 5))
+IDLE_TIMEOUT = int(os.getenv("EMAIL_IDLE_TIMEOUT", 60))  # then close session
+STATS_INTERVAL = int(os.getenv("EMAIL_STATS_INTERVAL", 300))
+
+
+class SendStats:
+    """ counters and timings logged every STATS_INTERVAL """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started_on = time.monotonic()
+        self.sent, self.failed = 0, 0
+        self.durations, self.latencies = [], []
+
+    @staticmethod
+    def summary(values, unit):
+        if not values:
+            return "-"
+        values = sorted(values)
+        return "med={med:.2f}{unit} p95={p95:.2f}{unit} max={max:.2f}{unit}".format(
+            med=statistics.median(values),
+            p95=values[max(int(len(values) * 0.95) - 1, 0)],
+            max=values[-1],
+            unit=unit,
+        )
+
+    def log_if_due(self):
+        if time.monotonic() - self.started_on < STATS_INTERVAL:
+            return
+        logger.info(
+            "sent={sent} failed={failed} send: {durations} queue latency: {lat}".format(
+                sent=self.sent,
+                failed=self.failed,
+                durations=self.summary(self.durations, "s"),
+                lat=self.summary(self.latencies, "s"),
+            )
+        )
+        self.reset()
+
+
+class Sender:
+    def __init__(self):
+        self.running = True
+        self.mailer = Mailer()
+        self.transport = "mailgun" if self.mailer.use_api else "smtp"
+        self.stats = SendStats()
+        self.last_send = time.monotonic()
+
+    def stop(self, signum=None, frame=None):
+        logger.info("stop requested, finishing current batch")
+        self.running = False
+
+    def send_batch(self, messages):
+        updates = []
+        for message in messages:
+            started_on = time.monotonic()
+            try:
+                self.mailer.send(message)
+            except Exception as exp:
+                logger.error(
+                    "Unable to send email #{} (attempt {}): {}".format(
+                        message["_id"], message["attempts"] + 1, exp
+                    )
+                )
+                self.stats.failed += 1
+                email_send_duration.labels("failed").observe(
+                    time.monotonic() - started_on
+                )
+                updates.append(EmailOutbox.failed_update(message, exp))
+            else:
+                duration = time.monotonic() - started_on
+                latency = (
+                    datetime.datetime.now() - message["queued_on"]
+                ).total_seconds()
+                self.stats.sent += 1
+                self.stats.durations.append(duration)
+                self.stats.latencies.append(latency)
+                email_send_duration.labels("sent").observe(duration)
+                email_queue_latency.labels(self.transport).observe(latency)
+                updates.append(EmailOutbox.sent_update(message, duration, latency))
+        EmailOutbox.record(updates)
+        self.last_send = time.monotonic()
+
+    def run(self):
+        logger.info("starting email sender")
+        while self.running:
+            messages = EmailOutbox.due(BATCH_SIZE)
+            if messages:
+                self.send_batch(messages)
+            else:
+                if time.monotonic() - self.last_send > IDLE_TIMEOUT:
+                    self.mailer.close()
+                time.sleep(POLL_INTERVAL)
+            self.stats.log_if_due()
+        self.mailer.close()
+        logger.info("email sender stopped")
+
+
+if __name__ == "__main__":
+    sender = Sender()
+    signal.signal(signal.SIGTERM, sender.stop)
+    signal.signal(signal.SIGINT, sender.stop)
+    sender.run()
@@ -3,15 +3,29 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import os
+import time
+import fcntl
+import shutil
+import hashlib
 import logging
+import tempfile
+import contextlib
 
 import pdfkit
 import yagmail
 import requests
+from flask import g, has_app_context
 from werkzeug.datastructures import MultiDict
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
-from utils.mongo import Orders, Users, Channels, WriterTasks, Acknowlegments
+from utils.mongo import (
+    Orders,
+    Users,
+    Channels,
+    WriterTasks,
+    Acknowlegments,
+    EmailOutbox,
+)
 from utils.templates import (
     get_id,
     country_name,
@@ -55,6 +69,11 @@ CLIENT_EMAIL_STATUSES = [
 
 RECIPIENT_EMAIL_STATUSES = [Orders.shipped]
 
+SHIPPING_DOCS_DIR = os.getenv(
+    "SHIPPING_DOCS_DIR", os.path.join(os.getenv("TMP_DIR", "/tmp"), "shipping")
+)
+RENDER_CONCURRENCY = int(os.getenv("RENDER_CONCURRENCY", 2))
+
 
 def get_sender():
     enctype = os.getenv("SMTP_ENCTYPE", "tls").lower()
@@ -72,18 +91,23 @@ def get_sender():
 
 
 def send_email_via_smtp(
-    to, subject, contents, cc=[], bcc=[], headers={}, attachments=[]
+    yag, to, subject, contents, cc=[], bcc=[], headers={}, attachments=[]
 ):
-    yag = get_sender()
     if attachments:
         if not isinstance(contents, list):
             contents = [contents]
         contents += attachments
-    yag.send(to=to, cc=cc, bcc=bcc, headers=headers, subject=subject, contents=contents)
+    # yag.send() logs in again for every message: reuse the open connection
+    if yag.is_closed is not False:
+        yag.login()
+    recipients, msg_string = yag.prepare_send(
+        to=to, cc=cc, bcc=bcc, headers=headers, subject=subject, contents=contents
+    )
+    yag.smtp.sendmail(yag.user, recipients, msg_string)
 
 
 def send_email_via_api(
-    to, subject, contents, cc=[], bcc=[], headers={}, attachments=[]
+    session, to, subject, contents, cc=[], bcc=[], headers={}, attachments=[]
 ):
     values = [
         ("from", os.getenv("MAIL_FROM", "cardshop@kiwix.org")),
@@ -100,9 +124,8 @@ def send_email_via_api(
         ("bcc", value) for value in (bcc if isinstance(bcc, (list, tuple)) else [bcc])
     ]
     data = MultiDict(values)
-    print(attachments)
 
-    req = requests.post(
+    req = session.post(
         url=os.getenv("MAILGUN_API_URL") + "/messages",
         auth=("api", os.getenv("MAILGUN_API_KEY")),
         data=data,
@@ -114,95 +137,229 @@ def send_email_via_api(
     req.raise_for_status()
 
 
+class Mailer:
+    """ delivers messages through a single SMTP or Mailgun session
+
+        session is opened on first send and reused until closed or broken """
+
+    def __init__(self):
+        self.use_api = bool(os.getenv("MAILGUN_API_KEY", False))
+        self.session = None
+
+    def send(self, message):
+        if self.session is None:
+            self.session = requests.Session() if self.use_api else get_sender()
+        func = send_email_via_api if self.use_api else send_email_via_smtp
+        try:
+            func(
+                self.session,
+                to=message["to"],
+                subject=message["subject"],
+                contents=message["contents"],
+                cc=message["cc"] or None,
+                bcc=message["bcc"] or None,
+                headers=message["headers"],
+                attachments=[
+                    get_attachment_path(attachment)
+                    for attachment in message["attachments"]
+                ],
+            )
+        except Exception:
+            # connection might be the culprit: start a new one on next send
+            self.close()
+            raise
+        # kept until then so retries don't render again
+        remove_shipping_documents(message["attachments"])
+
+    def close(self):
+        if self.session is not None:
+            try:
+                self.session.close()
+            except Exception as exp:
+                logger.debug("Unable to close mailer session: {}".format(exp))
+            self.session = None
+
+
 def send_email(to, subject, contents, cc=[], bcc=[], headers={}, attachments=[]):
+    """ queue an email for delivery by the email-sender """
 
     to = [to] if not isinstance(to, list) else to
     cc = [cc] if not isinstance(cc, list) else cc
-    bcc = [bcc] if not isinstance(bcc, list) else bcc
+    bcc = [bcc] if not isinstance(bcc, list) else list(bcc)
 
     # bcc SUPPORT_EMAIL to every message
     if os.getenv('SUPPORT_EMAIL'):
         bcc.append(os.getenv('SUPPORT_EMAIL'))
 
-    logger.info("sending --{}-- to --{}--/--{}".format(subject, to, attachments))
-    func = (
-        send_email_via_api
-        if os.getenv("MAILGUN_API_KEY", False)
-        else send_email_via_smtp
-    )
+    logger.info("queuing --{}-- to --{}--/--{}".format(subject, to, attachments))
     # make sure we don't send message to same address twice
     cc = [a for a in cc if a not in to]
     bcc = (
         [a for a in bcc if a not in to and a not in cc]
     )
+    message = {
+        "to": to,
+        "subject": subject,
+        "contents": contents,
+        "cc": cc,
+        "bcc": bcc,
+        "headers": headers,
+        "attachments": attachments,
+    }
+    if has_app_context() and g.get("email_batch") is not None:
+        g.email_batch.append(message)
+        return None
     try:
-        return func(
-            to=to,
-            subject=subject,
-            contents=contents,
-            cc=cc or None,
-            bcc=bcc or None,
-            headers=headers,
-            attachments=attachments,
-        )
+        return EmailOutbox.enqueue(**message)
     except Exception as exp:
-        logger.error("Unable to send email: {}".format(exp))
+        logger.error("Unable to queue email: {}".format(exp))
         logger.exception(exp)
 
 
-def get_full_context(order_id, extra={}):
-    order = Orders().get_with_tasks(order_id, {"logs": 0})
-    order.update(
-        {
-            "id": order_id,
-            "status": order["statuses"][-1],
-            "min_id": order_id[:8] + order_id[-3:],
+@contextlib.contextmanager
+def batched_emails():
+    """ queue emails sent within this block at once, when leaving it """
+    g.email_batch = []
+    try:
+        yield
+    finally:
+        messages, g.email_batch = g.email_batch, None
+        try:
+            EmailOutbox.enqueue_many(messages)
+        except Exception as exp:
+            logger.error("Unable to queue {} emails: {}".format(len(messages), exp))
+            logger.exception(exp)
+
+
+class OrderContext:
+    """ order with its tasks, channel and operator, loaded once
+
+        snapshot used to render and address all emails about an order """
+
+    def __init__(self, order, channel, operator):
+        order_id = str(order["_id"])
+        self.order = order
+        self.order.update(
+            {
+                "id": order_id,
+                "status": self.order["statuses"][-1],
+                "min_id": order_id[:8] + order_id[-3:],
+            }
+        )
+        self.channel = channel
+        self.operator = operator
+
+    @staticmethod
+    def operator_username(order):
+        return (order["tasks"]["download"] or {}).get("worker")
+
+    @classmethod
+    def load(cls, order_id):
+        order = Orders.get_with_tasks(order_id)
+        operator = cls.operator_username(order)
+        return cls(
+            order,
+            Channels().find_one({"slug": order["channel"]}),
+            Users().by_username(operator) if operator else None,
+        )
+
+    @classmethod
+    def load_many(cls, order_ids):
+        """ {order_id: OrderContext} of order_ids, with three queries at most """
+        orders = Orders.get_many_with_tasks(order_ids)
+        channels = {
+            channel["slug"]: channel
+            for channel in Channels().find(
+                {"slug": {"$in": list({order["channel"] for order in orders})}}
+            )
+        }
+        usernames = list({cls.operator_username(order) for order in orders} - {None})
+        operators = (
+            {
+                user["username"]: user
+                for user in Users().find({"username": {"$in": usernames}})
+            }
+            if usernames
+            else {}
+        )
+        return {
+            str(order["_id"]): cls(
+                order,
+                channels.get(order["channel"]),
+                operators.get(cls.operator_username(order)),
+            )
+            for order in orders
         }
-    )
-    context = {"order": order}
-    context.update(extra)
-    return context
 
+    def template_context(self, extra=None):
+        context = {"order": self.order, "channel": self.channel}
+        context.update(extra or {})
+        return context
 
-def get_order_status_update_template(status):
-    return "email_order_{}.html".format(status)
+    def email_for(self, kind):
+        def _fmt(name, email):
+            return "{name} <{email}>".format(name=name, email=email)
 
+        if kind == "client":
+            return _fmt(self.order["client"]["name"], self.order["client"]["email"])
 
-def get_email_for(order_id, kind, formatted=True):
-    def _fmt(name, email):
-        return "{name} <{email}>".format(name=name, email=email)
+        if kind == "recipient":
+            return _fmt(
+                self.order["recipient"]["name"], self.order["recipient"]["email"]
+            )
 
-    if kind not in ("client", "recipient", "operator"):
+        if kind == "operator" and self.operator:
+            return self.operator["email"]
         return []
 
-    order = Orders.get_with_tasks(order_id, {"logs": 0})
-    if kind == "client":
-        return _fmt(order["client"]["name"], order["client"]["email"])
+    def write_task(self, task_id):
+        for task in self.order["tasks"]["write"]:
+            if str(task["_id"]) == str(task_id):
+                return task
+        return WriterTasks.get(task_id)
+
 
-    if kind == "recipient":
-        return _fmt(order["recipient"]["name"], order["recipient"]["email"])
+def get_order_context(order_id):
+    """ OrderContext of order, shared by all emails sent during request """
+    if not has_app_context():
+        return OrderContext.load(order_id)
+    contexts = g.setdefault("order_contexts", {})
+    if str(order_id) not in contexts:
+        contexts[str(order_id)] = OrderContext.load(order_id)
+    return contexts[str(order_id)]
 
-    if kind == "operator":
-        worker = Users().by_username(order["tasks"]["download"]["worker"])
-        return worker["email"]
-    return []
+
+def load_order_contexts(order_ids):
+    """ load contexts of many orders at once ahead of emailing them """
+    g.setdefault("order_contexts", {}).update(OrderContext.load_many(order_ids))
+
+
+def forget_order_context(order_id):
+    """ drop request's snapshot of order (once it changed) """
+    if has_app_context():
+        g.get("order_contexts", {}).pop(str(order_id), None)
+
+
+def get_order_status_update_template(status):
+    return "email_order_{}.html".format(status)
 
 
 def send_order_email_for(
     order_id, subject_tmpl, content_tmpl, to, cc=[], bcc=[], attachments=[], extra={}
 ):
-    context = get_full_context(str(order_id), extra=extra)
+    order_context = get_order_context(order_id)
+    context = order_context.template_context(extra)
 
     subject = jinja_env.get_template("{}.txt".format(subject_tmpl)).render(**context)
     content = jinja_env.get_template("{}.html".format(content_tmpl)).render(**context)
     cc = [cc] if not isinstance(cc, list) else cc
     bcc = [bcc] if not isinstance(bcc, list) else bcc
     send_email(
-        to=get_email_for(order_id, kind=to),
+        to=order_context.email_for(to),
         subject=subject,
         contents=content,
-        cc=[get_email_for(order_id, kind=item) for item in cc],
-        bcc=[get_email_for(order_id, kind=item) for item in bcc],
+        cc=[order_context.email_for(item) for item in cc],
+        bcc=[order_context.email_for(item) for item in bcc],
         attachments=attachments,
     )
 
@@ -214,6 +371,14 @@ def send_order_created_email(order_id):
     )
 
 
+def send_orders_created_emails(order_ids):
+    """ send_order_created_email for many orders, loaded and queued at once """
+    load_order_contexts(order_ids)
+    with batched_emails():
+        for order_id in order_ids:
+            send_order_created_email(order_id)
+
+
 def send_order_failed_email(order_id):
     # recipient: order failed. you'll be refunded and contacted by client
     send_order_email_for(
@@ -225,14 +390,19 @@ def send_order_failed_email(order_id):
     )
 
     # operator: download/write failed, please check conn and SD and contact client
-    order = Orders().get_with_tasks(order_id, {"logs": 0})
-    if order["tasks"].get("write") and order["tasks"]["write"]["status"] in (
-        WriterTasks.failed_to_download,
-        WriterTasks.failed_to_write,
-    ):
-
+    failed_tasks = [
+        task
+        for task in get_order_context(order_id).order["tasks"]["write"]
+        if task["status"]
+        in (WriterTasks.failed_to_download, WriterTasks.failed_to_write)
+    ]
+    if failed_tasks:
         send_order_email_for(
-            order_id, "subject_order_failed", "operator_order_failed", "operator"
+            order_id,
+            "subject_order_failed",
+            "operator_order_failed",
+            "operator",
+            extra={"task": failed_tasks[0]},
         )
 
 
@@ -256,7 +426,7 @@ def send_image_uploaded_public_email(order_id):
 
 def send_insert_card_email(order_id, task_id):
     # operator: please insert XXGB SD card onto
-    write_task = WriterTasks.get(task_id)
+    write_task = get_order_context(order_id).write_task(task_id)
     send_order_email_for(
         order_id,
         "subject_insert_card",
@@ -268,7 +438,7 @@ def send_insert_card_email(order_id, task_id):
 
 def send_image_writing_email(order_id, task_id):
     # operator: thank you ; write started
-    write_task = WriterTasks.get(task_id)
+    write_task = get_order_context(order_id).write_task(task_id)
     send_order_email_for(
         order_id,
         "subject_card_inserted",
@@ -280,7 +450,7 @@ def send_image_writing_email(order_id, task_id):
 
 def send_image_written_email(order_id, task_id):
     # client: image writing successful.
-    write_task = WriterTasks.get(task_id)
+    write_task = get_order_context(order_id).write_task(task_id)
     send_order_email_for(
         order_id,
         "subject_image_written",
@@ -292,7 +462,8 @@ def send_image_written_email(order_id, task_id):
 
 def send_order_pending_shipment_email(order_id):
     # operator: please ship SD card from X to YY
-    attachments = [build_shipping_document(order_id)]
+    # document is rendered by the email-sender, see get_attachment_path
+    attachments = [{"shipping_document": str(order_id)}]
     send_order_email_for(
         order_id,
         "subject_ship_card",
@@ -326,16 +497,50 @@ def send_worker_sos_email(ack_id):
     )
 
 
+def get_attachment_path(attachment):
+    """ path of an attachment: a path or a document to render """
+    if isinstance(attachment, dict) and "shipping_document" in attachment:
+        return build_shipping_document(attachment["shipping_document"])
+    return attachment
+
+
+@contextlib.contextmanager
+def render_slot():
+    """ one of RENDER_CONCURRENCY render slots, shared by all processes """
+    os.makedirs(SHIPPING_DOCS_DIR, exist_ok=True)
+    while True:
+        for index in range(RENDER_CONCURRENCY):
+            fh = open(os.path.join(SHIPPING_DOCS_DIR, ".slot-{}".format(index)), "w")
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                fh.close()
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+                fh.close()
+            return
+        time.sleep(0.5)
+
+
 def build_shipping_document(order_id):
-    order = Orders().get(order_id, {"logs": 0})
-    channel = Channels().get(order["channel"])
-    context = get_full_context(str(order_id), extra={"channel": channel})
-    context.update({"cwd": os.path.abspath(".")})
+    """ path to shipping PDF for order, rendered only if content changed
 
-    fname = "Shipping_{oid}.pdf".format(oid=context["order"]["min_id"])
-    fpath = os.path.join(os.getenv("TMP_DIR", "/tmp"), fname)
+        cached as <SHIPPING_DOCS_DIR>/<order_id>/<content hash>/<fname> """
+    context = get_order_context(order_id).template_context(
+        {"cwd": os.path.abspath(".")}
+    )
 
+    fname = "Shipping_{oid}.pdf".format(oid=context["order"]["min_id"])
     content = jinja_env.get_template("shipping.html").render(**context)
+    order_dir = os.path.join(SHIPPING_DOCS_DIR, str(order_id))
+    digest = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+    fpath = os.path.join(order_dir, digest, fname)
+    if os.path.exists(fpath):
+        return fpath
+
     options = {
         "page-size": "A4",
         "encoding": "UTF-8",
@@ -343,5 +548,35 @@ def build_shipping_document(order_id):
         "no-outline": None,
         "viewport-size": "1280x1024",
     }
-    pdfkit.from_string(content, fpath, options=options)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    with render_slot():
+        if os.path.exists(fpath):  # rendered while we waited
+            return fpath
+        started_on = time.monotonic()
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(fpath), suffix=".pdf", delete=False
+        ) as fh:
+            tmp_path = fh.name
+        try:
+            pdfkit.from_string(content, tmp_path, options=options)
+            os.replace(tmp_path, fpath)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    logger.info("rendered {} in {:.2f}s".format(fpath, time.monotonic() - started_on))
+
+    # drop previous versions
+    for entry in os.listdir(order_dir):
+        if entry != digest:
+            shutil.rmtree(os.path.join(order_dir, entry), ignore_errors=True)
     return fpath
+
+
+def remove_shipping_documents(attachments):
+    """ drop cached shipping documents of attachments, once sent """
+    for attachment in attachments:
+        if isinstance(attachment, dict) and "shipping_document" in attachment:
+            shutil.rmtree(
+                os.path.join(SHIPPING_DOCS_DIR, str(attachment["shipping_document"])),
+                ignore_errors=True,
+            )
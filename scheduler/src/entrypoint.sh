@@ -1,13 +1,13 @@
 #!/bin/bash
 
+if [ ! -z "${prometheus_multiproc_dir}" ]; then
+    echo "reset metrics of previous run"
+    rm -rf "${prometheus_multiproc_dir}"
+    mkdir -p "${prometheus_multiproc_dir}"
+fi
+
 echo "execute our prestart script"
 python /app/prestart.py
 
-echo "dump environment"
-declare -p | grep -Ev 'BASHOPTS|BASH_VERSINFO|EUID|PPID|SHELLOPTS|UID' > /container.env
-
-echo "start cron"
-cron
-
 echo "run parent's entrypoint"
 exec /entrypoint.sh "$@"
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" explain() the hot query shapes and report those doing collection scans
+
+    python index-advisor.py [--create-indexes]
+
+    exits with 1 if any query shape is not backed by an index """
+
+import sys
+import logging
+import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from utils.mongo import (
+    Users,
+    RefreshTokens,
+    Acknowlegments,
+    Orders,
+    CreatorTasks,
+    DownloaderTasks,
+    WriterTasks,
+    TaskLogs,
+    ensure_indexes,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_query_shapes():
+    """ list of (name, collection class, filter, sort) used on hot paths """
+    shapes = []
+    for task_cls in (CreatorTasks, DownloaderTasks, WriterTasks):
+        name = task_cls.__name__
+        shapes += [
+            (
+                "{}.find_availables".format(name),
+                task_cls,
+                task_cls.eligibility_query("worker", "kiwix"),
+                [("_id", ASCENDING)],
+            ),
+            (
+                "{}.timeout_expired".format(name),
+                task_cls,
+                task_cls.expired_query(datetime.datetime.now()),
+                [("deadline", ASCENDING)],
+            ),
+            ("{}.by_order".format(name), task_cls, {"order": ObjectId()}, None),
+        ]
+    shapes += [
+        (
+            "Orders.all_expired",
+            Orders,
+            Orders.expired_query(datetime.datetime.now()),
+            [("deadline", ASCENDING)],
+        ),
+        (
+            "Acknowlegments.update",
+            Acknowlegments,
+            Acknowlegments.key("worker", "writer", "slot"),
+            None,
+        ),
+        ("Users.by_username", Users, {"username": "manager"}, None),
+        ("RefreshTokens.token", RefreshTokens, {"token": "token"}, None),
+        (
+            "TaskLogs.read",
+            TaskLogs,
+            {"task": ObjectId(), "kind": "writer", "end": {"$gt": 0}},
+            [("start", ASCENDING)],
+        ),
+    ]
+    return shapes
+
+
+def get_stages(plan):
+    """ flat list of all stages in a (winning) plan tree """
+    stages = [plan]
+    if "inputStage" in plan:
+        stages += get_stages(plan["inputStage"])
+    for stage in plan.get("inputStages", []):
+        stages += get_stages(stage)
+    return stages
+
+
+def explain(collection_cls, query, sort=None):
+    cursor = collection_cls().find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    explained = cursor.explain()
+    winning_plan = explained["queryPlanner"]["winningPlan"]
+    # slot-based engine (mongo 5+) nests the classic plan
+    stages = get_stages(winning_plan.get("queryPlan", winning_plan))
+    return {
+        "collscan": any(stage["stage"] == "COLLSCAN" for stage in stages),
+        "indexes": [stage["indexName"] for stage in stages if "indexName" in stage],
+        "examined": explained.get("executionStats", {}).get("totalDocsExamined"),
+    }
+
+
+def run_advisor():
+    nb_collscans = 0
+    for name, collection_cls, query, sort in get_query_shapes():
+        result = explain(collection_cls, query, sort)
+        if result["collscan"]:
+            nb_collscans += 1
+        logger.info(
+            "{flag} {name}: indexes={indexes} examined={examined}".format(
+                flag="COLLSCAN" if result["collscan"] else "OK",
+                name=name,
+                indexes=",".join(result["indexes"]) or "-",
+                examined=result["examined"],
+            )
+        )
+
+    logger.info("{} query shape(s) doing collection scans".format(nb_collscans))
+    return nb_collscans
+
+
+if __name__ == "__main__":
+    if "--create-indexes" in sys.argv:
+        ensure_indexes()
+    sys.exit(1 if run_advisor() else 0)
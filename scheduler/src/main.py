@@ -17,7 +17,12 @@ from routes import (
     home,
     warehouses,
     workers,
+    jobs,
+    stats,
+    metrics,
+    profiling,
 )
+from utils import metrics as request_metrics, queries
 from utils.json import Encoder
 from prestart import Initializer
 
@@ -34,8 +39,14 @@ flask.register_blueprint(orders.blueprint)
 flask.register_blueprint(tasks.blueprint)
 flask.register_blueprint(warehouses.blueprint)
 flask.register_blueprint(workers.blueprint)
+flask.register_blueprint(jobs.blueprint)
+flask.register_blueprint(stats.blueprint)
+flask.register_blueprint(metrics.blueprint)
+flask.register_blueprint(profiling.blueprint)
 
 errors.register_handlers(flask)
+request_metrics.init_app(flask)
+queries.init_app(flask)
 
 
 if __name__ == "__main__":
@@ -2,34 +2,43 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+""" resident daemon running periodic jobs (see periodic-tasks.conf)
+
+    python periodic-tasks.py [job ...]
+
+    with job names, runs those jobs once right away instead """
+
 import os
+import sys
+import time
+import random
+import signal
+import socket
 import logging
 import datetime
+import threading
 import subprocess
 
 import requests
-import humanfriendly
 
 from emailing import send_order_failed_email
-from utils.mongo import Orders, Tasks
-
-logging.basicConfig(level=logging.DEBUG)
+from utils.mongo import (
+    Orders,
+    CreatorTasks,
+    DownloaderTasks,
+    WriterTasks,
+    Leases,
+    PeriodicJobs,
+    pool_stats,
+)
+
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-
-def is_expired(status, since, size=0):
-    now = datetime.datetime.now()
-    min_bps = int(humanfriendly.parse_size("4MiB") / 8)
-
-    if status == Tasks.building:
-        return since < now - datetime.timedelta(hours=12)
-
-    if status == Tasks.wiping_sdcard:
-        return since < now - datetime.timedelta(minutes=30)
-
-    if status in (Tasks.uploading, Tasks.downloading, Tasks.writing):
-        size = humanfriendly.parse_size(size)
-        return since < now - datetime.timedelta(seconds=int(size / min_bps))
+BATCH_SIZE = 500
+TICK = int(os.getenv("PERIODIC_TICK", 5))  # seconds between schedule checks
+JITTER = float(os.getenv("PERIODIC_JITTER", 0.1))  # +/- fraction of interval
+LEASE_DURATION = int(os.getenv("PERIODIC_LEASE_DURATION", 300))  # renewed
 
 
 def remove_image(image_fname, upload_uri):
@@ -75,103 +84,168 @@ def remove_image(image_fname, upload_uri):
     return subprocess.run(args).returncode == 0
 
 
-def run_periodic_tasks():
-    logger.info("running periodic tasks !!")
-
-    # timeout orders based on status
-
-    # orders cant stay in creation for more than 12h
-    # orders in downloading/writing cant be slower than 4Mb/s
-    # now = datetime.datetime.now()
-    # min_bps = int(humanfriendly.parse_size("4MiB") / 8)
-
-    # for morder in Orders().find(
-    #     {"status": {"$in": [Orders().creating, Orders.downloading, Orders.writing]}},
-    #     {"_id": 1},
-    # ):
-    #     order = Orders().get_with_tasks(morder["_id"])
-    #     ls = order["statuses"][-1]
-
-    #     # prepare expired dt based on status
-    #     if ls["status"] == Orders().creating:
-    #         task = CreatorTasks().get(order["tasks"]["create"])
-    #     elif ls["status"] in (Orders.downloading, Orders.writing):
-    #         size = humanfriendly.parse_size(order["config"]["size"])
-    #         expired = now - datetime.timedelta(seconds=int(size / min_bps))
-    #         if ls["status"] == Orders.downloading:
-    #             task_cls, task_id = DownloaderTasks, order["tasks"]["download"]
-    #         else:
-    #             task_cls, task_id = WriterTasks, order["tasks"]["write"]
-    #     else:
-    #         # last status not in-progress
-    #         continue
-
-    #     # compare last update with expiry datetime
-    #     if ls["on"] > expired:
-    #         continue
-
-    #     # timeout task
-    #     task_cls().update_status(task_id=task_id, status=task_cls.timedout)
-
-    #     # timeout order
-    #     task_cls().cascade_status(task_id=task_id, status=task_cls.timedout)
-
-    #     # notify failure
-    #     send_order_failed_email(order["_id"])  # TODO: forward to task/order mgmt
-
-    logger.info("timing out expired orders")
-    for task in Tasks.all_inprogress():
-        task_id = task["_id"]
-        ls = task["statuses"][-1]
-
-        if not is_expired(ls["status"], ls["on"]):
-            logger.info("skipping non-expired task #{}".format(task_id))
-            continue
-
-        logger.info("timing out task #{}".format(task_id))
-
-        order = Orders().get_with_tasks(task["order"])
-
-        # timeout task
-        task.update_status(task_id=task_id, status=Tasks.timedout)
-
-        # if write, cancel peers
-        if ls["status"] in (Tasks.wiping_sdcard, Tasks.writing):
-            for peer in order["tasks"]["write"]:
-                if peer["_id"] == task_id:
-                    continue
-                task.update_status(task_id=peer["_id"], status=Tasks.canceled)
-
-        # cascade
-        task.cascade_status(task_id=task_id, status=task.timedout)
-
-        # notify
-        send_order_failed_email(order["_id"])  # TODO: forward to task/order mgmt
-
-    logger.info("removing expired donwload files")
+def timeout_expired_tasks():
+    """ time out tasks past their deadline, in batches """
     now = datetime.datetime.now()
+    for task_cls in (CreatorTasks, DownloaderTasks, WriterTasks):
+        while True:
+            matched, order_ids = task_cls.timeout_expired(now, limit=BATCH_SIZE)
+            for order_id in order_ids:
+                logger.info(
+                    "timed out {} of order #{}".format(task_cls.__name__, order_id)
+                )
+                send_order_failed_email(order_id)  # TODO: forward to task/order mgmt
+            # matched tasks are no longer expired: timed out or moved on since
+            if not matched:
+                break
+
+
+def remove_expired_images():
+    """ remove images of orders past their expiration from warehouses
+
+        orders which image could not be removed are retried later (backoff)
+        so that they don't hold back the others """
+    now = datetime.datetime.now()
+    seen = set()
+    while True:
+        orders = [
+            order
+            for order in Orders.all_expired(now, limit=BATCH_SIZE)
+            if order["_id"] not in seen
+        ]
+        if not orders:
+            break
+        for order in orders:
+            seen.add(order["_id"])
+            logger.info(
+                "Order #{} has reach expiration. deleting file".format(order["_id"])
+            )
+            order_fname = "{}.img".format(order["_id"])
+
+            # actually delete file
+            if remove_image(order_fname, order["warehouse"]["upload_uri"]):
+                # update order (all done)
+                Orders().update_status(order["_id"], Orders.expired)
+            else:
+                retry_on = Orders.postpone_expiration(order, now)
+                logger.error(
+                    "Failed to remove expired file {}, retrying on {}".format(
+                        order_fname, retry_on
+                    )
+                )
+
+
+class Job:
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval  # seconds
+
+    def next_run_on(self, now):
+        """ next run date, spread so replicas and jobs don't run in sync """
+        return now + datetime.timedelta(
+            seconds=self.interval * (1 + random.uniform(-JITTER, JITTER))
+        )
 
-    for order in Orders.all_pending_expiry():
-        ls = order["statuses"][-1]
-
-        if not ls["status"] == Orders.pending_expiry:
-            continue  # wrong timing
-
-        if not order["sd_card"]["expiration"] < now:
-            continue  # expiration not reached
 
+JOBS = [
+    Job(
+        "timeout-tasks",
+        timeout_expired_tasks,
+        int(os.getenv("TIMEOUT_TASKS_INTERVAL", 60)),
+    ),
+    Job(
+        "expire-images",
+        remove_expired_images,
+        int(os.getenv("EXPIRE_IMAGES_INTERVAL", 600)),
+    ),
+]
+
+
+class Daemon:
+    """ runs JOBS on schedule (or on-demand, see PeriodicJobs.request_run)
+
+        each job runs under a lease so that a single replica runs it at once """
+
+    def __init__(self, jobs):
+        self.jobs = {job.name: job for job in jobs}
+        self.holder = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.stopped = threading.Event()
+
+    def stop(self, signum=None, frame=None):
+        logger.info("stop requested, finishing current job")
+        self.stopped.set()
+
+    def keep_lease(self, name, done):
+        while not done.wait(LEASE_DURATION / 3):
+            Leases.acquire(name, self.holder, LEASE_DURATION)
+
+    def run_job(self, job, force=False):
+        """ run job unless another replica runs (or just ran) it """
+        if not Leases.acquire(job.name, self.holder, LEASE_DURATION):
+            return False
+        # might have run elsewhere since we checked
+        if not force and job.name not in PeriodicJobs.due(
+            datetime.datetime.now(), names=[job.name]
+        ):
+            Leases.release(job.name, self.holder)
+            return False
+
+        done = threading.Event()
+        keeper = threading.Thread(target=self.keep_lease, args=(job.name, done))
+        keeper.start()
+        started_on = datetime.datetime.now()
+        started = time.monotonic()
+        error = None
+        try:
+            job.func()
+        except Exception as exp:
+            logger.exception("{} failed".format(job.name))
+            error = str(exp)
+        finally:
+            duration = time.monotonic() - started
+            done.set()
+            keeper.join()
+            PeriodicJobs.record_run(
+                job.name,
+                holder=self.holder,
+                started_on=started_on,
+                duration=duration,
+                next_run_on=job.next_run_on(datetime.datetime.now()),
+                error=error,
+            )
+            Leases.release(job.name, self.holder)
         logger.info(
-            "Order #{} has reach expiration. deleting file".format(order["_id"])
+            "{name} ran in {duration:.2f}s -- mongo pool: {pool}".format(
+                name=job.name, duration=duration, pool=pool_stats()
+            )
         )
-        order_fname = "{}.img".format(order["_id"])
+        return True
+
+    def run(self):
+        logger.info("starting periodic tasks daemon ({})".format(self.holder))
+        now = datetime.datetime.now()
+        for job in self.jobs.values():
+            PeriodicJobs.declare(job.name, job.interval, first_run_on=now)
 
-        # actually delete file
-        if remove_image(order_fname, order["warehouse"]["upload_uri"]):
-            # update order (all done)
-            Orders().update_status(order["_id"], Orders.expired)
-        else:
-            logger.error("Failed to remove expired file {}".format(order_fname))
+        while not self.stopped.is_set():
+            for name in PeriodicJobs.due(datetime.datetime.now()):
+                if name in self.jobs and not self.stopped.is_set():
+                    self.run_job(self.jobs[name])
+            self.stopped.wait(TICK)
+        logger.info("periodic tasks daemon stopped")
 
 
 if __name__ == "__main__":
-    run_periodic_tasks()
+    daemon = Daemon(JOBS)
+    if len(sys.argv) > 1:  # run jobs once, now
+        for name in sys.argv[1:]:
+            if name not in daemon.jobs:
+                sys.exit(
+                    "Unknown job `{}`. Jobs: {}".format(name, ", ".join(daemon.jobs))
+                )
+            daemon.run_job(daemon.jobs[name], force=True)
+    else:
+        signal.signal(signal.SIGTERM, daemon.stop)
+        signal.signal(signal.SIGINT, daemon.stop)
+        daemon.run()
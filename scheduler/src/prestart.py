@@ -8,7 +8,6 @@ import logging
 
 from werkzeug.security import generate_password_hash
 from cerberus import Validator
-from pymongo import ASCENDING
 
 from utils import mongo
 from emailing import send_email
@@ -46,15 +45,8 @@ class Initializer:
 
     @staticmethod
     def create_database_indexes():
-        mongo.Users().create_index(
-            [(mongo.Users.username, ASCENDING)], name="username", unique=True
-        )
-        mongo.Users().create_index(
-            [(mongo.Users.email, ASCENDING)], name="email", unique=True
-        )
-        mongo.RefreshTokens().create_index(
-            [("token", ASCENDING)], name="token", unique=True
-        )
+        mongo.ensure_indexes()
+        mongo.backfill_deadlines()
 
     @staticmethod
     def create_initial_data():
@@ -4,6 +4,7 @@ from jwt import exceptions as jwt_exceptions
 from bson.objectid import ObjectId, InvalidId
 
 from utils.token import AccessToken
+from utils.pagination import paginate, date_range_query, parse_datetime
 from . import errors
 
 
@@ -58,6 +59,48 @@ def only_for_roles(roles: list = None):
     return decorate
 
 
+def get_page(collection, query, projection=None, filters=None, reverse=False):
+    """ paginated response for collection from request's URL parameters
+
+        filters: names of URL parameters to match on (exact value)
+        since/until: filter on creation date of the document """
+    skip = request.args.get("skip", default=0, type=int)
+    limit = request.args.get("limit", default=20, type=int)
+    cursor = request.args.get("cursor", default=None, type=str)
+    skip = 0 if skip < 0 else skip
+    limit = 20 if limit <= 0 else limit
+
+    query = dict(query)
+    for key in filters or []:
+        if request.args.get(key) is not None:
+            query[key] = request.args.get(key)
+
+    since, until = request.args.get("since"), request.args.get("until")
+    try:
+        created = date_range_query(
+            since=parse_datetime(since) if since else None,
+            until=parse_datetime(until) if until else None,
+        )
+        if created:
+            query["_id"] = created
+        items, next_cursor, count = paginate(
+            collection,
+            query,
+            projection,
+            limit=limit,
+            cursor=cursor,
+            skip=skip,
+            reverse=reverse,
+        )
+    except ValueError as exp:
+        raise errors.BadRequest(str(exp))
+
+    return {
+        "meta": {"skip": skip, "limit": limit, "count": count, "next": next_cursor},
+        "items": items,
+    }
+
+
 def ensure_user_matches_role(user, roles):
     roles = [roles] if not isinstance(roles, (list, tuple)) else roles
     if user.get("role") not in roles:
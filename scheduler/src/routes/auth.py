@@ -70,7 +70,7 @@ def token():
     """
     Issue a new set of access and refresh token after validating an old refresh token
     Old refresh token can only be used once and hence is removed from database
-    Unused but expired refresh token is also deleted from database
+    Unused but expired refresh tokens are removed by a TTL index
     """
 
     # get old refresh token from request header
@@ -78,10 +78,14 @@ def token():
     if old_token is None:
         raise BadRequest()
 
-    # check token exists in database and get expire time and user id
-    collection = RefreshTokens()
-    old_token_document = collection.find_one(
-        {"token": UUID(old_token)}, {"expire_time": 1, "user_id": 1}
+    try:
+        old_token = UUID(old_token)
+    except ValueError:
+        raise Unauthorized()
+
+    # remove token (single use) and get its expire time and user id
+    old_token_document = RefreshTokens().find_one_and_delete(
+        {"token": old_token}, {"expire_time": 1, "user_id": 1}
     )
     if old_token_document is None:
         raise Unauthorized()
@@ -110,10 +114,6 @@ def token():
         }
     )
 
-    # delete old refresh token from database
-    collection.delete_one({"token": UUID(old_token)})
-    collection.delete_many({"expire_time": {"$lte": datetime.now()}})
-
     # send response
     response_json = {"access_token": access_token, "refresh_token": refresh_token}
     response = jsonify(response_json)
@@ -1,4 +1,3 @@
-import pymongo
 from bson import ObjectId
 from flask import Blueprint, request, jsonify, Response
 from jsonschema import validate, ValidationError
@@ -10,6 +9,7 @@ from . import (
     errors,
     ensure_user_matches_role,
     only_for_roles,
+    get_page,
 )
 
 
@@ -27,27 +27,7 @@ def collection(user: dict):
         # check user permission
         ensure_user_matches_role(user, Users.MANAGER_ROLE)
 
-        # unpack url parameters
-        skip = request.args.get("skip", default=0, type=int)
-        limit = request.args.get("limit", default=20, type=int)
-        skip = 0 if skip < 0 else skip
-        limit = 20 if limit <= 0 else limit
-
-        query = {}
-        projection = None
-        cursor = (
-            Channels()
-            .find(query, projection)
-            .sort([("$natural", pymongo.ASCENDING)])
-            .skip(skip)
-            .limit(limit)
-        )
-        count = Channels().count_documents(query)
-        channels = [channel for channel in cursor]
-
-        return jsonify(
-            {"meta": {"skip": skip, "limit": limit, "count": count}, "items": channels}
-        )
+        return jsonify(get_page(Channels(), query={}))
     elif request.method == "POST":
         # check user permission
         ensure_user_matches_role(user, Users.MANAGER_ROLE)
@@ -62,6 +42,7 @@ def collection(user: dict):
             raise errors.BadRequest("Channel with this slug exists.")
 
         channel_id = Channels().insert_one(request_json).inserted_id
+        Channels.clear_private_slugs()
         return jsonify({"_id": channel_id})
 
 
@@ -84,6 +65,7 @@ def document(channel_id: ObjectId, user: dict):
         deleted_count = Channels().delete_one({"_id": channel_id}).deleted_count
         if deleted_count == 0:
             raise errors.NotFound()
+        Channels.clear_private_slugs()
 
         return Response()
 
@@ -6,6 +6,8 @@ def register_handlers(app: Flask):
     app.errorhandler(BadRequest)(BadRequest.handler)
     app.errorhandler(Unauthorized)(Unauthorized.handler)
     app.errorhandler(NotFound)(NotFound.handler)
+    app.errorhandler(Conflict)(Conflict.handler)
+    app.errorhandler(ServiceUnavailable)(ServiceUnavailable.handler)
     app.errorhandler(InternalError)(InternalError.handler)
 
     @app.errorhandler(jwt_exceptions.ExpiredSignature)
@@ -71,6 +73,39 @@ class NotFound(Exception):
             return Response(status=404)
 
 
+# 409
+class Conflict(Exception):
+    def __init__(self, message: str = None):
+        self.message = message
+
+    @staticmethod
+    def handler(e):
+        if isinstance(e, Conflict) and e.message is not None:
+            response = jsonify({"error": e.message})
+            response.status_code = 409
+            return response
+        else:
+            return Response(status=409)
+
+
+# 503
+class ServiceUnavailable(Exception):
+    def __init__(self, message: str = None, retry_after: int = None):
+        self.message = message
+        self.retry_after = retry_after
+
+    @staticmethod
+    def handler(e):
+        if isinstance(e, ServiceUnavailable) and e.message is not None:
+            response = jsonify({"error": e.message})
+        else:
+            response = Response()
+        response.status_code = 503
+        if isinstance(e, ServiceUnavailable) and e.retry_after is not None:
+            response.headers["Retry-After"] = str(e.retry_after)
+        return response
+
+
 # 500
 class InternalError(Exception):
     @staticmethod
@@ -0,0 +1,26 @@
+from flask import Blueprint, jsonify
+
+from . import errors
+from utils.mongo import Users, PeriodicJobs
+from . import authenticate, only_for_roles
+
+
+blueprint = Blueprint("job", __name__, url_prefix="/jobs")
+
+
+@blueprint.route("/", methods=["GET"])
+@authenticate
+@only_for_roles(roles=Users.MANAGER_ROLE)
+def collection(user: dict):
+    """ periodic jobs with their schedule and last run """
+    return jsonify({"items": PeriodicJobs.all()})
+
+
+@blueprint.route("/<string:name>/run", methods=["POST"])
+@authenticate
+@only_for_roles(roles=Users.MANAGER_ROLE)
+def run(name: str, user: dict):
+    """ request periodic-tasks daemon to run job now """
+    if not PeriodicJobs.request_run(name):
+        raise errors.NotFound()
+    return jsonify({"_id": name, "requested": True}), 202
@@ -0,0 +1,49 @@
+import os
+import hmac
+
+from flask import Blueprint, Response, request
+from prometheus_client import CollectorRegistry, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+
+from utils import metrics
+from utils.mongo import CreatorTasks, DownloaderTasks, WriterTasks
+from . import errors
+
+
+blueprint = Blueprint("metrics", __name__, url_prefix="/metrics")
+
+# scrapers send it as `Authorization: Bearer <token>`. unset: no /metrics
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+
+class PendingTasksCollector:
+    """ tasks waiting for a worker, counted at scrape time """
+
+    def collect(self):
+        gauge = GaugeMetricFamily(
+            "cardshop_pending_tasks", "tasks waiting for a worker", labels=["type"]
+        )
+        for task_type, task_cls in (
+            ("creator", CreatorTasks),
+            ("downloader", DownloaderTasks),
+            ("writer", WriterTasks),
+        ):
+            gauge.add_metric(
+                [task_type], task_cls().count_documents({"status": task_cls.pending})
+            )
+        yield gauge
+
+
+registry = CollectorRegistry(auto_describe=False)
+registry.register(PendingTasksCollector())
+
+
+@blueprint.route("", methods=["GET"])
+def collection():
+    """ prometheus metrics of all processes """
+    if not METRICS_TOKEN:
+        raise errors.NotFound()
+    token = request.headers.get("Authorization", "")[len("Bearer ") :]
+    if not hmac.compare_digest(token.encode("utf-8"), METRICS_TOKEN.encode("utf-8")):
+        raise errors.Unauthorized("token invalid")
+    return Response(metrics.render(registry), content_type=CONTENT_TYPE_LATEST)
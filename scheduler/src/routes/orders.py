@@ -1,6 +1,3 @@
-import datetime
-
-import pymongo
 from bson import ObjectId
 from distutils.util import strtobool
 from flask import Blueprint, request, jsonify, render_template
@@ -10,14 +7,17 @@ from utils.mongo import Orders, Users
 from utils.json import ensure_objectid
 from emailing import (
     send_order_created_email,
+    send_orders_created_emails,
     send_order_shipped_email,
     send_order_failed_email,
 )
-from . import authenticate, bson_object_id, errors, only_for_roles
+from . import authenticate, bson_object_id, errors, only_for_roles, get_page
 
 
 blueprint = Blueprint("order", __name__, url_prefix="/orders")
 
+BULK_MAX_ORDERS = 1000
+
 
 def string_to_bool(string):
     return bool(strtobool(str(string)))
@@ -32,26 +32,15 @@ def collection(user: dict):
     """
 
     if request.method == "GET":
-        # unpack url parameters
-        skip = request.args.get("skip", default=0, type=int)
-        limit = request.args.get("limit", default=20, type=int)
-        skip = 0 if skip < 0 else skip
-        limit = 20 if limit <= 0 else limit
-
-        query = {}
-        projection = {"_id": 1}
-        cursor = (
-            Orders()
-            .find(query, projection)
-            .sort([("$natural", pymongo.DESCENDING)])
-            .skip(skip)
-            .limit(limit)
-        )
-        count = Orders().count_documents(query)
-        orders = [Orders.get(order.get("_id")) for order in cursor]
-
+        # newest first
         return jsonify(
-            {"meta": {"skip": skip, "limit": limit, "count": count}, "items": orders}
+            get_page(
+                Orders(),
+                query={},
+                projection={"logs": 0},
+                filters=["status", "channel"],
+                reverse=True,
+            )
         )
     if request.method == "POST":
 
@@ -62,15 +51,8 @@ def collection(user: dict):
         except ValidationError as error:
             raise errors.BadRequest(error.message)
 
-        request_json["status"] = Orders().created
-        request_json["tasks"] = {}
-        request_json["statuses"] = [
-            {"status": Orders().created, "on": datetime.datetime.now(), "payload": None}
-        ]
-
         # actually create Ordr
-        order_id = Orders().insert_one(request_json).inserted_id
-        print("ORDER_ID", order_id)
+        order_id = Orders().insert_one(Orders.prepare(request_json)).inserted_id
 
         # send email about new order
         send_order_created_email(order_id)
@@ -80,6 +62,61 @@ def collection(user: dict):
 
         return jsonify({"_id": order_id})
 
+
+@blueprint.route("/bulk", methods=["POST"])
+@authenticate
+@only_for_roles(roles=Users.MANAGER_ROLE)
+def bulk(user: dict):
+    """
+    Create many orders at once: {"orders": [order, ...]}
+    Returns a result ({"_id"} or {"error"}) for each order, in order
+    """
+
+    orders = (request.get_json(silent=True) or {}).get("orders")
+    if not isinstance(orders, list) or not orders:
+        raise errors.BadRequest("`orders` must be a non-empty list of orders")
+    if len(orders) > BULK_MAX_ORDERS:
+        raise errors.BadRequest(
+            "Too many orders ({}/{})".format(len(orders), BULK_MAX_ORDERS)
+        )
+
+    # validate each order independently
+    results = [None] * len(orders)
+    documents, indexes = [], []
+    for index, order in enumerate(orders):
+        try:
+            if not isinstance(order, dict):
+                raise ValidationError("order must be an object")
+            validate(order, Orders().schema)
+        except ValidationError as error:
+            results[index] = {"error": error.message}
+        else:
+            documents.append(Orders.prepare(order))
+            indexes.append(index)
+
+    created = []
+    for index, document, (order_id, error) in zip(
+        indexes, documents, Orders.create_many(documents)
+    ):
+        if error:
+            results[index] = {"error": error}
+        else:
+            results[index] = {"_id": order_id}
+            created.append(dict(document, _id=order_id))
+
+    if created:
+        send_orders_created_emails([order["_id"] for order in created])
+        Orders.create_creator_tasks(created)
+
+    return jsonify(
+        {
+            "items": results,
+            "created": len(created),
+            "failed": len(orders) - len(created),
+        }
+    )
+
+
 @blueprint.route("/anonymize", methods=["PATCH"])
 @authenticate
 @only_for_roles(roles=Users.MANAGER_ROLE)
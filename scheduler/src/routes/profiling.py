@@ -0,0 +1,49 @@
+import os
+
+from flask import Blueprint, request, jsonify, send_from_directory
+
+from . import errors
+from utils.mongo import Users
+from utils.profiling import Profiler, PROFILING_DIR, list_profiles
+from . import authenticate, only_for_roles
+
+
+blueprint = Blueprint("profiling", __name__, url_prefix="/profiling")
+
+
+@blueprint.route("/", methods=["GET", "POST"])
+@authenticate
+@only_for_roles(roles=Users.MANAGER_ROLE)
+def collection(user: dict):
+    """ list profiles or profile the process handling the request
+
+        duration (seconds) is set by URL parameter. With several uwsgi
+        processes, only the one receiving the request is profiled. """
+    if request.method == "GET":
+        return jsonify({"items": list_profiles()})
+
+    duration = request.args.get("duration", default=30, type=int)
+    session = Profiler.start("scheduler", duration)
+    if session is None:
+        raise errors.Conflict("a profiling session is already running")
+    return (
+        jsonify(
+            {
+                "_id": session.profile_name,
+                "pid": os.getpid(),
+                "duration": session.duration,
+            }
+        ),
+        202,
+    )
+
+
+@blueprint.route("/<string:name>", methods=["GET"])
+@authenticate
+@only_for_roles(roles=Users.MANAGER_ROLE)
+def document(name: str, user: dict):
+    """ profile summary (or collapsed stacks with ?format=collapsed) """
+    extension = ".collapsed" if request.args.get("format") == "collapsed" else ".txt"
+    if name not in list_profiles():
+        raise errors.NotFound()
+    return send_from_directory(PROFILING_DIR, name + extension, mimetype="text/plain")
@@ -0,0 +1,69 @@
+import os
+import time
+import datetime
+import threading
+
+from flask import Blueprint, jsonify
+
+from utils.mongo import (
+    Users,
+    Acknowlegments,
+    CreatorTasks,
+    DownloaderTasks,
+    WriterTasks,
+)
+from . import authenticate, only_for_roles
+
+
+blueprint = Blueprint("stats", __name__, url_prefix="/stats")
+
+
+class StatsCache:
+    """ in-process short-lived cache of statistics (shared by all managers) """
+
+    ttl = int(os.getenv("STATS_CACHE_TTL", 15))  # seconds
+    lock = threading.Lock()
+    entries = {}
+
+    @classmethod
+    def get(cls, key, compute):
+        now = time.monotonic()
+        with cls.lock:
+            entry = cls.entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        value = compute()
+        with cls.lock:
+            cls.entries[key] = (now + cls.ttl, value)
+        return value
+
+
+def get_queues_stats():
+    since = datetime.datetime.now() - datetime.timedelta(hours=24)
+    stats = {
+        task_type: task_cls.queue_stats(since)
+        for task_type, task_cls in (
+            ("creator", CreatorTasks),
+            ("downloader", DownloaderTasks),
+            ("writer", WriterTasks),
+        )
+    }
+    stats["failed_since"] = since
+    return stats
+
+
+@blueprint.route("/fleet", methods=["GET"])
+@authenticate
+@only_for_roles(roles=Users.MANAGER_ROLE)
+def fleet(user: dict):
+    """ worker slots per worker, type and status """
+    return jsonify(StatsCache.get("fleet", Acknowlegments.fleet_stats))
+
+
+@blueprint.route("/queues", methods=["GET"])
+@authenticate
+@only_for_roles(roles=Users.MANAGER_ROLE)
+def queues(user: dict):
+    """ tasks per stage and status, failures of the last 24h """
+    return jsonify(StatsCache.get("queues", get_queues_stats))
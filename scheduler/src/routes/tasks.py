@@ -7,6 +7,7 @@ import datetime
 from bson import ObjectId
 from flask import Blueprint, request, jsonify, Response, render_template
 
+from utils.notifications import Hub
 from utils.mongo import (
     CreatorTasks,
     WriterTasks,
@@ -15,6 +16,7 @@ from utils.mongo import (
     Tasks,
     Orders,
     Acknowlegments,
+    TaskLogs,
 )
 from . import authenticate, bson_object_id, errors, only_for_roles
 from emailing import (
@@ -25,6 +27,7 @@ from emailing import (
     send_image_written_email,
     send_order_failed_email,
     send_order_pending_shipment_email,
+    forget_order_context,
 )
 
 
@@ -35,6 +38,22 @@ blueprint = Blueprint("task", __name__, url_prefix="/tasks")
 #     return CreatorTasks if user["role"] == Users.CREATOR_ROLE else WriterTasks
 
 
+def get_wait():
+    """ seconds a long-polling request may be held (?wait=<seconds>) """
+    wait = request.args.get("wait", default=0, type=float)
+    return max(0, min(wait, Hub.max_wait))
+
+
+def poll(key, fetch, timeout):
+    """ Hub.poll, answering 503 if this process holds too many requests """
+    try:
+        return Hub.poll(key, fetch, timeout)
+    except Hub.Busy:
+        raise errors.ServiceUnavailable(
+            "too many waiting requests, retry later", retry_after=Hub.max_wait
+        )
+
+
 def tasks_cls_for(task_type):
     cls = {
         "creator": CreatorTasks,
@@ -56,11 +75,52 @@ def typed_collection(task_type: str, user: dict):
             worker_type=task_type,
             slot=request.args.get("slot"),
         )
-        tasks = tasks_cls_for(task_type).find_availables(channel=user.get("channel"))
+        limit = request.args.get("limit", default=20, type=int)
+        limit = 20 if limit <= 0 else min(limit, 100)
+        fields = request.args.get("fields", default="", type=str)
+        try:
+            tasks = tasks_cls_for(task_type).find_availables(
+                username=user["username"],
+                channel=user.get("channel"),
+                fields=[field for field in fields.split(",") if field],
+                limit=limit,
+            )
+        except ValueError as exc:
+            raise errors.BadRequest(str(exc))
 
         return jsonify(tasks)
 
 
+@blueprint.route("/<string:task_type>/claim", methods=["POST"])
+@authenticate
+@only_for_roles(roles=Users.WORKER_ROLES)
+def claim_task(task_type: str, user: dict):
+    """ assign next available task to requesting worker (null if none)
+
+        with ?wait=<seconds>, request is held until a task is available """
+    task_cls = tasks_cls_for(task_type)
+    task = poll(
+        Hub.key(task_cls().name), lambda: task_cls.claim(user), timeout=get_wait()
+    )
+
+    # update ACK
+    if task is None:
+        Acknowlegments.idle_update(
+            username=user["username"],
+            worker_type=task_type,
+            slot=request.args.get("slot"),
+        )
+    else:
+        Acknowlegments.busy_update(
+            username=user["username"],
+            worker_type=task_type,
+            slot=request.args.get("slot"),
+            task_id=task["_id"],
+        )
+
+    return jsonify(task)
+
+
 @blueprint.route("/<string:task_type>/<string:task_id>", methods=["GET", "DELETE"])
 @authenticate
 @only_for_roles(roles=Users.WORKER_ROLES)
@@ -80,24 +140,46 @@ def document(task_id: ObjectId, task_type: str, user: dict):
         deleted_count = task_cls().delete_one({"_id": task_id}).deleted_count
         if deleted_count == 0:
             raise errors.NotFound()
+        TaskLogs().delete_many({"task": task_id})
 
         # send email about deletion
 
         return jsonify({"_id": task_id})
 
 
+@blueprint.route("/<string:task_type>/<string:task_id>/wait", methods=["GET"])
+@authenticate
+@only_for_roles(roles=Users.WORKER_ROLES)
+@bson_object_id(["task_id"])
+def wait_for_status(task_id: ObjectId, task_type: str, user: dict):
+    """ task once its status is not `until_status_not` anymore
+
+        held until then or for ?wait=<seconds>. client checks returned status """
+    status = request.args.get("until_status_not")
+    if not status:
+        raise errors.BadRequest("until_status_not is required")
+    task_cls = tasks_cls_for(task_type)
+    last = {}
+
+    def get_changed_task():
+        last["task"] = task_cls.get(task_id)
+        if last["task"] is None:
+            raise errors.NotFound()
+        return last["task"] if last["task"]["status"] != status else None
+
+    poll(Hub.key(task_cls().name, task_id), get_changed_task, timeout=get_wait())
+    return jsonify(last["task"])
+
+
 @blueprint.route("/<string:task_type>/<string:task_id>/request", methods=["PATCH"])
 @authenticate
 @only_for_roles(roles=Users.WORKER_ROLES)
 @bson_object_id(["task_id"])
 def register_task(task_id: ObjectId, task_type: str, user: dict):
     task_cls = tasks_cls_for(task_type)
-    task = task_cls().find({"_id": task_id, "status": task_cls.pending})
-    if task is None:
+    if not task_cls.register(task_id, user):
         raise errors.NotFound()
 
-    task_cls.register(task_id, user)
-
     # update ACK
     Acknowlegments.busy_update(
         username=user["username"],
@@ -121,8 +203,8 @@ def confirm_inserted_task(task_id: ObjectId, task_type: str):
     if task is None:
         raise errors.NotFound()
 
-    task_cls.update_status(task_id, status=task_cls.card_inserted)
-    task_cls.cascade_status(task_id, task_cls.card_inserted)
+    if task_cls.update_status(task_id, status=task_cls.card_inserted):
+        task_cls.cascade_status(task_id, task_cls.card_inserted, task["order"])
 
     order = Orders().get(task["order"])
 
@@ -148,18 +230,29 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
 
     # update task status
     status = request_json.get("status")
-    task_cls.update_status(
+    if status not in task_cls.TRANSITIONS:
+        raise errors.BadRequest("unknown status `{}`".format(status))
+    if not task_cls.update_status(
         task_id,
-        status=request_json.get("status"),
+        status=status,
         payload=request_json.get("log"),
         extra_update=request_json.get("extra"),
-    )
+    ):
+        current = (task_cls().find_one({"_id": task_id}, {"status": 1}) or {}).get(
+            "status"
+        )
+        if current != status:
+            raise errors.Conflict(
+                "task can't move from `{}` to `{}`".format(current, status)
+            )
+        # already in that status: nothing to cascade
+        return jsonify({"_id": task_id, "updated": False})
 
     # update order status based on this task
-    task_cls.cascade_status(task_id, request_json.get("status"))
+    order_id = task["order"]
+    task_cls.cascade_status(task_id, status, order_id)
 
     # send email if appropriate
-    order_id = task["order"]
 
     # create task uploaded image
     if status == Tasks.uploaded_public:
@@ -168,7 +261,7 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
         expiration = datetime.datetime.now() + datetime.timedelta(
             days=order["sd_card"]["duration"]
         )
-        Orders().update(order_id, {"sd_card.expiration": expiration})
+        Orders.set_expiration(order_id, expiration)
         send_image_uploaded_public_email(order_id)
     elif status == Tasks.uploaded:
         send_image_uploaded_email(order_id)
@@ -202,10 +295,11 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
         send_image_written_email(order_id, task_id)
 
         order = Orders().get_with_tasks(order_id)
-        # all write tasks are marked as written
-        if not [1 for wt in order["tasks"]["write"] if wt["status"] != Tasks.written]:
-            Orders().update_status(order_id, Orders.pending_shipment)
-
+        # all write tasks are marked as written (only one request moves order)
+        if not [
+            1 for wt in order["tasks"]["write"] if wt["status"] != Tasks.written
+        ] and Orders().update_status(order_id, Orders.pending_shipment):
+            forget_order_context(order_id)  # status changed since last email
             send_order_pending_shipment_email(order_id)
 
             # find matching download task and mark it for file removal
@@ -217,7 +311,7 @@ def update_status(task_id: ObjectId, task_type: str, user: dict):
     elif status in Tasks.FAILED_STATUSES:
         send_order_failed_email(order_id)
 
-    return jsonify({"_id": task_id})
+    return jsonify({"_id": task_id, "updated": True})
 
 
 @blueprint.route("/<string:task_type>/<string:task_id>/logs", methods=["POST"])
@@ -230,17 +324,24 @@ def add_log(task_id: ObjectId, task_type: str, user: dict):
     if task is None:
         raise errors.NotFound()
 
-    request_json = request.get_json()
-
-    task_cls.update_logs(
-        task_id,
-        worker_log=request_json.get("worker_log"),
-        installer_log=request_json.get("installer_log"),
-        uploader_log=request_json.get("uploader_log"),
-        downloader_log=request_json.get("downloader_log"),
-        wipe_log=request_json.get("wipe_log"),
-        writer_log=request_json.get("writer_log"),
-    )
+    # each `<kind>_log` is either the full log (str) or a part of it:
+    # {"offset": <position of data in log>, "data": <str>}
+    request_json = request.get_json() or {}
+    sizes = {}
+    for kind in TaskLogs.KINDS:
+        log = request_json.get("{}_log".format(kind))
+        if log is None:
+            continue
+        try:
+            if isinstance(log, dict):
+                offset = int(log["offset"])
+                if offset < 0:
+                    raise errors.BadRequest("offset must be positive")
+                sizes[kind] = TaskLogs.append(task_id, kind, str(log["data"]), offset)
+            else:
+                sizes[kind] = TaskLogs.replace(task_id, kind, str(log))
+        except (KeyError, TypeError, ValueError) as exc:
+            raise errors.BadRequest(str(exc))
 
     # update ACK
     Acknowlegments.busy_update(
@@ -250,4 +351,25 @@ def add_log(task_id: ObjectId, task_type: str, user: dict):
         task_id=task_id,
     )
 
-    return jsonify({"_id": task_id})
+    return jsonify({"_id": task_id, "sizes": sizes})
+
+
+@blueprint.route(
+    "/<string:task_type>/<string:task_id>/logs/<string:kind>", methods=["GET"]
+)
+@authenticate
+@only_for_roles(roles=Users.ROLES)
+@bson_object_id(["task_id"])
+def get_log(task_id: ObjectId, task_type: str, kind: str, user: dict):
+    """ range of a task log: ?offset=<int>&limit=<int> (all by default) """
+    if kind not in TaskLogs.KINDS:
+        raise errors.NotFound("Incorrect log kind")
+    offset = request.args.get("offset", default=0, type=int)
+    limit = request.args.get("limit", default=None, type=int)
+    if offset < 0 or (limit is not None and limit < 0):
+        raise errors.BadRequest("offset and limit must be positive")
+
+    size, data = tasks_cls_for(task_type).read_log(task_id, kind, offset, limit)
+    return jsonify(
+        {"_id": task_id, "kind": kind, "offset": offset, "size": size, "data": data}
+    )
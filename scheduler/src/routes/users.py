@@ -1,4 +1,3 @@
-import pymongo
 from bson import ObjectId
 from flask import Blueprint, request, jsonify, Response
 from jsonschema import validate, ValidationError
@@ -11,6 +10,7 @@ from . import (
     errors,
     ensure_user_matches_role,
     only_for_roles,
+    get_page,
 )
 
 
@@ -28,27 +28,14 @@ def collection(user: dict):
         # check user permission
         ensure_user_matches_role(user, Users.MANAGER_ROLE)
 
-        # unpack url parameters
-        skip = request.args.get("skip", default=0, type=int)
-        limit = request.args.get("limit", default=20, type=int)
-        skip = 0 if skip < 0 else skip
-        limit = 20 if limit <= 0 else limit
-
         # get users from database
-        query = {}
-        projection = {"password_hash": 0}
-        cursor = (
-            Users()
-            .find(query, projection)
-            .sort([("$natural", pymongo.ASCENDING)])
-            .skip(skip)
-            .limit(limit)
-        )
-        count = Users().count_documents(query)
-        users = [user for user in cursor]
-
         return jsonify(
-            {"meta": {"skip": skip, "limit": limit, "count": count}, "items": users}
+            get_page(
+                Users(),
+                query={},
+                projection={"password_hash": 0},
+                filters=["role", "channel"],
+            )
         )
     elif request.method == "POST":
         # check user permission
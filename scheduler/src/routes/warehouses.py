@@ -1,4 +1,3 @@
-import pymongo
 from bson import ObjectId
 from flask import Blueprint, request, jsonify, Response
 from jsonschema import validate, ValidationError
@@ -10,6 +9,7 @@ from . import (
     errors,
     ensure_user_matches_role,
     only_for_roles,
+    get_page,
 )
 
 
@@ -27,30 +27,7 @@ def collection(user: dict):
         # check user permission
         ensure_user_matches_role(user, Users.MANAGER_ROLE)
 
-        # unpack url parameters
-        skip = request.args.get("skip", default=0, type=int)
-        limit = request.args.get("limit", default=20, type=int)
-        skip = 0 if skip < 0 else skip
-        limit = 20 if limit <= 0 else limit
-
-        query = {}
-        projection = None
-        cursor = (
-            Warehouses()
-            .find(query, projection)
-            .sort([("$natural", pymongo.ASCENDING)])
-            .skip(skip)
-            .limit(limit)
-        )
-        count = Warehouses().count_documents(query)
-        warehouses = [warehouse for warehouse in cursor]
-
-        return jsonify(
-            {
-                "meta": {"skip": skip, "limit": limit, "count": count},
-                "items": warehouses,
-            }
-        )
+        return jsonify(get_page(Warehouses(), query={}))
     elif request.method == "POST":
         # check user permission
         ensure_user_matches_role(user, Users.MANAGER_ROLE)
@@ -1,10 +1,9 @@
-import pymongo
 from flask import Blueprint, request, jsonify
 from jsonschema import ValidationError
 
 from . import errors
 from utils.mongo import Users, Acknowlegments
-from . import authenticate, only_for_roles
+from . import authenticate, only_for_roles, get_page
 from emailing import send_worker_sos_email
 
 
@@ -15,26 +14,10 @@ blueprint = Blueprint("worker", __name__, url_prefix="/workers")
 @authenticate
 @only_for_roles(roles=Users.MANAGER_ROLE)
 def collection(user: dict):
-
-    skip = request.args.get("skip", default=0, type=int)
-    limit = request.args.get("limit", default=20, type=int)
-    skip = 0 if skip < 0 else skip
-    limit = 20 if limit <= 0 else limit
-
-    query = {}
-    projection = None
-    cursor = (
-        Acknowlegments()
-        .find(query, projection)
-        .sort([("$natural", pymongo.ASCENDING)])
-        .skip(skip)
-        .limit(limit)
-    )
-    count = Acknowlegments().count_documents(query)
-    workers = [worker for worker in cursor]
-
     return jsonify(
-        {"meta": {"skip": skip, "limit": limit, "count": count}, "items": workers}
+        get_page(
+            Acknowlegments(), query={}, filters=["username", "worker_type", "status"],
+        )
     )
 
 
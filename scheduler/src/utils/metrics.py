@@ -0,0 +1,121 @@
+""" prometheus metrics of the API, mongo and email-sender processes
+
+    with prometheus_multiproc_dir set (see Dockerfile), values of all
+    processes (uwsgi workers, email-sender) are stored there and aggregated
+    by the /metrics endpoint. Only labelled metrics are defined so values
+    are always created in the process using them (after uwsgi forks).
+    Exiting processes mark themselves dead so their live gauges are dropped. """
+
+import os
+import time
+import atexit
+
+from flask import g, request
+from pymongo import monitoring
+from prometheus_client import (
+    Counter,
+    Histogram,
+    CollectorRegistry,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MONGO_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+http_request_duration = Histogram(
+    "cardshop_http_request_duration_seconds",
+    "API requests duration",
+    ["blueprint", "route", "method"],
+    buckets=LATENCY_BUCKETS,
+)
+http_requests = Counter(
+    "cardshop_http_requests_total",
+    "API requests by response status code",
+    ["blueprint", "route", "method", "status"],
+)
+mongo_command_duration = Histogram(
+    "cardshop_mongo_command_duration_seconds",
+    "mongo commands duration",
+    ["command"],
+    buckets=MONGO_BUCKETS,
+)
+mongo_command_failures = Counter(
+    "cardshop_mongo_command_failures_total", "failed mongo commands", ["command"]
+)
+email_send_duration = Histogram(
+    "cardshop_email_send_duration_seconds",
+    "time to hand an email over to SMTP/mailgun",
+    ["result"],
+    buckets=LATENCY_BUCKETS,
+)
+email_queue_latency = Histogram(
+    "cardshop_email_queue_latency_seconds",
+    "time emails spent in outbox before being sent",
+    ["transport"],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 14400),
+)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """ count and time mongo commands of the current process """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_command_duration.labels(event.command_name).observe(
+            event.duration_micros / 1e6
+        )
+
+    def failed(self, event):
+        mongo_command_duration.labels(event.command_name).observe(
+            event.duration_micros / 1e6
+        )
+        mongo_command_failures.labels(event.command_name).inc()
+
+
+def mark_process_dead():
+    """ drop this process' live gauges, its counters are still aggregated """
+    if os.getenv("prometheus_multiproc_dir"):
+        multiprocess.mark_process_dead(os.getpid())
+
+
+# registered before uwsgi forks: called with the pid of each exiting worker
+atexit.register(mark_process_dead)
+
+
+def start_request_timer():
+    g.metrics_started_on = time.perf_counter()
+
+
+def record_request(response):
+    started_on = g.pop("metrics_started_on", None)
+    if started_on is None:
+        return response
+    # route pattern (not path) so IDs don't create new series
+    labels = (
+        request.blueprint or "",
+        request.url_rule.rule if request.url_rule else "unmatched",
+        request.method,
+    )
+    http_request_duration.labels(*labels).observe(time.perf_counter() - started_on)
+    http_requests.labels(*labels, str(response.status_code)).inc()
+    return response
+
+
+def init_app(app):
+    """ time and count all requests of app """
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+
+
+def render(*registries):
+    """ exposition of metrics (of all processes) and of extra registries """
+    if os.getenv("prometheus_multiproc_dir"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return b"".join(generate_latest(reg) for reg in (registry,) + registries)
@@ -1,22 +1,240 @@
 import os
+import json
+import zlib
+import time
+import hashlib
+import secrets
+import logging
 import datetime
-
-from bson import ObjectId
-from pymongo import MongoClient
+import threading
+
+from bson import ObjectId, Binary
+from pymongo import (
+    MongoClient,
+    IndexModel,
+    ReturnDocument,
+    UpdateOne,
+    ASCENDING,
+    DESCENDING,
+    monitoring,
+)
+from pymongo.errors import OperationFailure, DuplicateKeyError, BulkWriteError
 from pymongo.database import Database as BaseDatabase
 from pymongo.collection import Collection as BaseCollection
 
+from utils.notifications import Hub
+from utils.metrics import MongoCommandMetrics
+from utils.queries import QueryTrackingListener
+
 from utils.json import ensure_objectid
 
+logger = logging.getLogger(__name__)
+
+
+class PoolCounters(monitoring.ConnectionPoolListener):
+    """ connection pool utilisation counters for the current process """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {
+            "created": 0,
+            "closed": 0,
+            "checked_out": 0,
+            "checked_in": 0,
+            "checkout_failed": 0,
+            "pools_cleared": 0,
+            "in_use": 0,
+            "max_in_use": 0,
+        }
+
+    def incr(self, key, value=1):
+        with self.lock:
+            self.counters[key] += value
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats.update({"pid": os.getpid(), "open": stats["created"] - stats["closed"]})
+        return stats
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.incr("pools_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.incr("created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.incr("closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.incr("checkout_failed")
+
+    def connection_checked_out(self, event):
+        with self.lock:
+            self.counters["checked_out"] += 1
+            self.counters["in_use"] += 1
+            self.counters["max_in_use"] = max(
+                self.counters["max_in_use"], self.counters["in_use"]
+            )
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.counters["checked_in"] += 1
+            self.counters["in_use"] -= 1
+
+
+pool_counters = PoolCounters()
+
 
 class Client(MongoClient):
     def __init__(self):
-        super().__init__(host=os.getenv("MONGODB_URI", "mongo"))
+        # connect=False defers server discovery to first use so that a client
+        # created before uwsgi forks is never shared with the children
+        super().__init__(
+            host=os.getenv("MONGODB_URI", "mongo"),
+            maxPoolSize=int(os.getenv("MONGODB_POOL_SIZE", 100)),
+            connect=False,
+            event_listeners=[
+                pool_counters,
+                MongoCommandMetrics(),
+                QueryTrackingListener(),
+            ],
+        )
 
 
 class Database(BaseDatabase):
-    def __init__(self):
-        super().__init__(Client(), "Cardshop")
+    def __init__(self, client=None):
+        super().__init__(
+            client or get_client(), os.getenv("MONGODB_DBNAME", "Cardshop")
+        )
+
+
+class Registry:
+    """ process-wide Client and Database, lazily (re)created in each process
+
+        All collection classes share a single connection pool per process.
+        Forked children (uwsgi workers) get a fresh one on first use. """
+
+    lock = threading.Lock()
+    pid = None
+    client = None
+    database = None
+
+    @classmethod
+    def get(cls):
+        if cls.pid != os.getpid():
+            with cls.lock:
+                if cls.pid != os.getpid():
+                    cls.client = Client()
+                    cls.database = Database(cls.client)
+                    cls.pid = os.getpid()
+        return cls.database
+
+    @classmethod
+    def reset(cls):
+        """ forget parent's client (called in child process after fork) """
+        cls.lock = threading.Lock()
+        cls.pid = cls.client = cls.database = None
+        pool_counters.lock = threading.Lock()
+        pool_counters.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=Registry.reset)
+
+
+def get_database():
+    """ shared Database for the current process """
+    return Registry.get()
+
+
+def get_client():
+    """ shared MongoClient for the current process """
+    return get_database().client
+
+
+def pool_stats():
+    """ connection pool utilisation counters for the current process """
+    stats = pool_counters.stats()
+    stats.update({"max_pool_size": get_client().max_pool_size})
+    return stats
+
+
+def transition(
+    collection_cls, document_id, status, payload=None, extra_update=None, deadline=None
+):
+    """ single conditional update of a document's status (see TRANSITIONS)
+
+        only applies if current status is an allowed source for status.
+        same-status or disallowed transitions are no-op and return False """
+    sources = [
+        source
+        for source in collection_cls.TRANSITIONS.get(status, [])
+        if source != status
+    ]
+    if not sources:
+        logger.warning(
+            "{} can't be moved to unknown status `{}`".format(
+                collection_cls.__name__, status
+            )
+        )
+        return False
+
+    collection = collection_cls()
+    result = collection.update_one(
+        {"_id": ensure_objectid(document_id), "status": {"$in": sources}},
+        status_update(
+            status, payload=payload, extra_update=extra_update, deadline=deadline
+        ),
+    )
+    if result.modified_count != 1:
+        return False
+
+    keys = [Hub.key(collection.name, document_id)]
+    if status == Tasks.pending:
+        keys.append(Hub.key(collection.name))
+    Hub.notify(*keys)
+    return True
+
+
+def status_update(status, payload=None, extra_update=None, deadline=None):
+    """ update document appending status to its statuses history
+
+        deadline is the datetime the document must have left status by.
+        it is removed otherwise, so only timed documents are in its index """
+    update = {
+        "$set": {"status": status},
+        "$push": {
+            "statuses": {
+                "status": status,
+                "on": datetime.datetime.now(),
+                "payload": payload,
+            }
+        },
+    }
+    for key, value in (extra_update or {}).items():
+        if key not in ("status", "statuses", "deadline"):
+            update["$set"][key] = value
+    if deadline is None:
+        update["$unset"] = {"deadline": ""}
+    else:
+        update["$set"]["deadline"] = deadline
+    return update
 
 
 class Users(BaseCollection):
@@ -43,8 +261,13 @@ class Users(BaseCollection):
         "role": {"type": "string", "required": True},
     }
 
+    indexes = [
+        IndexModel([("username", ASCENDING)], name="username", unique=True),
+        IndexModel([("email", ASCENDING)], name="email", unique=True),
+    ]
+
     def __init__(self):
-        super().__init__(Database(), "users")
+        super().__init__(get_database(), "users")
 
     @classmethod
     def by_username(cls, username):
@@ -56,11 +279,96 @@ class Users(BaseCollection):
 
 
 class RefreshTokens(BaseCollection):
+    indexes = [
+        IndexModel([("token", ASCENDING)], name="token", unique=True),
+        IndexModel(
+            [("expire_time", ASCENDING)], name="expire_ttl", expireAfterSeconds=0
+        ),
+    ]
+
+    def __init__(self):
+        super().__init__(get_database(), "refresh_tokens")
+
+
+class SigningKeys(BaseCollection):
+    """ secrets of access tokens signing keys, shared by scheduler processes
+
+        only used when no JWT_SECRET is set (keys are derived from it
+        otherwise). Expired keys are removed by the TTL index. """
+
+    indexes = [
+        IndexModel([("expire_on", ASCENDING)], name="expire_ttl", expireAfterSeconds=0)
+    ]
+
+    def __init__(self):
+        super().__init__(get_database(), "signing_keys")
+
+    @classmethod
+    def get_secret(cls, kid, expire_on):
+        """ secret of key kid, created if it does not exist yet """
+        update = {
+            "$setOnInsert": {
+                "secret": secrets.token_hex(32),
+                "created_on": datetime.datetime.now(),
+                "expire_on": expire_on,
+            }
+        }
+        try:
+            key = cls().find_one_and_update(
+                {"_id": kid}, update, upsert=True, return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:  # concurrent creation by another process
+            key = cls().find_one({"_id": kid})
+        return key["secret"]
+
+
+class ChangeMarkers(BaseCollection):
+    """ last change of notification keys (see Hub), shared by all processes
+
+        a marker is a new ObjectId on each change: waiters only compare it.
+        Markers of keys not changed for a day are removed (TTL) """
+
+    indexes = [IndexModel([("on", ASCENDING)], name="on_ttl", expireAfterSeconds=86400)]
+
     def __init__(self):
-        super().__init__(Database(), "refresh_tokens")
+        super().__init__(get_database(), "change_markers")
+
+    @classmethod
+    def bump(cls, keys):
+        """ mark keys as changed. returns {key: new marker} """
+        now = datetime.datetime.now()
+        markers = {key: ObjectId() for key in keys}
+        if markers:
+            cls().bulk_write(
+                [
+                    UpdateOne(
+                        {"_id": key},
+                        {"$set": {"marker": marker, "on": now}},
+                        upsert=True,
+                    )
+                    for key, marker in markers.items()
+                ],
+                ordered=False,
+            )
+        return markers
+
+    @classmethod
+    def get(cls, keys):
+        """ {key: marker} of keys (None for keys never changed) """
+        markers = dict.fromkeys(keys)
+        for document in cls().find({"_id": {"$in": list(keys)}}, {"marker": 1}):
+            markers[document["_id"]] = document["marker"]
+        return markers
 
 
 class Acknowlegments(BaseCollection):
+    """ last heartbeat (status) of each worker slot
+
+        heartbeats not changing a slot's status are buffered in-process and
+        their date written in bulk every persist_interval seconds. A process
+        re-reads (and rewrites) a slot's status at most that often, so a
+        status change recorded by another process may be masked for as long.
+        Slots silent for stale_after seconds are removed (TTL) """
 
     idle = "idle"
     busy = "busy"
@@ -68,8 +376,31 @@ class Acknowlegments(BaseCollection):
     error = "error"
     no_slot = "no_slot"
 
+    persist_interval = int(os.getenv("ACK_PERSIST_INTERVAL", 60))
+    stale_after = int(os.getenv("ACK_STALE_AFTER", 30 * 86400))
+
+    indexes = [
+        IndexModel(
+            [("username", ASCENDING), ("worker_type", ASCENDING), ("slot", ASCENDING)],
+            name="worker_slot",
+            unique=True,
+        ),
+        IndexModel(
+            [("on", ASCENDING)], name="stale_ttl", expireAfterSeconds=stale_after
+        ),
+    ]
+
+    # write-behind buffer. (username, worker_type, slot): last heartbeat
+    buffer_lock = threading.Lock()
+    buffer = {}
+    flusher = None
+
     def __init__(self):
-        super().__init__(Database(), "acknowlegments")
+        super().__init__(get_database(), "acknowlegments")
+
+    @staticmethod
+    def key(username, worker_type, slot):
+        return {"username": username, "worker_type": worker_type, "slot": slot}
 
     schema = {
         "username": {"type": "string", "regex": "^[a-zA-Z0-9_.+-]+$", "required": True},
@@ -82,18 +413,91 @@ class Acknowlegments(BaseCollection):
 
     @classmethod
     def update(
-        cls, username, worker_type, slot, status, payload=None, extra={}, on=None
+        cls, username, worker_type, slot, status, payload=None, extra=None, on=None
     ):
-        # retrieve previsous status
-        mfilter = {"username": username, "worker_type": worker_type, "slot": slot}
-        existing = cls().find_one(mfilter, {"status"})
-        previous_status = existing["status"] if existing else None
-        # update ack
-        extra.update(
-            {"status": status, "on": datetime.datetime.now(), "payload": payload}
-        )
-        res = cls().update_one(mfilter, {"$set": extra}, upsert=True)
-        return res.upserted_id or existing["_id"], status != previous_status
+        """ record a heartbeat. returns (ack_id, whether status changed) """
+        key = (username, worker_type, slot)
+        on = on or datetime.datetime.now()
+        with cls.buffer_lock:
+            entry = cls.buffer.get(key)
+            if (
+                entry is not None
+                and not extra
+                and (entry["status"], entry["payload"]) == (status, payload)
+                and time.monotonic() - entry["persisted"] < cls.persist_interval
+            ):
+                entry["on"] = on
+                cls.start_flusher()
+                return entry["_id"], False
+
+        # single round-trip upsert returning previous status
+        ack_id = ObjectId()
+        update = {
+            "$set": dict(extra or {}, status=status, on=on, payload=payload),
+            "$setOnInsert": {"_id": ack_id},
+        }
+        try:
+            previous = cls().find_one_and_update(
+                cls.key(username, worker_type, slot),
+                update,
+                projection={"status": 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE,
+            )
+        except DuplicateKeyError:
+            # concurrent first heartbeat of this slot created it
+            del update["$setOnInsert"]
+            previous = cls().find_one_and_update(
+                cls.key(username, worker_type, slot),
+                update,
+                projection={"status": 1},
+                return_document=ReturnDocument.BEFORE,
+            )
+        if previous is not None:
+            ack_id = previous["_id"]
+
+        with cls.buffer_lock:
+            cls.buffer[key] = {
+                "_id": ack_id,
+                "status": status,
+                "payload": payload,
+                "persisted": time.monotonic(),
+                "on": None,  # date of last buffered heartbeat
+            }
+        return ack_id, previous is None or previous["status"] != status
+
+    @classmethod
+    def flush(cls):
+        """ write dates of buffered heartbeats, in bulk """
+        with cls.buffer_lock:
+            updates = [
+                UpdateOne(
+                    {"_id": entry["_id"], "status": entry["status"]},
+                    {"$max": {"on": entry["on"]}},
+                )
+                for entry in cls.buffer.values()
+                if entry["on"] is not None
+            ]
+            for entry in cls.buffer.values():
+                entry["on"] = None
+        if updates:
+            cls().bulk_write(updates, ordered=False)
+
+    @classmethod
+    def start_flusher(cls):
+        """ (re)start flushing thread, once per process """
+
+        def flush_periodically():
+            while True:
+                time.sleep(cls.persist_interval)
+                try:
+                    cls.flush()
+                except Exception as exp:
+                    logger.error("Unable to flush heartbeats: {}".format(exp))
+
+        if cls.flusher is None or not cls.flusher.is_alive():
+            cls.flusher = threading.Thread(target=flush_periodically, daemon=True)
+            cls.flusher.start()
 
     @classmethod
     def idle_update(cls, username, worker_type, slot):
@@ -121,6 +525,59 @@ class Acknowlegments(BaseCollection):
             payload=error,
         )
 
+    @classmethod
+    def fleet_stats(cls, offline_after=300):
+        """ slots of each worker by type and status, in one aggregation
+
+            slots without heartbeat for offline_after seconds count as offline """
+        offline_since = datetime.datetime.now() - datetime.timedelta(
+            seconds=offline_after + cls.persist_interval
+        )
+        groups = cls().aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": {
+                            "username": "$username",
+                            "worker_type": "$worker_type",
+                            "status": "$status",
+                        },
+                        "slots": {"$sum": 1},
+                        "offline": {
+                            "$sum": {"$cond": [{"$lt": ["$on", offline_since]}, 1, 0]}
+                        },
+                        "last_seen": {"$max": "$on"},
+                    }
+                }
+            ]
+        )
+        workers = {}
+        totals = {"slots": 0, "offline": 0, "statuses": {}}
+        for group in groups:
+            username, worker_type, status = (
+                group["_id"].get("username"),
+                group["_id"].get("worker_type"),
+                group["_id"].get("status"),
+            )
+            worker = workers.setdefault(
+                username, {"username": username, "slots": 0, "offline": 0, "types": {}},
+            )
+            worker["slots"] += group["slots"]
+            worker["offline"] += group["offline"]
+            worker["last_seen"] = max(
+                worker.get("last_seen") or group["last_seen"], group["last_seen"]
+            )
+            worker["types"].setdefault(worker_type, {})[status] = group["slots"]
+            totals["slots"] += group["slots"]
+            totals["offline"] += group["offline"]
+            totals["statuses"][status] = (
+                totals["statuses"].get(status, 0) + group["slots"]
+            )
+        return {
+            "workers": sorted(workers.values(), key=lambda w: str(w["username"])),
+            "totals": totals,
+        }
+
     @classmethod
     def get(cls, aid):
         ack = cls().find_one({"_id": aid})
@@ -143,8 +600,18 @@ class Channels(BaseCollection):
         },
     }
 
+    indexes = [
+        IndexModel([("slug", ASCENDING)], name="slug", unique=True),
+        IndexModel([("private", ASCENDING)], name="private"),
+    ]
+
+    # private slugs are read on every task claim and listing
+    private_slugs_ttl = 30  # seconds
+    private_slugs_lock = threading.Lock()
+    private_slugs_cache = None  # (expires on, slugs)
+
     def __init__(self):
-        super().__init__(Database(), "channels")
+        super().__init__(get_database(), "channels")
 
     @classmethod
     def get(cls, slug):
@@ -153,6 +620,29 @@ class Channels(BaseCollection):
             raise ValueError("Unable to retrieve channel with slug `{}`".format(slug))
         return channel
 
+    @classmethod
+    def private_slugs(cls):
+        """ slugs of private channels, cached in-process for private_slugs_ttl """
+        now = time.monotonic()
+        with cls.private_slugs_lock:
+            entry = cls.private_slugs_cache
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        slugs = [
+            channel["slug"]
+            for channel in cls().find({"private": True}, {"slug": 1, "_id": 0})
+        ]
+        with cls.private_slugs_lock:
+            cls.private_slugs_cache = (now + cls.private_slugs_ttl, slugs)
+        return slugs
+
+    @classmethod
+    def clear_private_slugs(cls):
+        """ channels changed in this process: read private slugs again """
+        with cls.private_slugs_lock:
+            cls.private_slugs_cache = None
+
 
 class Warehouses(BaseCollection):
     schema = {
@@ -162,8 +652,10 @@ class Warehouses(BaseCollection):
         "active": {"type": "boolean", "default": True, "required": True},
     }
 
+    indexes = [IndexModel([("slug", ASCENDING)], name="slug", unique=True)]
+
     def __init__(self):
-        super().__init__(Database(), "warehouses")
+        super().__init__(get_database(), "warehouses")
 
 
 class Orders(BaseCollection):
@@ -200,6 +692,31 @@ class Orders(BaseCollection):
     FAILED_STATUSES = [creation_failed, download_failed, write_failed, canceled, failed]
     SUCCESS_STATUSES = [shipped, expired]
 
+    FINAL_STATUSES = [shipped, expired, canceled, failed]
+    ACTIVE_STATUSES = [
+        created,
+        pending_creator,
+        creating,
+        creation_failed,
+        pending_writer,
+        downloading,
+        download_failed,
+        downloaded,
+        writing,
+        write_failed,
+        written,
+        pending_shipment,
+        pending_expiry,
+    ]
+
+    # allowed source statuses for each target status
+    TRANSITIONS = dict.fromkeys(ACTIVE_STATUSES + FINAL_STATUSES, ACTIVE_STATUSES)
+    TRANSITIONS[expired] = [pending_expiry]
+
+    # retries of image removal of expired orders (see postpone_expiration)
+    expiration_retry_delay = datetime.timedelta(minutes=10)
+    expiration_max_retry_delay = datetime.timedelta(days=1)
+
     schema = {
         "config": {"type": "dict", "required": True},
         "sd_card": {
@@ -249,8 +766,15 @@ class Orders(BaseCollection):
         "tasks": {"type": "dict", "required": False},
     }
 
+    indexes = [
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)], name="status"),
+        IndexModel([("channel", ASCENDING), ("_id", ASCENDING)], name="channel"),
+        # only set while pending_expiry
+        IndexModel([("deadline", ASCENDING)], name="deadline", sparse=True),
+    ]
+
     def __init__(self):
-        super().__init__(Database(), "orders")
+        super().__init__(get_database(), "orders")
 
     @classmethod
     def get(cls, order_id, with_logs=False):
@@ -266,40 +790,127 @@ class Orders(BaseCollection):
 
     @classmethod
     def get_tasks(cls, order_id, with_logs=False):
-        order = cls().get(order_id, {"tasks": 1})
-        return {
-            "create": CreatorTasks().get(
-                order["tasks"].get("create"), with_logs=with_logs
-            ),
-            "download": DownloaderTasks().get(
-                order["tasks"].get("download"), with_logs=with_logs
-            ),
-            "write": [
-                WriterTasks().get(task, with_logs=with_logs)
-                for task in order["tasks"].get("write", [])
-            ],
-        }
+        tasks = cls.get_with_tasks(order_id, with_logs=with_logs)["tasks"]
+        return {key: tasks[key] for key in ("create", "download", "write")}
+
+    @classmethod
+    def with_tasks_pipeline(cls, match, with_logs=False):
+        """ aggregation pipeline joining orders in match with their tasks """
+        pipeline = [{"$match": match}]
+        for key, collection in (
+            ("create", "creator_tasks"),
+            ("download", "downloader_tasks"),
+            ("write", "writer_tasks"),
+        ):
+            pipeline.append(
+                {
+                    "$lookup": {
+                        "from": collection,
+                        "localField": "tasks.{}".format(key),
+                        "foreignField": "_id",
+                        "as": "_{}_tasks".format(key),
+                    }
+                }
+            )
+        if not with_logs:
+            pipeline.append(
+                {
+                    "$project": {
+                        "logs": 0,
+                        "_create_tasks.logs": 0,
+                        "_download_tasks.logs": 0,
+                        "_write_tasks.logs": 0,
+                    }
+                }
+            )
+        return pipeline
+
+    @staticmethod
+    def attach_tasks(order):
+        """ move joined tasks from pipeline output into order[tasks] """
+        create = order.pop("_create_tasks")
+        download = order.pop("_download_tasks")
+        write = {task["_id"]: task for task in order.pop("_write_tasks")}
+        order.setdefault("tasks", {})
+        order["tasks"].update(
+            {
+                "create": create[0] if create else None,
+                "download": download[0] if download else None,
+                "write": [
+                    write[task_id]
+                    for task_id in order["tasks"].get("write", [])
+                    if task_id in write
+                ],
+            }
+        )
+        return order
 
     @classmethod
     def get_with_tasks(cls, order_id, with_logs=False):
-        order = cls().get(order_id, with_logs=with_logs)
+        pipeline = cls.with_tasks_pipeline(
+            {"_id": ensure_objectid(order_id)}, with_logs=with_logs
+        )
+        order = next(cls().aggregate(pipeline), None)
         if order is None:
-            return order
-        order["tasks"].update(cls().get_tasks(order_id, with_logs=with_logs))
+            raise ValueError(
+                "Unable to find/retrieve object with ID {}".format(order_id)
+            )
+        order = cls.attach_tasks(order)
+        if with_logs:
+            tasks = [order["tasks"]["create"], order["tasks"]["download"]]
+            TaskLogs.attach_logs(
+                [task for task in tasks if task] + order["tasks"]["write"]
+            )
         return order
 
+    @classmethod
+    def get_many_with_tasks(cls, order_ids):
+        """ orders (with tasks) of order_ids, in a single aggregation """
+        pipeline = cls.with_tasks_pipeline(
+            {"_id": {"$in": [ensure_objectid(order_id) for order_id in order_ids]}}
+        )
+        return [cls.attach_tasks(order) for order in cls().aggregate(pipeline)]
+
     @classmethod
     def update(cls, order_id, update_set):
         cls().update_one({"_id": ObjectId(order_id)}, {"$set": update_set})
 
     @classmethod
-    def create_creator_task(cls, order_id):
-        order = cls.get(order_id)
-        if order is None:
-            raise ValueError("Order #{} not exists. can't create task".format(order_id))
+    def prepare(cls, document):
+        """ new order document, in created status, from a validated request """
+        return dict(
+            document,
+            status=cls.created,
+            tasks={},
+            statuses=[
+                {"status": cls.created, "on": datetime.datetime.now(), "payload": None}
+            ],
+        )
 
-        payload = {
-            "order": order_id,
+    @classmethod
+    def create_many(cls, documents):
+        """ insert prepared orders in bulk
+
+            returns a (order_id, error) tuple for each document, in order """
+        if not documents:
+            return []
+        failures = {}
+        try:
+            cls().insert_many(documents, ordered=False)
+        except BulkWriteError as exp:
+            failures = {
+                error["index"]: error["errmsg"] for error in exp.details["writeErrors"]
+            }
+        # insert_many sets the _id of each document (including failed ones)
+        return [
+            (None, failures[index]) if index in failures else (document["_id"], None)
+            for index, document in enumerate(documents)
+        ]
+
+    @staticmethod
+    def creator_task_payload(order):
+        return {
+            "order": order["_id"],
             "media_type": order["sd_card"]["type"],
             "channel": order["channel"],
             "upload_uri": order["warehouse"]["upload_uri"],
@@ -312,14 +923,36 @@ class Orders(BaseCollection):
                 {"status": CreatorTasks.pending, "on": datetime.datetime.now()}
             ],
         }
-        task_id = CreatorTasks().insert_one(payload).inserted_id
 
-        # add task_id to order
-        cls().update_one(
-            {"_id": ObjectId(order_id)}, {"$set": {"tasks.create": task_id}}
+    @classmethod
+    def create_creator_task(cls, order_id):
+        order = cls.get(order_id)
+        if order is None:
+            raise ValueError("Order #{} not exists. can't create task".format(order_id))
+        return cls.create_creator_tasks([order])[0]
+
+    @classmethod
+    def create_creator_tasks(cls, orders):
+        """ creator tasks of (inserted) orders, in bulk. returns their IDs """
+        if not orders:
+            return []
+        task_ids = (
+            CreatorTasks()
+            .insert_many([cls.creator_task_payload(order) for order in orders])
+            .inserted_ids
         )
+        Hub.notify(Hub.key(CreatorTasks().name))
 
-        return task_id
+        # add task_id to orders
+        cls().bulk_write(
+            [
+                UpdateOne({"_id": order["_id"]}, {"$set": {"tasks.create": task_id}})
+                for order, task_id in zip(orders, task_ids)
+            ],
+            ordered=False,
+        )
+
+        return task_ids
 
     @classmethod
     def cancel(cls, order_id):
@@ -354,6 +987,7 @@ class Orders(BaseCollection):
             ],
         }
         task_id = DownloaderTasks().insert_one(payload).inserted_id
+        Hub.notify(Hub.key(DownloaderTasks().name))
 
         # add task_id to order
         cls().update_one(
@@ -368,23 +1002,31 @@ class Orders(BaseCollection):
         if order is None:
             raise ValueError("Order #{} not exists. can't create task".format(order_id))
 
-        payload = {
-            "order": order_id,
-            "channel": order["channel"],
-            "worker": order["tasks"]["download"]["worker"],
-            "image_fname": order["tasks"]["download"]["image_fname"],
-            "image_checksum": order["tasks"]["download"]["image_checksum"],
-            "image_size": order["tasks"]["download"]["image_size"],
-            "logs": {"worker": None, "downloader": None},
-            "status": DownloaderTasks.pending,
-            "statuses": [
-                {"status": DownloaderTasks.pending, "on": datetime.datetime.now()}
-            ],
-        }
-
-        task_ids = []
-        for index in range(0, order["quantity"]):
-            task_ids.append(WriterTasks().insert_one(payload).inserted_id)
+        download = order["tasks"]["download"]
+        now = datetime.datetime.now()
+
+        # one document per card (insert_many sets _id on each)
+        task_ids = (
+            WriterTasks()
+            .insert_many(
+                [
+                    {
+                        "order": order_id,
+                        "channel": order["channel"],
+                        "worker": download["worker"],
+                        "image_fname": download["image_fname"],
+                        "image_checksum": download["image_checksum"],
+                        "image_size": download["image_size"],
+                        "logs": {"worker": None, "wipe": None, "writer": None},
+                        "status": WriterTasks.pending,
+                        "statuses": [{"status": WriterTasks.pending, "on": now}],
+                    }
+                    for _ in range(order["quantity"])
+                ]
+            )
+            .inserted_ids
+        )
+        Hub.notify(Hub.key(WriterTasks().name))
 
         # add task_id to order
         cls().update_one(
@@ -394,18 +1036,13 @@ class Orders(BaseCollection):
         return task_ids
 
     @classmethod
-    def update_status(cls, order_id, status, payload=None, extra_update={}):
-        order = cls.get(order_id)
-        # don't update if still current status
-        if status == order["status"]:
-            return
-        statuses = order["statuses"]
-        statuses.append(
-            {"status": status, "on": datetime.datetime.now(), "payload": payload}
-        )
-        update = {"status": status, "statuses": statuses}
-        update.update(extra_update)
-        cls().update_one({"_id": ObjectId(order_id)}, {"$set": update})
+    def update_status(cls, order_id, status, payload=None, extra_update=None):
+        """ atomically move order to status if allowed from its current one
+
+            returns whether the transition happened """
+        return transition(
+            cls, order_id, status, payload=payload, extra_update=extra_update
+        )
 
     @classmethod
     def add_shipment(cls, order_id, shipment_details):
@@ -414,11 +1051,62 @@ class Orders(BaseCollection):
         cls().update_status(order_id, Orders.shipped)
 
     @classmethod
-    def all_pending_expiry(cls):
-        return [
-            cls().get(res["_id"])
-            for res in cls().find({"status": cls.pending_expiry}, {"_id": 1})
-        ]
+    def set_expiration(cls, order_id, expiration):
+        """ date order's image is removed from warehouse, once pending_expiry """
+        cls().update_one(
+            {"_id": ensure_objectid(order_id), "status": cls.pending_expiry},
+            {"$set": {"sd_card.expiration": expiration, "deadline": expiration}},
+        )
+
+    @classmethod
+    def postpone_expiration(cls, order, now):
+        """ retry expiring order later (exponential backoff) after a failure
+
+            order: as returned by all_expired """
+        attempts = order.get("expiration_attempts", 0) + 1
+        delay = min(
+            cls.expiration_retry_delay * 2 ** (attempts - 1),
+            cls.expiration_max_retry_delay,
+        )
+        cls().update_one(
+            {"_id": order["_id"], "status": cls.pending_expiry},
+            {"$set": {"deadline": now + delay, "expiration_attempts": attempts}},
+        )
+        return now + delay
+
+    @classmethod
+    def expired_query(cls, now):
+        return {"deadline": {"$lt": now}, "status": cls.pending_expiry}
+
+    @classmethod
+    def backfill_deadlines(cls):
+        """ set deadline of pending_expiry orders expiring before deadlines """
+        collection = cls()
+        for order in collection.find(
+            {
+                "status": cls.pending_expiry,
+                "deadline": None,
+                "sd_card.expiration": {"$ne": None},
+            },
+            {"sd_card.expiration": 1},
+        ):
+            collection.update_one(
+                {"_id": order["_id"], "status": cls.pending_expiry},
+                {"$set": {"deadline": order["sd_card"]["expiration"]}},
+            )
+
+    @classmethod
+    def all_expired(cls, now, limit=100):
+        """ pending_expiry orders past their expiration (oldest first) """
+        return list(
+            cls()
+            .find(
+                cls.expired_query(now),
+                {"warehouse": 1, "sd_card": 1, "expiration_attempts": 1},
+            )
+            .sort([("deadline", ASCENDING)])
+            .limit(limit)
+        )
 
     @classmethod
     def anonymize(cls, order_ids):
@@ -518,6 +1206,16 @@ class Tasks(BaseCollection):
     ]
     IN_PROGRESS_STATUSES = [building, uploading, downloading, wiping_sdcard, writing]
 
+    # in-progress tasks time out after a fixed duration or, for transfers,
+    # if slower than min_transfer_rate (bytes/s)
+    TIMEOUTS = {
+        building: datetime.timedelta(hours=12),
+        wiping_sdcard: datetime.timedelta(minutes=30),
+    }
+    TRANSFER_STATUSES = [uploading, downloading, writing]
+    min_transfer_rate = int(os.getenv("MIN_TRANSFER_RATE", 2 ** 19))  # 4Mib/s
+    min_transfer_timeout = datetime.timedelta(minutes=30)
+
     CREATOR_SUCCESS_STATUSES = [uploaded, uploaded_public]
     DOWNLOADER_SUCCESS_STATUSES = [
         downloaded,
@@ -528,119 +1226,393 @@ class Tasks(BaseCollection):
     WRITER_SUCCESS_STATUSES = [written]
     SUCCESS_STATUSES = CREATOR_SUCCESS_STATUSES + WRITER_SUCCESS_STATUSES
 
+    ACTIVE_STATUSES = PENDING_STATUSES + WORKING_STATUSES + [card_inserted]
+
+    # allowed source statuses for each target status
+    TRANSITIONS = {
+        received: [pending],
+        # create
+        building: [received],
+        failed_to_build: [building],
+        built: [building],
+        uploading: [built],
+        failed_to_upload: [uploading],
+        uploaded: [uploading],
+        uploaded_public: [uploading],
+        # download
+        downloading: [received],
+        failed_to_download: [downloading],
+        downloaded: [downloading],
+        pending_end_of_writes: [downloaded],
+        pending_image_removal: [downloaded, pending_end_of_writes],
+        downloaded_failed_to_remove: [pending_end_of_writes, pending_image_removal],
+        downloaded_and_removed: [pending_image_removal],
+        # image removed from warehouse once its order expired
+        expired: [
+            uploaded_public,
+            downloaded,
+            pending_end_of_writes,
+            pending_image_removal,
+            downloaded_failed_to_remove,
+            downloaded_and_removed,
+        ],
+        # write
+        waiting_for_card: [received],
+        failed_to_insert: [waiting_for_card, card_inserted],
+        card_inserted: [waiting_for_card],
+        wiping_sdcard: [card_inserted],
+        failed_to_wipe: [wiping_sdcard],
+        card_wiped: [wiping_sdcard],
+        writing: [card_wiped],
+        failed_to_write: [writing],
+        written: [writing],
+        pending_shipment: [written],
+        failed_to_ship: [pending_shipment],
+        shiped: [pending_shipment, failed_to_ship],
+        # any time before completion
+        failed: ACTIVE_STATUSES,
+        canceled: ACTIVE_STATUSES,
+        timedout: ACTIVE_STATUSES,
+    }
+
+    # order status to set when a task reaches a status
+    CASCADE = {
+        received: Orders.creating,
+        building: Orders.creating,
+        failed_to_build: Orders.creation_failed,
+        built: Orders.creating,
+        uploading: Orders.creating,
+        failed_to_upload: Orders.creation_failed,
+        uploaded: Orders.pending_writer,
+        uploaded_public: Orders.pending_expiry,
+        downloading: Orders.downloading,
+        failed_to_download: Orders.download_failed,
+        downloaded: Orders.writing,
+        waiting_for_card: Orders.writing,
+        card_inserted: Orders.writing,
+        failed_to_insert: Orders.write_failed,
+        wiping_sdcard: Orders.writing,
+        card_wiped: Orders.writing,
+        failed_to_wipe: Orders.write_failed,
+        writing: Orders.writing,
+        failed_to_write: Orders.write_failed,
+        # written: Orders.pending_shipment,
+        # pending_end_of_writes: Orders.writing,
+        # pending_image_removal: Orders.written,
+        # downloaded_and_removed: Orders.written,
+        downloaded_failed_to_remove: Orders.written,
+        failed: Orders.failed,
+        canceled: Orders.canceled,
+        timedout: Orders.failed,
+    }
+
+    # shared by all three task collections
+    indexes = [
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)], name="status"),
+        IndexModel([("order", ASCENDING)], name="order"),
+        IndexModel([("worker", ASCENDING), ("status", ASCENDING)], name="worker"),
+        # only set while in one of IN_PROGRESS_STATUSES
+        IndexModel([("deadline", ASCENDING)], name="deadline", sparse=True),
+    ]
+
+    # fields included when listing tasks (config might hold large blobs)
+    listing_fields = ["_id", "order", "channel", "worker", "status"]
+
     @classmethod
     def get(cls, task_id, with_logs=False):
-        return cls().find_one(
+        task = cls().find_one(
             {"_id": ensure_objectid(task_id)},
             projection={"logs": 0} if not with_logs else None,
         )
+        if task and with_logs:
+            TaskLogs.attach_logs([task])
+        return task
 
     @classmethod
-    def cascade_status(cls, task_id, task_status):
-        task = cls.get(task_id)
-
-        cascade_map = {
-            Tasks.received: Orders.creating,
-            Tasks.building: Orders.creating,
-            Tasks.failed_to_build: Orders.creation_failed,
-            Tasks.built: Orders.creating,
-            Tasks.uploading: Orders.creating,
-            Tasks.failed_to_upload: Orders.creation_failed,
-            Tasks.uploaded: Orders.pending_writer,
-            Tasks.uploaded_public: Orders.pending_expiry,
-            Tasks.downloading: Orders.downloading,
-            Tasks.failed_to_download: Orders.download_failed,
-            Tasks.downloaded: Orders.writing,
-            Tasks.waiting_for_card: Orders.writing,
-            Tasks.card_inserted: Orders.writing,
-            Tasks.failed_to_insert: Orders.write_failed,
-            Tasks.wiping_sdcard: Orders.writing,
-            Tasks.card_wiped: Orders.writing,
-            Tasks.failed_to_wipe: Orders.write_failed,
-            Tasks.writing: Orders.writing,
-            Tasks.failed_to_write: Orders.write_failed,
-            # Tasks.written: Orders.pending_shipment,
-            # Tasks.pending_end_of_writes: Orders.writing,
-            # Tasks.pending_image_removal: Orders.written,
-            # Tasks.downloaded_and_removed: Orders.written,
-            Tasks.downloaded_failed_to_remove: Orders.written,
-            Tasks.failed: Orders.failed,
-            Tasks.canceled: Orders.canceled,
-            Tasks.timedout: Orders.failed,
-        }
-
-        order_status = cascade_map.get(task_status)
+    def cascade_status(cls, task_id, task_status, order_id=None):
+        """ update task's order status according to CASCADE """
+        order_status = cls.CASCADE.get(task_status)
         if not order_status:
-            return
+            return False
 
-        Orders().update_status(order_id=task["order"], status=order_status)
+        if order_id is None:
+            task = cls().find_one({"_id": ensure_objectid(task_id)}, {"order": 1})
+            order_id = task["order"]
+        return Orders.update_status(order_id=order_id, status=order_status)
 
     @classmethod
-    def update_logs(
-        cls,
-        task_id,
-        worker_log=None,
-        installer_log=None,
-        uploader_log=None,
-        downloader_log=None,
-        wipe_log=None,
-        writer_log=None,
-    ):
-        if worker_log is None and installer_log is None:
-            return
-        update = {}
-        if worker_log is not None:
-            update.update({"logs.worker": worker_log})
-        if installer_log is not None:
-            update.update({"logs.installer": installer_log})
-        if uploader_log is not None:
-            update.update({"logs.uploader": uploader_log})
-        if downloader_log is not None:
-            update.update({"logs.downloader": downloader_log})
-        if wipe_log is not None:
-            update.update({"logs.wipe": wipe_log})
-        if writer_log is not None:
-            update.update({"logs.writer": writer_log})
-
-        cls().update_one({"_id": ObjectId(task_id)}, {"$set": update})
-
-    @classmethod
-    def update_status(cls, task_id, status, payload=None, extra_update={}):
-        task = cls.get(task_id)
-        statuses = task["statuses"]
-        statuses.append(
-            {"status": status, "on": datetime.datetime.now(), "payload": payload}
-        )
-        update = {"status": status, "statuses": statuses}
-        update.update(extra_update)
-        cls().update_one({"_id": ObjectId(task_id)}, {"$set": update})
+    def read_log(cls, task_id, kind, offset=0, limit=None):
+        """ (log size, log[offset:offset + limit]) of a task's kind log """
+        size = TaskLogs.size(task_id, kind)
+        if size:
+            return size, TaskLogs.read(task_id, kind, offset, limit)
+
+        # logs stored inside task document before TaskLogs
+        task = cls().find_one({"_id": ensure_objectid(task_id)}, {"logs": 1})
+        content = ((task or {}).get("logs") or {}).get(kind) or ""
+        end = None if limit is None else offset + limit
+        return len(content), content[offset:end]
+
+    @staticmethod
+    def image_size(task):
+        """ size (bytes) of the image uploaded, downloaded or written by task """
+        return task.get("image_size") or (task.get("image") or {}).get("size") or 0
 
     @classmethod
-    def register(cls, task_id, worker):
-        cls.update_status(
-            task_id=task_id,
-            status=cls.received,
-            extra_update={"worker": worker["username"]},
-            payload="assigned worker: {}".format(worker["username"]),
+    def deadline_for(cls, status, task, since):
+        """ datetime task must have left status by. None if status is not timed """
+        if status in cls.TIMEOUTS:
+            return since + cls.TIMEOUTS[status]
+        if status in cls.TRANSFER_STATUSES:
+            duration = datetime.timedelta(
+                seconds=cls.image_size(task) / cls.min_transfer_rate
+            )
+            return since + max(duration, cls.min_transfer_timeout)
+        return None
+
+    @classmethod
+    def update_status(cls, task_id, status, payload=None, extra_update=None):
+        """ atomically move task to status if allowed from its current one
+
+            returns whether the transition happened """
+        deadline = None
+        if status in cls.IN_PROGRESS_STATUSES:
+            task = dict(extra_update or {})
+            # transfers' deadline depends on the image size
+            if status in cls.TRANSFER_STATUSES and not cls.image_size(task):
+                task.update(
+                    cls().find_one(
+                        {"_id": ensure_objectid(task_id)},
+                        {"image_size": 1, "image.size": 1},
+                    )
+                    or {}
+                )
+            deadline = cls.deadline_for(status, task, datetime.datetime.now())
+        return transition(
+            cls,
+            task_id,
+            status,
+            payload=payload,
+            extra_update=extra_update,
+            deadline=deadline,
         )
 
     @classmethod
-    def find_availables(cls, channel):
-        tasks = [
-            cls.get(task.get("_id"))
-            for task in cls().find({"status": cls.pending}, {"_id": 1})
+    def eligibility_query(cls, username, channel):
+        """ filter matching pending tasks a worker is allowed to pick
+
+            tasks preassigned to another worker are excluded and tasks from
+            a private channel only go to workers of that channel """
+        query = {"status": cls.pending, "worker": {"$in": [None, username]}}
+        excluded_channels = [
+            slug for slug in Channels.private_slugs() if slug != channel
         ]
-        return tasks
+        if excluded_channels:
+            query["channel"] = {"$nin": excluded_channels}
+        return query
+
+    @classmethod
+    def received_update(cls, username):
+        return status_update(
+            cls.received,
+            payload="assigned worker: {}".format(username),
+            extra_update={"worker": username},
+        )
+
+    @classmethod
+    def register(cls, task_id, worker):
+        """ assign a specific pending task to worker. False if not pending """
+        collection = cls()
+        result = collection.update_one(
+            {"_id": ensure_objectid(task_id), "status": cls.pending},
+            cls.received_update(worker["username"]),
+        )
+        if result.modified_count != 1:
+            return False
+        Hub.notify(Hub.key(collection.name, task_id))
+        return True
+
+    @classmethod
+    def claim(cls, worker):
+        """ atomically assign the oldest eligible pending task to worker
+
+            returns the assigned task or None if there is none available """
+        collection = cls()
+        task = collection.find_one_and_update(
+            cls.eligibility_query(worker["username"], worker.get("channel")),
+            cls.received_update(worker["username"]),
+            projection={"logs": 0},
+            sort=[("_id", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if task is not None:
+            Hub.notify(Hub.key(collection.name, task["_id"]))
+        return task
+
+    @classmethod
+    def find_availables(cls, username, channel, fields=None, limit=20):
+        """ oldest pending tasks for a worker, with listing fields only
+
+            fields: extra top-level fields to include (ex: config), from the
+            collection's schema. logs are never sent.
+            ValueError on other fields """
+        selectable = (set(cls.schema) | set(cls.listing_fields)) - {"logs"}
+        unknown = sorted(set(fields or []) - selectable)
+        if unknown:
+            raise ValueError("unknown fields: {}".format(", ".join(unknown)))
+        projection = {field: 1 for field in cls.listing_fields + (fields or [])}
+        return list(
+            cls()
+            .find(cls.eligibility_query(username, channel), projection)
+            .sort([("_id", ASCENDING)])
+            .limit(limit)
+        )
 
     @classmethod
-    def all_inprogress(cls):
-        tasks = []
-        for tcls in (CreatorTasks, DownloaderTasks, WriterTasks):
-            xtasks = tcls().find(
-                {"status": {"$in": cls.IN_PROGRESS_STATUSES}}, {"_id": 1}
+    def queue_stats(cls, since):
+        """ number of active tasks per status and of failures since, by $group
+
+            oldest holds the creation date of the oldest task of each status """
+        groups = cls().aggregate(
+            [
+                {
+                    "$match": {
+                        "$or": [
+                            {"status": {"$in": cls.ACTIVE_STATUSES}},
+                            {
+                                "status": {"$in": cls.FAILED_STATUSES},
+                                "statuses.on": {"$gte": since},
+                            },
+                        ]
+                    }
+                },
+                {
+                    "$group": {
+                        "_id": "$status",
+                        "count": {"$sum": 1},
+                        "since": {
+                            "$sum": {
+                                "$cond": [
+                                    {
+                                        "$gte": [
+                                            {"$arrayElemAt": ["$statuses.on", -1]},
+                                            since,
+                                        ]
+                                    },
+                                    1,
+                                    0,
+                                ]
+                            }
+                        },
+                        "oldest": {"$min": "$_id"},
+                    }
+                },
+            ]
+        )
+        stats = {"pending": {}, "in_progress": {}, "failed": {}, "oldest": {}}
+        for group in groups:
+            status = group["_id"]
+            if status in cls.FAILED_STATUSES:
+                if group["since"]:
+                    stats["failed"][status] = group["since"]
+                continue
+            key = "pending" if status in cls.PENDING_STATUSES else "in_progress"
+            stats[key][status] = group["count"]
+            stats["oldest"][status] = group["oldest"].generation_time.replace(
+                tzinfo=None
+            )
+        stats["queued"] = sum(stats["pending"].values())
+        return stats
+
+    @classmethod
+    def expired_query(cls, now):
+        return {"deadline": {"$lt": now}}
+
+    @classmethod
+    def timeout_expired(cls, now, limit=500):
+        """ time out (at most limit) tasks past their deadline, in bulk
+
+            peers of timed out writers are canceled and orders failed.
+            returns (number of expired tasks found, IDs of the orders of timed
+            out tasks): tasks found might have left their status since """
+        collection = cls()
+        statuses = {
+            task["_id"]: task["status"]
+            for task in collection.find(cls.expired_query(now), {"status": 1})
+            .sort([("deadline", ASCENDING)])
+            .limit(limit)
+        }
+        if not statuses:
+            return 0, []
+        ids = list(statuses.keys())
+
+        # deadline is unset on status change: those left their status since
+        run_id = ObjectId()
+        collection.update_many(
+            {"_id": {"$in": ids}, "deadline": {"$lt": now}},
+            status_update(
+                cls.timedout,
+                payload="deadline exceeded",
+                extra_update={"timedout_on": now, "timeout_run": run_id},
+            ),
+        )
+        timedout = list(
+            collection.find({"_id": {"$in": ids}, "timeout_run": run_id}, {"order": 1})
+        )
+        if not timedout:
+            return len(ids), []
+        order_ids = list({task["order"] for task in timedout})
+        notified = [task["_id"] for task in timedout]
+
+        # a timed out writer fails the order: cancel its peers
+        writing_order_ids = list(
+            {
+                task["order"]
+                for task in timedout
+                if statuses[task["_id"]] in (cls.wiping_sdcard, cls.writing)
+            }
+        )
+        if writing_order_ids:
+            peers = {
+                "order": {"$in": writing_order_ids},
+                "_id": {"$nin": ids},
+                "status": {"$in": cls.TRANSITIONS[cls.canceled]},
+            }
+            notified += [task["_id"] for task in collection.find(peers, {"_id": 1})]
+            collection.update_many(
+                peers, status_update(cls.canceled, payload="peer timed out")
+            )
+        Hub.notify(*[Hub.key(collection.name, task_id) for task_id in notified])
+
+        # cascade
+        order_status = cls.CASCADE[cls.timedout]
+        Orders().update_many(
+            {
+                "_id": {"$in": order_ids},
+                "status": {"$in": Orders.TRANSITIONS[order_status]},
+            },
+            status_update(order_status, payload="task timed out"),
+        )
+        return len(ids), order_ids
+
+    @classmethod
+    def backfill_deadlines(cls):
+        """ set deadline of in-progress tasks created before deadlines """
+        collection = cls()
+        for task in collection.find(
+            {"status": {"$in": cls.IN_PROGRESS_STATUSES}, "deadline": None},
+            {"status": 1, "statuses": 1, "image_size": 1, "image.size": 1},
+        ):
+            collection.update_one(
+                {"_id": task["_id"], "status": task["status"]},
+                {
+                    "$set": {
+                        "deadline": cls.deadline_for(
+                            task["status"], task, task["statuses"][-1]["on"]
+                        )
+                    }
+                },
             )
-            tasks += [tcls().get(t["_id"]) for t in xtasks]
-        return tasks
 
     @classmethod
     def cancel(cls, task_id):
@@ -662,8 +1634,10 @@ class CreatorTasks(Tasks):
         "statuses": {"type": "list"},
     }
 
+    listing_fields = Tasks.listing_fields + ["media_type", "size"]
+
     def __init__(self):
-        super().__init__(Database(), "creator_tasks")
+        super().__init__(get_database(), "creator_tasks")
 
 
 class DownloaderTasks(Tasks):
@@ -681,8 +1655,10 @@ class DownloaderTasks(Tasks):
         "statuses": {"type": "list"},
     }
 
+    listing_fields = Tasks.listing_fields + ["image_fname", "image_size"]
+
     def __init__(self):
-        super().__init__(Database(), "downloader_tasks")
+        super().__init__(get_database(), "downloader_tasks")
 
 
 class WriterTasks(Tasks):
@@ -700,5 +1676,405 @@ class WriterTasks(Tasks):
         "statuses": {"type": "list"},
     }
 
+    listing_fields = Tasks.listing_fields + ["image_fname", "image_size"]
+
+    def __init__(self):
+        super().__init__(get_database(), "writer_tasks")
+
+
+class TaskLogs(BaseCollection):
+    """ tasks logs as append-only compressed chunks, outside tasks documents
+
+        a chunk holds log[start:end] of the `kind` log of a task """
+
+    KINDS = ["worker", "installer", "uploader", "downloader", "wipe", "writer"]
+    CHUNK_SIZE = 2 ** 20  # characters
+
+    indexes = [
+        IndexModel(
+            [("task", ASCENDING), ("kind", ASCENDING), ("start", ASCENDING)],
+            name="task_kind_start",
+            unique=True,
+        )
+    ]
+
+    def __init__(self):
+        super().__init__(get_database(), "task_logs")
+
+    @staticmethod
+    def decode(chunk):
+        return zlib.decompress(chunk["data"]).decode("utf-8")
+
+    @classmethod
+    def size(cls, task_id, kind):
+        """ length of the stored log """
+        last = cls().find_one(
+            {"task": ensure_objectid(task_id), "kind": kind},
+            {"end": 1},
+            sort=[("start", DESCENDING)],
+        )
+        return last["end"] if last else 0
+
+    @classmethod
+    def insert_chunks(cls, task_id, kind, data, start):
+        for index in range(0, len(data), cls.CHUNK_SIZE):
+            content = data[index : index + cls.CHUNK_SIZE]
+            cls().insert_one(
+                {
+                    "task": ensure_objectid(task_id),
+                    "kind": kind,
+                    "start": start + index,
+                    "end": start + index + len(content),
+                    "data": Binary(zlib.compress(content.encode("utf-8"))),
+                    "on": datetime.datetime.now(),
+                }
+            )
+        return start + len(data)
+
+    @classmethod
+    def append(cls, task_id, kind, data, offset):
+        """ store data found at offset in the log. returns new log size
+
+            parts already stored are skipped. ValueError if offset is negative
+            or past the end of the stored log (client should resend from size) """
+        if offset < 0:
+            raise ValueError(
+                "`{kind}` log offset {offset} is negative".format(
+                    kind=kind, offset=offset
+                )
+            )
+        size = cls.size(task_id, kind)
+        if offset > size:
+            raise ValueError(
+                "`{kind}` log offset {offset} is past its size ({size})".format(
+                    kind=kind, offset=offset, size=size
+                )
+            )
+        data = data[size - offset :]
+        if not data:
+            return size
+        try:
+            return cls.insert_chunks(task_id, kind, data, size)
+        except DuplicateKeyError:
+            # concurrent upload of the same part
+            return cls.size(task_id, kind)
+
+    @classmethod
+    def replace(cls, task_id, kind, data):
+        """ store data as the whole log (clients sending full logs) """
+        cls().delete_many({"task": ensure_objectid(task_id), "kind": kind})
+        return cls.insert_chunks(task_id, kind, data, 0)
+
+    @classmethod
+    def read(cls, task_id, kind, offset=0, limit=None):
+        """ log[offset:offset + limit] """
+        query = {
+            "task": ensure_objectid(task_id),
+            "kind": kind,
+            "end": {"$gt": offset},
+        }
+        if limit is not None:
+            query["start"] = {"$lt": offset + limit}
+        chunks = list(cls().find(query).sort([("start", ASCENDING)]))
+        if not chunks:
+            return ""
+        content = "".join(cls.decode(chunk) for chunk in chunks)
+        start = offset - chunks[0]["start"]
+        return content[start : None if limit is None else start + limit]
+
+    @classmethod
+    def attach_logs(cls, tasks):
+        """ set logs of tasks from stored chunks, in a single query """
+        logs = {task["_id"]: {} for task in tasks}
+        for chunk in cls().find(
+            {"task": {"$in": list(logs.keys())}},
+            sort=[("task", ASCENDING), ("kind", ASCENDING), ("start", ASCENDING)],
+        ):
+            kind_logs = logs[chunk["task"]]
+            kind_logs[chunk["kind"]] = kind_logs.get(chunk["kind"], "") + cls.decode(
+                chunk
+            )
+        for task in tasks:
+            task["logs"] = dict(task.get("logs") or {}, **logs[task["_id"]])
+        return tasks
+
+
+class EmailOutbox(BaseCollection):
+    """ emails queued by requests, delivered by email-sender.py
+
+        identical messages still pending are only queued once """
+
+    pending = "pending"
+    sent = "sent"
+    failed = "failed"
+
+    max_attempts = int(os.getenv("EMAIL_MAX_ATTEMPTS", 8))
+    retry_delay = int(os.getenv("EMAIL_RETRY_DELAY", 30))  # doubles each attempt
+    max_retry_delay = 60 * 60
+
+    indexes = [
+        IndexModel(
+            [("status", ASCENDING), ("next_attempt_on", ASCENDING)],
+            name="status_next_attempt",
+        ),
+        IndexModel(
+            [("dedupe_key", ASCENDING)],
+            name="pending_dedupe",
+            unique=True,
+            partialFilterExpression={"status": pending},
+        ),
+        # keep sent messages (and their timings) for 30 days
+        IndexModel(
+            [("sent_on", ASCENDING)], name="sent_ttl", expireAfterSeconds=30 * 86400
+        ),
+    ]
+
+    def __init__(self):
+        super().__init__(get_database(), "email_outbox")
+
+    @staticmethod
+    def dedupe_key(message):
+        return hashlib.sha256(
+            json.dumps(message, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    @classmethod
+    def document(
+        cls, to, subject, contents, cc=None, bcc=None, headers=None, attachments=None
+    ):
+        """ outbox document of a message, pending """
+        message = {
+            "to": to,
+            "cc": cc or [],
+            "bcc": bcc or [],
+            "subject": subject,
+            "contents": contents,
+            "headers": headers or {},
+            "attachments": attachments or [],
+        }
+        now = datetime.datetime.now()
+        return dict(
+            message,
+            dedupe_key=cls.dedupe_key(message),
+            status=cls.pending,
+            attempts=0,
+            queued_on=now,
+            next_attempt_on=now,
+        )
+
+    @classmethod
+    def enqueue(cls, **message):
+        """ queue a message. returns its ID or None if already pending """
+        try:
+            return cls().insert_one(cls.document(**message)).inserted_id
+        except DuplicateKeyError:
+            return None
+
+    @classmethod
+    def enqueue_many(cls, messages):
+        """ queue messages in bulk. returns number queued (not already pending) """
+        if not messages:
+            return 0
+        try:
+            return len(
+                cls()
+                .insert_many(
+                    [cls.document(**message) for message in messages], ordered=False
+                )
+                .inserted_ids
+            )
+        except BulkWriteError as exp:
+            if any(error["code"] != 11000 for error in exp.details["writeErrors"]):
+                raise
+            return exp.details["nInserted"]
+
+    @classmethod
+    def due(cls, limit):
+        """ pending messages ready to be (re)tried, oldest first """
+        return list(
+            cls()
+            .find(
+                {
+                    "status": cls.pending,
+                    "next_attempt_on": {"$lte": datetime.datetime.now()},
+                }
+            )
+            .sort([("next_attempt_on", ASCENDING)])
+            .limit(limit)
+        )
+
+    @classmethod
+    def sent_update(cls, message, duration, latency):
+        """ mark sent. duration of send and latency since queued in seconds """
+        return UpdateOne(
+            {"_id": message["_id"]},
+            {
+                "$set": {
+                    "status": cls.sent,
+                    "sent_on": datetime.datetime.now(),
+                    "send_duration": duration,
+                    "latency": latency,
+                },
+                "$inc": {"attempts": 1},
+                "$unset": {"next_attempt_on": ""},
+            },
+        )
+
+    @classmethod
+    def failed_update(cls, message, error):
+        """ reschedule message with exponential backoff (or give up) """
+        attempts = message["attempts"] + 1
+        update = {"attempts": attempts, "error": str(error)}
+        if attempts >= cls.max_attempts:
+            update["status"] = cls.failed
+        else:
+            update["next_attempt_on"] = datetime.datetime.now() + datetime.timedelta(
+                seconds=min(cls.retry_delay * 2 ** (attempts - 1), cls.max_retry_delay)
+            )
+        return UpdateOne({"_id": message["_id"]}, {"$set": update})
+
+    @classmethod
+    def record(cls, updates):
+        """ store results of a batch of sends """
+        if updates:
+            cls().bulk_write(updates, ordered=False)
+
+
+class Leases(BaseCollection):
+    """ time-limited named locks shared by all scheduler replicas
+
+        a lease belongs to its holder until expire_on. Holders renew it
+        while working. Relies on replicas' clocks being in sync """
+
+    def __init__(self):
+        super().__init__(get_database(), "leases")
+
+    @classmethod
+    def acquire(cls, name, holder, duration):
+        """ take or renew lease name for duration seconds. False if held """
+        now = datetime.datetime.now()
+        try:
+            cls().update_one(
+                {"_id": name, "$or": [{"holder": holder}, {"expire_on": {"$lt": now}}]},
+                {
+                    "$set": {
+                        "holder": holder,
+                        "expire_on": now + datetime.timedelta(seconds=duration),
+                    }
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:  # exists and held by another holder
+            return False
+        return True
+
+    @classmethod
+    def release(cls, name, holder):
+        cls().delete_one({"_id": name, "holder": holder})
+
+
+class PeriodicJobs(BaseCollection):
+    """ schedule and runs of periodic-tasks.py jobs, shared by replicas """
+
+    history_size = 100  # runs kept per job
+
     def __init__(self):
-        super().__init__(Database(), "writer_tasks")
+        super().__init__(get_database(), "periodic_jobs")
+
+    @classmethod
+    def declare(cls, name, interval, first_run_on):
+        """ add job to schedule (keeping its schedule if known) """
+        cls().update_one(
+            {"_id": name},
+            {
+                "$set": {"interval": interval},
+                "$setOnInsert": {"next_run_on": first_run_on},
+            },
+            upsert=True,
+        )
+
+    @classmethod
+    def due(cls, now, names=None):
+        """ names of jobs scheduled before now or requested on-demand """
+        query = {
+            "$or": [{"next_run_on": {"$lte": now}}, {"requested_on": {"$ne": None}}]
+        }
+        if names is not None:
+            query["_id"] = {"$in": names}
+        return [job["_id"] for job in cls().find(query, {"_id": 1})]
+
+    @classmethod
+    def all(cls):
+        return list(cls().find({}, {"runs": 0}).sort([("_id", ASCENDING)]))
+
+    @classmethod
+    def request_run(cls, name):
+        """ ask daemon to run job now. False if job is unknown """
+        return (
+            cls()
+            .update_one(
+                {"_id": name}, {"$set": {"requested_on": datetime.datetime.now()}}
+            )
+            .matched_count
+            == 1
+        )
+
+    @classmethod
+    def record_run(cls, name, holder, started_on, duration, next_run_on, error=None):
+        """ store run results and schedule next one """
+        run = {
+            "holder": holder,
+            "started_on": started_on,
+            "duration": duration,
+            "error": error,
+        }
+        collection = cls()
+        collection.update_one(
+            {"_id": name},
+            {
+                "$set": {"last_run": run, "next_run_on": next_run_on},
+                "$push": {"runs": {"$each": [run], "$slice": -cls.history_size}},
+            },
+        )
+        # requests made while running call for another run
+        collection.update_one(
+            {"_id": name, "requested_on": {"$lte": started_on}},
+            {"$unset": {"requested_on": ""}},
+        )
+
+
+COLLECTIONS = [
+    Users,
+    RefreshTokens,
+    SigningKeys,
+    ChangeMarkers,
+    Acknowlegments,
+    Channels,
+    Warehouses,
+    Orders,
+    CreatorTasks,
+    DownloaderTasks,
+    WriterTasks,
+    TaskLogs,
+    EmailOutbox,
+]
+
+
+def ensure_indexes():
+    """ create declared indexes of all collections (no-op if present) """
+    for collection_cls in COLLECTIONS:
+        collection = collection_cls()
+        try:
+            names = collection.create_indexes(collection_cls.indexes)
+        except OperationFailure as exp:
+            logger.error(
+                "Unable to create indexes on {}: {}".format(collection.name, exp)
+            )
+        else:
+            logger.info("indexes on {}: {}".format(collection.name, ", ".join(names)))
+
+
+def backfill_deadlines():
+    """ set deadlines of documents timed before deadlines existed (at start) """
+    for collection_cls in (CreatorTasks, DownloaderTasks, WriterTasks, Orders):
+        collection_cls.backfill_deadlines()
@@ -0,0 +1,143 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Hub:
+    """ notifications of documents changes for long-polling requests
+
+        waiters register interest in keys (collection name or
+        `collection:document_id`) and are woken up when those are notified.
+        Waiters of the notifying process are woken up right away. Others are
+        woken up by their process' watcher which checks the change markers
+        (see ChangeMarkers) of all waited keys at once every `recheck`
+        seconds: waiters only fetch again when their key actually changed.
+
+        At most `max_waiters` requests are held per process so that request
+        threads (uwsgi.ini) remain available for other requests. """
+
+    max_wait = int(os.getenv("LONG_POLL_TIMEOUT", 50))  # below proxy timeout
+    recheck = int(os.getenv("LONG_POLL_RECHECK", 5))
+    max_waiters = int(os.getenv("LONG_POLL_MAX_WAITERS", 8))
+
+    class Busy(Exception):
+        """ max_waiters requests are already held by this process """
+
+    condition = threading.Condition()
+    versions = {}  # key: number of notifications since first waiter came in
+    waiters = {}  # key: number of waiters
+    markers = {}  # key: last seen change marker
+    watcher = None
+    watcher_pid = None
+
+    @staticmethod
+    def key(collection_name, document_id=None):
+        if document_id is None:
+            return collection_name
+        return "{}:{}".format(collection_name, document_id)
+
+    @classmethod
+    def notify(cls, *keys):
+        from utils.mongo import ChangeMarkers
+
+        # called once changes are written: waiters missing this notification
+        # only wait until their timeout
+        try:
+            markers = ChangeMarkers.bump(keys)
+        except Exception as exp:
+            logger.error("Unable to bump change markers: {}".format(exp))
+            markers = {}
+        with cls.condition:
+            watched = [key for key in keys if key in cls.waiters]
+            for key in watched:
+                cls.versions[key] += 1
+                if key in markers:  # not a change for the watcher
+                    cls.markers[key] = markers[key]
+            if watched:
+                cls.condition.notify_all()
+
+    @classmethod
+    def watch(cls):
+        """ wake waiters of keys changed by other processes (watcher thread) """
+        from utils.mongo import ChangeMarkers
+
+        while True:
+            time.sleep(cls.recheck)
+            with cls.condition:
+                keys = list(cls.markers.keys())
+            if not keys:
+                continue
+            try:
+                current = ChangeMarkers.get(keys)
+            except Exception as exp:
+                logger.warning("Unable to read change markers: {}".format(exp))
+                continue
+            with cls.condition:
+                changed = [
+                    key
+                    for key in keys
+                    if key in cls.markers and cls.markers[key] != current[key]
+                ]
+                for key in changed:
+                    cls.markers[key] = current[key]
+                    cls.versions[key] += 1
+                if changed:
+                    cls.condition.notify_all()
+
+    @classmethod
+    def ensure_watcher(cls):
+        with cls.condition:
+            if cls.watcher_pid == os.getpid() and cls.watcher.is_alive():
+                return
+            cls.watcher = threading.Thread(
+                target=cls.watch, name="hub-watcher", daemon=True
+            )
+            cls.watcher.start()
+            cls.watcher_pid = os.getpid()
+
+    @classmethod
+    def poll(cls, key, fetch, timeout):
+        """ fetch() until it returns something truthy or timeout passed
+
+            fetch is called again as soon as key is notified.
+            raises Hub.Busy if max_waiters requests are already waiting """
+        if timeout <= 0:
+            return fetch()
+
+        from utils.mongo import ChangeMarkers
+
+        cls.ensure_watcher()
+        with cls.condition:
+            if sum(cls.waiters.values()) >= cls.max_waiters:
+                raise cls.Busy()
+            cls.waiters[key] = cls.waiters.get(key, 0) + 1
+            cls.versions.setdefault(key, 0)
+        try:
+            if key not in cls.markers:
+                # read before fetching: changes made after fetch are seen
+                marker = ChangeMarkers.get([key])[key]
+                with cls.condition:
+                    cls.markers.setdefault(key, marker)
+
+            deadline = time.monotonic() + timeout
+            while True:
+                with cls.condition:
+                    version = cls.versions[key]
+                result = fetch()
+                remaining = deadline - time.monotonic()
+                if result or remaining <= 0:
+                    return result
+                with cls.condition:
+                    cls.condition.wait_for(
+                        lambda: cls.versions[key] != version, timeout=remaining
+                    )
+        finally:
+            with cls.condition:
+                cls.waiters[key] -= 1
+                if not cls.waiters[key]:
+                    del cls.waiters[key]
+                    del cls.versions[key]
+                    cls.markers.pop(key, None)
@@ -0,0 +1,90 @@
+import time
+import base64
+import binascii
+import datetime
+import threading
+
+import pymongo
+from bson import ObjectId
+from bson.errors import InvalidId
+
+
+def encode_cursor(object_id):
+    """ opaque token pointing after object_id """
+    return base64.urlsafe_b64encode(ObjectId(object_id).binary).decode("ascii")
+
+
+def decode_cursor(token):
+    """ ObjectId from a cursor token. ValueError if token is invalid """
+    try:
+        return ObjectId(base64.urlsafe_b64decode(token.encode("ascii")))
+    except (binascii.Error, InvalidId, TypeError, UnicodeError):
+        raise ValueError("Invalid cursor `{}`".format(token))
+
+
+def date_range_query(since=None, until=None):
+    """ _id query matching documents created within [since, until[ """
+    query = {}
+    if since is not None:
+        query["$gte"] = ObjectId.from_datetime(since)
+    if until is not None:
+        query["$lt"] = ObjectId.from_datetime(until)
+    return query
+
+
+def parse_datetime(value):
+    """ datetime from an ISO date (YYYY-MM-DD) or datetime string """
+    return datetime.datetime.fromisoformat(value.rstrip("Z"))
+
+
+class CountCache:
+    """ in-process short-lived cache of count_documents results """
+
+    ttl = 30  # seconds
+    lock = threading.Lock()
+    entries = {}
+
+    @classmethod
+    def count(cls, collection, query):
+        if not query:
+            return collection.estimated_document_count()
+
+        key = (collection.name, repr(sorted(query.items())))
+        now = time.monotonic()
+        with cls.lock:
+            entry = cls.entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        count = collection.count_documents(query)
+        with cls.lock:
+            # drop expired entries so the cache stays bounded
+            cls.entries = {k: v for k, v in cls.entries.items() if v[0] > now}
+            cls.entries[key] = (now + cls.ttl, count)
+        return count
+
+
+def paginate(
+    collection, query, projection=None, limit=20, cursor=None, skip=0, reverse=False
+):
+    """ (items, next cursor, count) of a page of collection sorted by _id
+
+        cursor-based (keyset) pages have constant cost whatever the depth.
+        skip is kept for older clients and only used without a cursor """
+    count = CountCache.count(collection, query)
+
+    query = dict(query)
+    if cursor:
+        query["_id"] = dict(
+            query.get("_id", {}), **{"$lt" if reverse else "$gt": decode_cursor(cursor)}
+        )
+        skip = 0
+
+    items = list(
+        collection.find(query, projection)
+        .sort([("_id", pymongo.DESCENDING if reverse else pymongo.ASCENDING)])
+        .skip(skip)
+        .limit(limit + 1)
+    )
+    next_cursor = encode_cursor(items[limit - 1]["_id"]) if len(items) > limit else None
+    return items[:limit], next_cursor, count
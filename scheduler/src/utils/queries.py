@@ -0,0 +1,187 @@
+""" per-request tracking of mongo commands (debug and tests)
+
+    with QUERY_TRACKING=1, every command issued while handling a request is
+    counted and timed. Commands sharing the same shape (same collection,
+    filter keys and operators, values stripped) QUERY_REPEAT_THRESHOLD times
+    or more in a request are reported as likely N+1 patterns.
+    A summary is returned in the X-Mongo-Queries response header and logged
+    (as a warning when over QUERY_BUDGET or with repeated shapes). """
+
+import os
+import json
+import logging
+import threading
+import contextlib
+import collections
+
+from flask import g, request
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+ENABLED = bool(int(os.getenv("QUERY_TRACKING", 0)))
+BUDGET = int(os.getenv("QUERY_BUDGET", 30))  # commands per request
+REPEAT_THRESHOLD = int(os.getenv("QUERY_REPEAT_THRESHOLD", 3))
+HEADER = "X-Mongo-Queries"
+
+# not part of a query's shape: session, cluster and inserted payloads
+IGNORED_KEYS = ("lsid", "$db", "$clusterTime", "$readPreference", "txnNumber")
+IGNORED_KEYS += ("documents", "cursor", "batchSize")
+# continuation of a previous command, not a query of its own
+CONTINUATIONS = ("getMore", "killCursors", "endSessions")
+
+local = threading.local()
+
+
+def shape_of(value):
+    """ value with all scalars replaced by ? (lists of scalars by [?]) """
+    if isinstance(value, dict):
+        return {key: shape_of(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, (dict, list, tuple)) for item in value):
+            return [shape_of(item) for item in value]
+        return ["?"]
+    return "?"
+
+
+def query_shape(command_name, command):
+    """ identifies commands differing only by their values """
+    details = {
+        key: shape_of(value)
+        for key, value in command.items()
+        if key != command_name and key not in IGNORED_KEYS
+    }
+    return "{} {} {}".format(
+        command_name,
+        command.get(command_name),
+        json.dumps(details, sort_keys=True, default=str),
+    )
+
+
+class QueryTracker:
+    """ mongo commands issued while active (see track()) """
+
+    def __init__(self, label="", parent=None):
+        self.label = label
+        self.parent = parent
+        self.started = {}  # request_id: shape
+        self.commands = []  # (shape, duration in seconds, succeeded)
+
+    @property
+    def count(self):
+        return len(self.commands)
+
+    @property
+    def duration(self):
+        return sum(duration for _, duration, _ in self.commands)
+
+    def start(self, event):
+        self.started[event.request_id] = (
+            event.command_name
+            if event.command_name in CONTINUATIONS
+            else query_shape(event.command_name, event.command)
+        )
+
+    def finish(self, event, succeeded):
+        shape = self.started.pop(event.request_id, event.command_name)
+        self.commands.append((shape, event.duration_micros / 1e6, succeeded))
+
+    def repeated(self):
+        """ {shape: count} of shapes seen at least REPEAT_THRESHOLD times """
+        counts = collections.Counter(
+            shape for shape, _, _ in self.commands if shape not in CONTINUATIONS
+        )
+        return {
+            shape: count
+            for shape, count in counts.most_common()
+            if count >= REPEAT_THRESHOLD
+        }
+
+    def header(self):
+        return "count={count}; duration={duration:.1f}ms; repeated={repeated}".format(
+            count=self.count,
+            duration=self.duration * 1000,
+            repeated=len(self.repeated()),
+        )
+
+    def report(self):
+        lines = ["{label}: {header}".format(label=self.label, header=self.header())]
+        lines += [
+            "  {count}x {shape}".format(count=count, shape=shape)
+            for shape, count in self.repeated().items()
+        ]
+        return "\n".join(lines)
+
+
+def current():
+    return getattr(local, "tracker", None)
+
+
+@contextlib.contextmanager
+def track(label=""):
+    """ QueryTracker of commands issued by this thread within the block """
+    tracker = local.tracker = QueryTracker(label, parent=current())
+    try:
+        yield tracker
+    finally:
+        local.tracker = tracker.parent
+
+
+class QueryTrackingListener(monitoring.CommandListener):
+    """ feeds the trackers active in the thread issuing commands """
+
+    def started(self, event):
+        tracker = current()
+        while tracker is not None:
+            tracker.start(event)
+            tracker = tracker.parent
+
+    def succeeded(self, event):
+        tracker = current()
+        while tracker is not None:
+            tracker.finish(event, True)
+            tracker = tracker.parent
+
+    def failed(self, event):
+        tracker = current()
+        while tracker is not None:
+            tracker.finish(event, False)
+            tracker = tracker.parent
+
+
+def start_request_tracking():
+    g.query_tracking = track(
+        "{} {}".format(request.method, request.url_rule or request.path)
+    )
+    g.query_tracker = g.query_tracking.__enter__()
+
+
+def report_request(response):
+    tracker = g.get("query_tracker")
+    if tracker is None:
+        return response
+    response.headers[HEADER] = tracker.header()
+    if tracker.count > BUDGET or tracker.repeated():
+        logger.warning(
+            "over query budget ({})\n{}".format(BUDGET, tracker.report())
+            if tracker.count > BUDGET
+            else tracker.report()
+        )
+    else:
+        logger.debug(tracker.report())
+    return response
+
+
+def stop_request_tracking(exc=None):
+    tracking = g.pop("query_tracking", None)
+    if tracking is not None:
+        tracking.__exit__(None, None, None)
+
+
+def init_app(app):
+    """ track commands of each request to app (if QUERY_TRACKING is set) """
+    if not ENABLED:
+        return
+    app.before_request(start_request_tracking)
+    app.after_request(report_request)
+    app.teardown_request(stop_request_tracking)
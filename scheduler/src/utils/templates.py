@@ -2,11 +2,12 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+import io
 import re
 import os
 import base64
 import logging
-import tempfile
+import functools
 
 import qrcode
 import langcodes
@@ -76,10 +77,10 @@ def linebreaksbr(value, autoescape=True):
     return Markup(value.replace("\n", "<br />"))
 
 
+@functools.lru_cache(maxsize=256)
 def b64qrcode(text):
     """ encodes the text in PNG QRCode then return its base64 repr """
     img = qrcode.make(text, image_factory=PymagingImage)
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=True) as qfile:
-        img.save(qfile)
-        qfile.seek(0)
-        return base64.b64encode(qfile.read()).decode("utf-8")
+    qfile = io.BytesIO()
+    img.save(qfile)
+    return base64.b64encode(qfile.getvalue()).decode("utf-8")
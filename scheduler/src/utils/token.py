@@ -1,17 +1,77 @@
+import os
+import hmac
 import json
+import time
 import uuid
-import string
-import random
+import hashlib
+import threading
 from datetime import datetime, timedelta
 
 import jwt
 from bson.objectid import ObjectId
 
+from utils.mongo import SigningKeys
+
+
+class KeyRing:
+    """ signing keys shared by all scheduler processes and nodes
+
+        a new key is used every `rotation` seconds. Its id (kid) is the start
+        of its rotation period so that all processes agree on it without
+        coordination. Retired keys still verify tokens for `grace` seconds.
+
+        With JWT_SECRET set (shared with warehouses so they can verify tokens
+        locally), secrets are derived from it. Otherwise random secrets are
+        stored in the signing_keys collection. """
+
+    master_secret = os.getenv("JWT_SECRET")
+    rotation = int(os.getenv("JWT_KEY_ROTATION", 86400))
+    grace = int(os.getenv("JWT_KEY_GRACE", 7200))  # above token lifetime
+
+    lock = threading.Lock()
+    secrets = {}  # kid: secret
+
+    @staticmethod
+    def derive(master_secret, kid):
+        return hmac.new(
+            master_secret.encode("utf-8"), kid.encode("utf-8"), hashlib.sha256
+        ).hexdigest()
+
+    @classmethod
+    def current_kid(cls):
+        return str(int(time.time()) // cls.rotation * cls.rotation)
+
+    @classmethod
+    def get_secret(cls, kid):
+        """ secret of key kid. None if kid is invalid or not valid anymore """
+        try:
+            started_on = int(kid)
+        except (TypeError, ValueError):
+            return None
+        now = time.time()
+        expire_on = started_on + cls.rotation + cls.grace
+        if started_on > now or expire_on < now:
+            return None
+
+        with cls.lock:
+            secret = cls.secrets.get(kid)
+        if secret is None:
+            if cls.master_secret:
+                secret = cls.derive(cls.master_secret, kid)
+            else:
+                secret = SigningKeys.get_secret(kid, datetime.fromtimestamp(expire_on))
+            with cls.lock:
+                # drop retired keys so the ring stays bounded
+                cls.secrets = {
+                    k: v
+                    for k, v in cls.secrets.items()
+                    if int(k) + cls.rotation + cls.grace >= now
+                }
+                cls.secrets[kid] = secret
+        return secret
+
 
 class AccessToken:
-    secret = "".join(
-        [random.choice(string.ascii_letters + string.digits) for _ in range(32)]
-    )
     issuer = "scheduler"
 
     class JSONEncoder(json.JSONEncoder):
@@ -36,10 +96,19 @@ class AccessToken:
             "jti": uuid.uuid4(),
             "user": user,
         }
+        kid = KeyRing.current_kid()
         return jwt.encode(
-            payload, key=cls.secret, algorithm="HS256", json_encoder=cls.JSONEncoder
+            payload,
+            key=KeyRing.get_secret(kid),
+            algorithm="HS256",
+            headers={"kid": kid},
+            json_encoder=cls.JSONEncoder,
         ).decode("utf-8")
 
     @classmethod
     def decode(cls, token: str) -> dict:
-        return jwt.decode(token, cls.secret, algorithms=["HS256"])
+        kid = jwt.get_unverified_header(token).get("kid")
+        secret = KeyRing.get_secret(kid)
+        if secret is None:
+            raise jwt.InvalidTokenError("unknown or retired signing key")
+        return jwt.decode(token, secret, algorithms=["HS256"])
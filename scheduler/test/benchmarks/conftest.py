@@ -0,0 +1,212 @@
+""" seeded scheduler database for the micro-benchmarks
+
+    needs a mongod: MONGODB_URI or a `mongod` binary to start a throwaway one.
+    Without it, benchmarks run on mongomock: checks only, timings are not
+    those of MongoDB.
+    Volumes: BENCHMARK_ORDERS orders of history (1 to 5 cards each), and
+    enough tasks in the right status for BENCHMARK_ROUNDS rounds of each
+    benchmark consuming some (claim, status update, sweep).
+
+    keep a JSON baseline and compare with it:
+        pytest test/benchmarks --benchmark-save=baseline
+        pytest test/benchmarks --benchmark-compare=0001 --benchmark-compare-fail=mean:20%
+    or --benchmark-json=<path> to write results elsewhere """
+
+import os
+import random
+import datetime
+
+import pytest
+from pymongo import UpdateOne
+
+ORDERS = int(os.getenv("BENCHMARK_ORDERS", 2000))
+ROUNDS = int(os.getenv("BENCHMARK_ROUNDS", 100))
+SWEEP_SIZE = int(os.getenv("BENCHMARK_SWEEP_SIZE", 50))  # orders timed out
+SEED = 20190601
+
+
+class Seeded:
+    """ IDs of seeded documents per use, consumed by benchmarks """
+
+    def __init__(self):
+        self.rounds = ROUNDS
+        self.detail_order = None
+        self.received_creator_tasks = []
+        self.writing_writer_task = None
+        self.sweep_orders = []
+
+
+def statuses(*names, since=None):
+    on = since or datetime.datetime.now() - datetime.timedelta(days=2)
+    history = []
+    for name in names:
+        history.append({"status": name, "on": on, "payload": None})
+        on += datetime.timedelta(minutes=10)
+    return history
+
+
+def new_order(rng, index, status, history, quantity=None):
+    person = {
+        "name": "client {}".format(index),
+        "email": "client{}@example.org".format(index),
+    }
+    return {
+        "config": {"name": "benchmark {}".format(index), "content": {"zims": []}},
+        "sd_card": {"name": "64GB", "type": "physical", "size": 64, "duration": 7},
+        "quantity": quantity or rng.randint(1, 5),
+        "units": 1,
+        "channel": rng.choice(["kiwix", "kiwix", "kiwix", "partner"]),
+        "client": person,
+        "recipient": dict(person, address="somewhere", country="fr"),
+        "warehouse": {"upload_uri": "ftp://warehouse/", "download_uri": "ftp://w/"},
+        "status": status,
+        "statuses": history,
+        "tasks": {},
+    }
+
+
+def new_task(order, order_id, status, history, **extra):
+    return dict(
+        {
+            "order": order_id,
+            "channel": order["channel"],
+            "worker": None if status == "pending" else "worker",
+            "status": status,
+            "statuses": history,
+            "image_size": 2 ** 33,
+        },
+        **extra
+    )
+
+
+def seed_orders(
+    mongo, rng, count, order_status, creator, downloader, writer, quantity=None
+):
+    """ count orders in order_status with tasks in given statuses
+
+        creator, downloader and writer are task statuses (None: no such task)
+        returns [(order_id, {kind: [task_id, ...]})] """
+    orders = [
+        new_order(rng, index, order_status, statuses("created", order_status), quantity)
+        for index in range(count)
+    ]
+    # in-progress tasks far from timing out (see sweep benchmark)
+    tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+    order_ids = mongo.Orders().insert_many(orders).inserted_ids
+    tasks = [{} for _ in orders]
+    for kind, task_cls, status in (
+        ("create", mongo.CreatorTasks, creator),
+        ("download", mongo.DownloaderTasks, downloader),
+        ("write", mongo.WriterTasks, writer),
+    ):
+        if status is None:
+            continue
+        documents, owners = [], []
+        extra = {}
+        if status in mongo.Tasks.IN_PROGRESS_STATUSES:
+            extra["deadline"] = tomorrow
+        for index, (order, order_id) in enumerate(zip(orders, order_ids)):
+            copies = order["quantity"] if kind == "write" else 1
+            for slot in range(copies):
+                documents.append(
+                    new_task(
+                        order,
+                        order_id,
+                        status,
+                        statuses("pending", "received", status),
+                        **(dict(extra, slot=str(slot)) if kind == "write" else extra)
+                    )
+                )
+                owners.append(index)
+        for index, task_id in zip(
+            owners, task_cls().insert_many(documents).inserted_ids
+        ):
+            tasks[index].setdefault(kind, []).append(task_id)
+
+    updates = []
+    for order_id, order_tasks in zip(order_ids, tasks):
+        update = {"tasks.write": order_tasks.get("write", [])}
+        for kind in ("create", "download"):
+            if kind in order_tasks:
+                update["tasks.{}".format(kind)] = order_tasks[kind][0]
+        updates.append(UpdateOne({"_id": order_id}, {"$set": update}))
+    mongo.Orders().bulk_write(updates, ordered=False)
+    return list(zip(order_ids, tasks))
+
+
+def reset_database(mongo):
+    mongo.get_client().drop_database(os.environ["MONGODB_DBNAME"])
+    mongo.ensure_indexes()
+    mongo.Channels.clear_private_slugs()
+
+
+@pytest.fixture(scope="module")
+def seeded(mongo):
+    """ database seeded for this module only (other tests seed their own) """
+    reset_database(mongo)
+    rng = random.Random(SEED)
+    seeded = Seeded()
+
+    mongo.Channels().insert_many(
+        [
+            {"slug": "kiwix", "name": "Kiwix", "private": False},
+            {"slug": "partner", "name": "Partner", "private": True},
+        ]
+    )
+    mongo.Users().insert_many(
+        [
+            {"username": "manager", "email": "m@example.org", "role": "manager"},
+            {"username": "worker", "email": "w@example.org", "role": "writer"},
+        ]
+    )
+
+    # history: shipped orders with all their tasks completed
+    seed_orders(
+        mongo,
+        rng,
+        ORDERS,
+        mongo.Orders.shipped,
+        "uploaded",
+        "downloaded_and_removed",
+        "written",
+    )
+    # creator tasks waiting for a worker (listed and claimed)
+    seed_orders(mongo, rng, ROUNDS * 3, "created", "pending", None, None)
+    # creator tasks received, moved to building by status updates
+    seeded.received_creator_tasks = [
+        tasks["create"][0]
+        for _, tasks in seed_orders(
+            mongo, rng, ROUNDS * 2, "creating", "received", None, None
+        )
+    ]
+    # orders being written: one uploading logs, others timed out by sweeps
+    writing = seed_orders(
+        mongo, rng, SWEEP_SIZE + 1, "writing", "uploaded", "downloaded", "writing"
+    )
+    seeded.writing_writer_task = writing[0][1]["write"][0]
+    seeded.sweep_orders = [order_id for order_id, _ in writing[1:]]
+    # a ten cards order
+    seeded.detail_order = seed_orders(
+        mongo, rng, 1, "writing", "uploaded", "downloaded", "waiting_for_card", 10
+    )[0][0]
+    yield seeded
+    reset_database(mongo)
+
+
+@pytest.fixture(scope="session")
+def tokens(mongo):
+    from utils.token import AccessToken
+
+    return {
+        role: {"token": AccessToken.encode({"username": username, "role": role})}
+        for username, role in (
+            ("manager", "manager"),
+            ("worker", "creator"),
+            ("worker", "writer"),
+        )
+    }
+
+
+@pytest.fixture(scope="module")
+def client(app, seeded):
+    return app.test_client()
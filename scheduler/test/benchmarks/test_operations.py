@@ -0,0 +1,108 @@
+import os
+import datetime
+import importlib.util
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+
+@pytest.fixture(scope="module")
+def periodic_tasks(mongo):
+    pytest.importorskip("emailing")
+    spec = importlib.util.spec_from_file_location(
+        "periodic_tasks",
+        os.path.join(
+            os.path.dirname(os.path.dirname(mongo.__file__)), "periodic-tasks.py"
+        ),
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_list_tasks(benchmark, client, tokens):
+    response = benchmark(
+        client.get, "/tasks/creator?limit=20&slot=1", headers=tokens["creator"]
+    )
+    assert response.status_code == 200
+    assert len(response.json) == 20
+
+
+def test_claim_task(benchmark, client, tokens, seeded):
+    def claim():
+        return client.post("/tasks/creator/claim?slot=1", headers=tokens["creator"])
+
+    response = benchmark.pedantic(claim, rounds=seeded.rounds)
+    assert response.status_code == 200
+    assert response.json["status"] == "received"
+
+
+def test_status_update_cascade(benchmark, client, tokens, seeded):
+    task_ids = iter(seeded.received_creator_tasks)
+
+    def next_task():
+        return (next(task_ids),), {}
+
+    def update_status(task_id):
+        return client.patch(
+            "/tasks/creator/{}/status".format(task_id),
+            json={"status": "building", "log": "building image"},
+            headers=tokens["creator"],
+        )
+
+    response = benchmark.pedantic(update_status, setup=next_task, rounds=seeded.rounds)
+    assert response.json["updated"]
+
+
+def test_log_upload(benchmark, client, tokens, seeded):
+    line = "[writer] wrote 1% of image\n" * 40
+    sent = {"size": 0, "uploads": 0}
+
+    def upload_log():
+        response = client.post(
+            "/tasks/writer/{}/logs".format(seeded.writing_writer_task),
+            json={"writer_log": {"offset": sent["size"], "data": line}},
+            headers=tokens["writer"],
+        )
+        sent["size"] = response.json["sizes"]["writer"]
+        sent["uploads"] += 1
+        return response
+
+    response = benchmark.pedantic(upload_log, rounds=seeded.rounds)
+    assert sent["size"] == len(line) * sent["uploads"]
+    assert response.status_code == 200
+
+
+def test_order_detail(benchmark, client, tokens, seeded):
+    response = benchmark(
+        client.get, "/orders/{}".format(seeded.detail_order), headers=tokens["manager"]
+    )
+    assert response.status_code == 200
+    assert len(response.json["tasks"]["write"]) == 10
+
+
+def test_periodic_sweep(benchmark, mongo, periodic_tasks, seeded):
+    """ timing out SWEEP_SIZE writing orders among all tasks """
+
+    def expire_tasks():
+        past = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        mongo.WriterTasks().update_many(
+            {"order": {"$in": seeded.sweep_orders}},
+            {
+                "$set": {"status": "writing", "deadline": past},
+                "$unset": {"timedout_on": ""},
+            },
+        )
+        mongo.Orders().update_many(
+            {"_id": {"$in": seeded.sweep_orders}}, {"$set": {"status": "writing"}}
+        )
+
+    benchmark.pedantic(
+        periodic_tasks.timeout_expired_tasks,
+        setup=expire_tasks,
+        rounds=max(seeded.rounds // 10, 1),
+    )
+    assert mongo.Orders().count_documents(
+        {"_id": {"$in": seeded.sweep_orders}, "status": "failed"}
+    ) == len(seeded.sweep_orders)
@@ -1,5 +1,17 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import subprocess
+
 import pytest
 import requests
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
+from pymongo.collection import Collection
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
 
 
 @pytest.fixture(scope="module")
@@ -24,3 +36,171 @@ def access_token(authorize):
 @pytest.fixture(scope="class")
 def refresh_token(authorize):
     return authorize["refresh_token"]
+
+
+class CommandCounter(monitoring.CommandListener):
+    """ names of Mongo commands sent since last reset() """
+
+    def __init__(self):
+        self.commands = []
+
+    def reset(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+@pytest.fixture(scope="session")
+def command_counter():
+    counter = CommandCounter()
+    monitoring.register(counter)
+    return counter
+
+
+@pytest.fixture(scope="session")
+def mongodb_uri(tmp_path_factory):
+    """ MONGODB_URI or, if mongod is installed, a throwaway one for the session """
+    if os.getenv("MONGODB_URI") or not shutil.which("mongod"):
+        yield os.getenv("MONGODB_URI", "mongodb://localhost")
+        return
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [
+            "mongod",
+            "--dbpath",
+            str(tmp_path_factory.mktemp("mongod")),
+            "--bind_ip",
+            "127.0.0.1",
+            "--port",
+            str(port),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.STDOUT,
+    )
+    uri = "mongodb://127.0.0.1:{}".format(port)
+    client = MongoClient(uri, serverSelectionTimeoutMS=1000)
+    for _ in range(30):
+        try:
+            client.admin.command("ping")
+            break
+        except PyMongoError:
+            time.sleep(1)
+    client.close()
+    yield uri
+    process.terminate()
+    process.wait(timeout=30)
+
+
+class InMemoryCollection:
+    """ mongomock collection standing for an instance of a collection class
+
+        class attributes (classmethods, indexes, etc) come first """
+
+    def __init__(self, collection_cls, collection):
+        self.collection_cls = collection_cls
+        self.collection = collection
+
+    def __getattr__(self, name):
+        for klass in self.collection_cls.__mro__:
+            if klass is Collection:
+                break
+            if name in vars(klass):
+                return getattr(self.collection_cls, name)
+        return getattr(self.collection, name)
+
+
+def use_in_memory_database(mongo, mongomock):
+    """ make utils.mongo's collection classes use a mongomock database """
+    client = mongomock.MongoClient()
+    database = client[os.environ["MONGODB_DBNAME"]]
+    for collection_cls in vars(mongo).values():
+        if not isinstance(collection_cls, type) or not issubclass(
+            collection_cls, Collection
+        ):
+            continue
+        try:
+            name = collection_cls().name  # no server needed
+        except TypeError:  # no collection of its own (ie. Tasks)
+            continue
+        collection_cls.__new__ = (
+            lambda name: lambda cls, *args, **kwargs: InMemoryCollection(
+                cls, database[name]
+            )
+        )(name)
+    mongo.get_database = lambda: database
+    mongo.get_client = lambda: client
+
+
+@pytest.fixture(scope="session")
+def mongo(command_counter, mongodb_uri):
+    """ scheduler's utils.mongo on a throwaway database
+
+        without MongoDB server, on an in-memory mongomock one if installed:
+        no commands are sent then (see mongod fixture) """
+    os.environ["MONGODB_URI"] = mongodb_uri
+    os.environ["MONGODB_DBNAME"] = "Cardshop_test"
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    from utils import mongo
+
+    try:
+        MongoClient(
+            os.environ["MONGODB_URI"], serverSelectionTimeoutMS=2000
+        ).admin.command("ping")
+    except PyMongoError as exp:
+        mongomock = pytest.importorskip(
+            "mongomock", reason="no MongoDB server available: {}".format(exp)
+        )
+        use_in_memory_database(mongo, mongomock)
+
+    mongo.Registry.reset()  # new client, with command_counter listening
+    mongo.get_client().drop_database(os.environ["MONGODB_DBNAME"])
+    mongo.ensure_indexes()
+    yield mongo
+    mongo.get_client().drop_database(os.environ["MONGODB_DBNAME"])
+
+
+@pytest.fixture(scope="session")
+def mongod(mongo):
+    """ utils.mongo on a MongoDB server, for tests of the commands sent """
+    if not isinstance(mongo.get_client(), MongoClient):
+        pytest.skip("no MongoDB server available")
+    return mongo
+
+
+@pytest.fixture(scope="session")
+def app(mongo):
+    """ scheduler's flask app, on the test database """
+    main = pytest.importorskip("main")
+    cwd = os.getcwd()
+    os.chdir(SRC_DIR)  # for email templates
+    yield main.flask
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def query_budget(app, mongod):
+    """ request app, failing if it issues more than max_queries mongo commands
+
+        query_budget(max_queries, method, url, **kwargs) -> response """
+    from utils import queries
+
+    client = app.test_client()
+
+    def request(max_queries, method, url, **kwargs):
+        with queries.track("{} {}".format(method, url)) as tracker:
+            response = client.open(url, method=method, **kwargs)
+        assert tracker.count <= max_queries, tracker.report()
+        return response
+
+    return request
@@ -0,0 +1,79 @@
+import os
+import datetime
+
+import pytest
+from flask import Flask
+
+
+@pytest.fixture(scope="module")
+def emailing(mongod):
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(os.path.dirname(mongod.__file__)))  # for templates
+    yield pytest.importorskip("emailing")
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope="module")
+def order(mongo):
+    now = datetime.datetime.now()
+    mongo.Users().insert_one(
+        {"username": "operator", "email": "operator@example.org", "role": "writer"}
+    )
+    mongo.Channels().insert_one({"slug": "kiwix", "name": "Kiwix", "private": False})
+    person = {"name": "someone", "email": "someone@example.org", "country": "fr"}
+    statuses = [{"status": "writing", "on": now, "payload": None}]
+    order_id = (
+        mongo.Orders()
+        .insert_one(
+            {
+                "config": {"name": "test"},
+                "sd_card": {"name": "64GB", "type": "physical", "size": 64},
+                "quantity": 3,
+                "units": 3,
+                "channel": "kiwix",
+                "client": person,
+                "recipient": person,
+                "warehouse": {"download_uri": "ftp://localhost"},
+                "status": "writing",
+                "statuses": statuses,
+            }
+        )
+        .inserted_id
+    )
+    task = {
+        "order": order_id,
+        "worker": "operator",
+        "status": "waiting_for_card",
+        "statuses": statuses,
+    }
+    tasks = {
+        "create": mongo.CreatorTasks().insert_one(dict(task)).inserted_id,
+        "download": mongo.DownloaderTasks().insert_one(dict(task)).inserted_id,
+        "write": mongo.WriterTasks()
+        .insert_many([dict(task, slot=str(slot)) for slot in range(3)])
+        .inserted_ids,
+    }
+    mongo.Orders().update_one({"_id": order_id}, {"$set": {"tasks": tasks}})
+    return mongo.Orders.get(order_id)
+
+
+def test_email_queries_are_constant(emailing, order, command_counter):
+    with Flask(__name__).app_context():
+        command_counter.reset()
+        emailing.send_insert_card_email(order["_id"], order["tasks"]["write"][0])
+        # order with tasks, channel, operator, then queuing
+        assert command_counter.commands == ["aggregate", "find", "find", "insert"]
+
+        command_counter.reset()
+        for write_task in order["tasks"]["write"]:
+            emailing.send_image_writing_email(order["_id"], write_task)
+        # context is shared by all emails of the request
+        assert command_counter.commands == ["insert"] * 3
+
+
+def test_email_context_not_shared_across_requests(emailing, order, command_counter):
+    for _ in range(2):
+        with Flask(__name__).app_context():
+            command_counter.reset()
+            emailing.send_order_created_email(order["_id"])
+            assert command_counter.commands.count("aggregate") == 1
@@ -0,0 +1,42 @@
+import pytest
+
+
+@pytest.fixture(scope="module")
+def queries(mongod):
+    from utils import queries
+
+    return queries
+
+
+@pytest.fixture(scope="module")
+def manager_token(mongo):
+    from utils.token import AccessToken
+
+    return AccessToken.encode({"username": "manager", "role": "manager"})
+
+
+def test_repeated_shapes_are_reported(mongo, queries):
+    with queries.track() as tracker:
+        for index in range(queries.REPEAT_THRESHOLD):
+            mongo.Orders().find_one({"_id": index})
+        mongo.Orders().find_one({"status": "pending"})
+    assert tracker.count == queries.REPEAT_THRESHOLD + 1
+    # values differ but not the shape of the filter
+    assert list(tracker.repeated().values()) == [queries.REPEAT_THRESHOLD]
+
+
+def test_nested_trackers(mongo, queries):
+    with queries.track() as outer:
+        mongo.Orders().find_one({})
+        with queries.track() as inner:
+            mongo.Orders().find_one({})
+    assert (outer.count, inner.count) == (2, 1)
+    assert queries.current() is None
+
+
+@pytest.mark.parametrize(
+    "max_queries, url", [(3, "/orders/"), (3, "/workers/"), (6, "/stats/queues")],
+)
+def test_routes_query_budget(query_budget, manager_token, max_queries, url):
+    response = query_budget(max_queries, "GET", url, headers={"token": manager_token})
+    assert response.status_code == 200
@@ -0,0 +1,84 @@
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# (working, success(es), failed) statuses reported by workers, in order
+# (see `states` in workers/worker/tasks/*.py)
+WORKER_STATES = {
+    "CreatorTasks": [
+        ("building", ["built"], "failed_to_build"),
+        ("uploading", ["uploaded", "uploaded_public"], "failed_to_upload"),
+    ],
+    "DownloaderTasks": [
+        ("downloading", ["downloaded"], "failed_to_download"),
+        (
+            "pending_end_of_writes",
+            ["pending_image_removal"],
+            "downloaded_failed_to_remove",
+        ),
+        (
+            "pending_image_removal",
+            ["downloaded_and_removed"],
+            "downloaded_failed_to_remove",
+        ),
+    ],
+    "WriterTasks": [
+        ("waiting_for_card", ["card_inserted"], "failed_to_insert"),
+        ("wiping_sdcard", ["card_wiped"], "failed_to_wipe"),
+        ("writing", ["written"], "failed_to_write"),
+    ],
+}
+
+# set by the scheduler once workers are done
+FOLLOW_UPS = {
+    "uploaded_public": ["expired"],
+    "downloaded_and_removed": ["expired"],
+    "written": ["pending_shipment", "shiped"],
+}
+
+
+@pytest.fixture(scope="module")
+def mongo():
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    from utils import mongo
+
+    return mongo
+
+
+def worker_paths(states):
+    """ lists of statuses a worker reports, for all outcomes of each step """
+    paths, done = [], []
+    for working, successes, failed in states:
+        for outcome in [failed, "canceled"]:
+            paths.append(done + [working, outcome])
+        done = done + [working, successes[0]]
+        for success in successes[1:]:
+            paths.append(done[:-1] + [success])
+    paths.append(done)
+    return paths + [["failed"]]
+
+
+def walk(task_cls, statuses, start="received"):
+    """ status reached following statuses, failing on a refused one """
+    current = start
+    for status in statuses:
+        assert status in task_cls.TRANSITIONS, "unknown status {}".format(status)
+        if status == current:  # reported again: no-op
+            continue
+        assert current in task_cls.TRANSITIONS[status], "{} -> {}".format(
+            current, status
+        )
+        current = status
+    return current
+
+
+@pytest.mark.parametrize("cls_name", sorted(WORKER_STATES.keys()))
+def test_worker_statuses_are_allowed(mongo, cls_name):
+    task_cls = getattr(mongo, cls_name)
+    for path in worker_paths(WORKER_STATES[cls_name]):
+        last = walk(task_cls, path)
+        walk(task_cls, FOLLOW_UPS.get(last, []), start=last)
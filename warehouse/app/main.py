@@ -1,7 +1,12 @@
 import os
 import sys
+import hmac
+import time
+import hashlib
 import logging
+import threading
 
+import jwt
 import requests
 from pyftpdlib.authorizers import DummyAuthorizer, AuthenticationFailed
 from pyftpdlib.handlers import FTPHandler
@@ -11,34 +16,142 @@ logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
+class TokenCache:
+    """ (username, token) validated recently, with cache expiry (monotonic) """
+
+    def __init__(self, ttl, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            expiry = self.tokens.get(key)
+            if expiry is None:
+                return False
+            if expiry < time.monotonic():
+                del self.tokens[key]
+                return False
+            return True
+
+    def add(self, key, ttl=None):
+        """ cache key for ttl seconds (at most self.ttl) """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self.lock:
+            if len(self.tokens) >= self.max_size:
+                now = time.monotonic()
+                self.tokens = {
+                    key: expiry for key, expiry in self.tokens.items() if expiry > now
+                }
+                if len(self.tokens) >= self.max_size:
+                    self.tokens.pop(min(self.tokens, key=self.tokens.get))
+            self.tokens[key] = time.monotonic() + ttl
+
+    def remove(self, key):
+        with self.lock:
+            self.tokens.pop(key, None)
+
+    def all(self):
+        with self.lock:
+            return list(self.tokens.keys())
+
+
 class Authorizer(DummyAuthorizer):
-    def __init__(self, token_validation_url: str, file_storage_dir: str):
+    def __init__(
+        self,
+        token_validation_url: str,
+        file_storage_dir: str,
+        jwt_secret: str = None,
+        cache_ttl: int = 300,
+    ):
         super().__init__()
         self.token_validation_url = token_validation_url
         self.file_storage_dir = file_storage_dir
+        self.jwt_secret = jwt_secret
+        self.cache = TokenCache(ttl=cache_ttl)
+
+    def verify_locally(self, username, token):
+        """ seconds token is still valid for. raises if invalid """
+        # scheduler signs with keys derived from JWT_SECRET and the key id
+        kid = jwt.get_unverified_header(token).get("kid")
+        if not kid:
+            raise jwt.InvalidTokenError("token has no key id")
+        key = hmac.new(
+            self.jwt_secret.encode("utf-8"), kid.encode("utf-8"), hashlib.sha256
+        ).hexdigest()
+        payload = jwt.decode(token, key, algorithms=["HS256"], issuer="scheduler")
+        if payload.get("user", {}).get("username") != username:
+            raise jwt.InvalidTokenError("token is not {}'s".format(username))
+        return payload["exp"] - time.time()
+
+    @staticmethod
+    def remaining_validity(token):
+        """ seconds token's exp is in, None if it has none. not verified: only
+            used to shorten caching of tokens the scheduler accepted """
+        expiry = jwt.decode(token, verify=False).get("exp")
+        return None if expiry is None else expiry - time.time()
+
+    def verify_remotely(self, token):
+        """ whether scheduler accepts token. raises if unable to tell """
+        req = requests.post(
+            url=self.token_validation_url, headers={"access-token": token}, timeout=10
+        )
+        if req.status_code in (401, 403):
+            return False
+        req.raise_for_status()
+        return True
 
     def validate_authentication(self, username, password, handler):
         """
-        Upon receiving the authentication request, the ftp server contact cardshop scheduler to validate user's token.
-        If dispatcher return HTTP 200, the token is valid
+        Password is a scheduler access token.
+
+        Validated tokens are cached. Without cache hit, token is verified
+        locally if JWT_SECRET is set, by contacting the scheduler otherwise.
 
         :param username:
         :param token:
         :param handler:
         :raises AuthenticationFailed: if token is not valid or cannot contact cardshop scheduler
         """
+        if self.cache.get((username, password)):
+            return None
 
         try:
-            req = requests.post(
-                url=self.token_validation_url, headers={"access-token": password}
-            )
-            req.raise_for_status()
-            return None
+            if self.jwt_secret:
+                ttl = self.verify_locally(username, password)
+                self.cache.add((username, password), ttl)
+                return None
+            if self.verify_remotely(password):
+                self.cache.add((username, password), self.remaining_validity(password))
+                return None
         except Exception as exp:
             logger.error(exp)
 
         raise AuthenticationFailed("Authentication failed.")
 
+    def revalidate(self, interval):
+        """ periodically evict cached tokens the scheduler now rejects
+
+            (ie. deleted users). tokens are kept if scheduler is unreachable """
+        while True:
+            time.sleep(interval)
+            for key in self.cache.all():
+                try:
+                    if not self.verify_remotely(key[1]):
+                        logger.info("evicting {}'s token rejected".format(key[0]))
+                        self.cache.remove(key)
+                except Exception as exp:
+                    logger.warning("unable to revalidate token: {}".format(exp))
+                    break
+
+    def start_revalidation(self, interval):
+        thread = threading.Thread(target=self.revalidate, args=(interval,))
+        thread.daemon = True
+        thread.start()
+
     def get_home_dir(self, username):
         """
         All users share the same home dir path
@@ -127,7 +240,16 @@ if __name__ == "__main__":
             logging.basicConfig(level=logging.DEBUG)
 
         FTPHandler.banner = "Welcome to the Cardshop Warehouse."
-        FTPHandler.authorizer = Authorizer(token_validation_url, file_storage_dir)
+        authorizer = Authorizer(
+            token_validation_url,
+            file_storage_dir,
+            jwt_secret=os.getenv("JWT_SECRET"),
+            cache_ttl=int(os.getenv("TOKEN_CACHE_TTL", 300)),
+        )
+        revalidate_interval = int(os.getenv("TOKEN_REVALIDATE_INTERVAL", 0))
+        if revalidate_interval:
+            authorizer.start_revalidation(revalidate_interval)
+        FTPHandler.authorizer = authorizer
         FTPHandler.passive_ports = ftp_data_port_range
 
         masquerade_address = os.getenv("MASQUERADE_ADDRESS")
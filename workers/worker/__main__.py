@@ -10,10 +10,13 @@ import logging
 from writer import WriterWorker
 from creator import CreatorWorker
 from downloader import DownloaderWorker
+from utils.profiling import Profiler
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+PROFILING_DURATION = int(os.getenv("PROFILING_DURATION", 60))  # seconds
+
 
 WORKERS = {
     "creator": CreatorWorker,
@@ -29,6 +32,12 @@ def main(worker_cls):
         logger.error("requesting quit via {}".format(sig))
         worker.stop()
 
+    def profiling_handler(sig, frame):
+        # kill -USR1 <pid> (docker kill -s USR1 <container>) on a running worker
+        if Profiler.start(worker.worker_type, PROFILING_DURATION) is None:
+            logger.warning("a profiling session is already running")
+
+    signal.signal(signal.SIGUSR1, profiling_handler)
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGHUP, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
@@ -7,12 +7,7 @@ import time
 import logging
 
 from utils.setting import Setting
-from utils.scheduler import (
-    get_available_tasks,
-    request_task,
-    upload_logs,
-    set_worker_type,
-)
+from utils.scheduler import claim_task, upload_logs, set_worker_type
 from tasks.base import BaseTask
 
 
@@ -73,22 +68,25 @@ class BaseWorker:
         self.log_handler = logging.StreamHandler(self.log_stream)
         logger.addHandler(self.log_handler)
 
-    def get_available_tasks(self):
-        logger.info("requesting list of tasks for worker {}".format(Setting.username))
-        success, tasks = get_available_tasks()
+    def claim_task(self):
+        logger.info("requesting a task for worker {}".format(Setting.username))
+        success, task = claim_task(wait=Setting.long_poll_wait)
         if not success:
-            logger.error("ERROR getting tasks: {}".format(tasks))
-            return []
-        return tasks
+            logger.error("ERROR claiming task: {}".format(task))
+            return False, None
+        return True, task
 
-    def request_task(self, task_id):
-        logger.info("requesting task #{} to scheduler.".format(task_id))
-        success, tid = request_task(task_id)
-        return success
-
-    def upload_worker_logs(self, logs):
+    def upload_worker_logs(self, worker_log=None):
+        """ ship job logs' new parts (and full worker log if provided) """
         logger.info("sending logs for task #{}.".format(self.task["_id"]))
-        success, tid = upload_logs(task_id=self.task["_id"], logs=logs)
+        payloads = self.job.log_payloads()
+        logs = {key: payload for key, (payload, token) in payloads.items()}
+        logs["worker_log"] = worker_log
+        success, response = upload_logs(task_id=self.task["_id"], logs=logs)
+        if success:
+            self.job.acknowledge_logs(payloads, response.get("sizes", {}))
+        else:
+            logger.error("ERROR uploading logs: {}".format(response))
 
     def send_ack(self):
         logger.info("sending ACK to scheduler. working on #{}".format(self.task["_id"]))
@@ -108,9 +106,7 @@ class BaseWorker:
         return content
 
     def cleanup_task(self):
-        logs = {"worker_log": self.read_worker_log()}
-        logs.update(self.job.logs)
-        self.upload_worker_logs(logs)
+        self.upload_worker_logs(worker_log=self.read_worker_log())
         # clean-up
         self.job = None
         self.task = None
@@ -129,7 +125,7 @@ class BaseWorker:
 
                 if not log_upload_timer.pop():
                     logger.info("periodic log upload..................")
-                    self.upload_worker_logs(self.job.logs)
+                    self.upload_worker_logs()
                     log_upload_timer = Setting.get_timer(Setting.log_upload_interval)
 
                 if not self.job.is_alive():
@@ -142,23 +138,15 @@ class BaseWorker:
                     self.cleanup_task()
             else:
                 if not poll_timer.pop():
-                    # fetch tasks on scheduler
-                    for task in self.get_available_tasks():
-                        # skip tasks that are scheduled for other workers
-                        try:
-                            if (
-                                task["worker"] is not None
-                                and task["worker"] != Setting.username
-                            ):
-                                continue
-                        except Exception:
-                            pass
-
-                        # notify scheduler we want to take it
-                        if self.request_task(task["_id"]):
-                            self.start_task(task)
-                            break
-                    poll_timer = Setting.get_timer(Setting.poll_interval)
+                    # scheduler picks and assigns us the next eligible task,
+                    # holding the request until there is one (long-polling)
+                    success, task = self.claim_task()
+                    if task:
+                        self.start_task(task)
+                    # claim again right away unless scheduler failed us
+                    poll_timer = Setting.get_timer(
+                        1 if success else Setting.poll_interval
+                    )
 
             time.sleep(1)
 
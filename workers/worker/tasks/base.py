@@ -2,15 +2,85 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+import codecs
 import logging
 import threading
 import subprocess
 
 
 from utils.setting import Setting
-from utils.scheduler import update_task_status
+from utils.scheduler import update_task_status, wait_for_status_change
 
 ONE_KiB = 2 ** 10
+ONE_MiB = 2 ** 20
+
+
+class LogTail:
+    """ follows a log file by offset, keeping only what's not shipped yet
+
+        text is the log as shipped to the scheduler: header + file content.
+        pending (not yet acknowledged) text is bounded to max_pending chars,
+        oldest part being replaced by a marker should the scheduler be
+        unreachable for long """
+
+    read_size = 64 * ONE_KiB
+
+    def __init__(self, path, header="", max_pending=ONE_MiB):
+        self.path = path
+        self.max_pending = max_pending
+        self.position = 0  # bytes of file read so far
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.shipped = 0  # chars acknowledged by scheduler
+        self.pending = header  # chars after shipped
+        self.truncations = 0
+        self.lock = threading.Lock()
+
+    def read(self):
+        """ read what's been written to file since last read """
+        try:
+            fh = open(str(self.path), "rb")
+        except FileNotFoundError:
+            return
+        with fh:
+            fh.seek(self.position)
+            while True:
+                data = fh.read(self.read_size)
+                if not data:
+                    break
+                self.position += len(data)
+                self.append(self.decoder.decode(data))
+
+    def append(self, text):
+        with self.lock:
+            self.pending += text
+            if len(self.pending) > self.max_pending:
+                kept = self.pending[-self.max_pending :]
+                self.pending = "\n[… {} chars dropped …]\n{}".format(
+                    len(self.pending) - len(kept), kept
+                )
+                self.truncations += 1
+
+    def payload(self):
+        """ (log part to upload or None, token to acknowledge() it with) """
+        with self.lock:
+            if not self.pending:
+                return None, None
+            return (
+                {"offset": self.shipped, "data": self.pending},
+                (self.shipped, self.truncations),
+            )
+
+    def acknowledge(self, token, size):
+        """ scheduler stored log up to size (from a payload() with token) """
+        with self.lock:
+            shipped, truncations = token
+            if size <= self.shipped:
+                return
+            if truncations == self.truncations:
+                self.pending = self.pending[size - self.shipped :]
+            # else part of what was sent has been replaced by the marker
+            # meanwhile: keep it all as next part, after what's been stored
+            self.shipped = size
 
 
 class BaseTask(threading.Thread):
@@ -21,7 +91,7 @@ class BaseTask(threading.Thread):
         self.task: dict = {}
         self.logs = {}
 
-        self._should_stop: bool = False  # stop flag
+        self._stop_event = threading.Event()  # stop flag
 
         self.extra = {}  # extra data to populate and send
 
@@ -29,17 +99,34 @@ class BaseTask(threading.Thread):
 
     def stop(self):
         self.logger.info("stopping thread")
-        self._should_stop = True
+        self._stop_event.set()
 
     @property
     def canceled(self):
-        return self._should_stop
+        return self._stop_event.is_set()
+
+    def wait_while_status(self, status):
+        """ block until scheduler reports our task out of status (or stop) """
+        while not self.canceled:
+            success, task = wait_for_status_change(
+                self.task["_id"], status, wait=Setting.long_poll_wait
+            )
+            if success and task["status"] != status:
+                return task
+            if not success:
+                self.logger.error("unable to get task status: {}".format(task))
+                # don't hammer an unreachable scheduler
+                self._stop_event.wait(Setting.poll_interval)
+            else:
+                self.logger.info("still {}…".format(status))
 
     def report_status(self, status, status_log=None):
         self.logger.info("updating task #{} status to: {}".format(self.task["_id"], status))
         success, tid = update_task_status(
             self.task["_id"], status, status_log, extra=self.extra
         )
+        if not success:
+            self.logger.error("status {} rejected by scheduler: {}".format(status, tid))
         return success
 
     def file_path(self, ext):
@@ -47,11 +134,55 @@ class BaseTask(threading.Thread):
             "{id}.{ext}".format(id=str(self.task["order"]), ext=ext)
         )
 
-    def read_log(self, path):
-        cat = subprocess.run(["cat", str(path)], text=True, capture_output=True)
-        return "{stdout}\n{stderr}".format(
-            stdout=cat.stdout or "", stderr=cat.stderr or ""
-        )
+    def log_payloads(self):
+        """ {log_key: (payload, token)} of logs having something to ship """
+        payloads = {key: tail.payload() for key, tail in self.logs.items()}
+        return {key: value for key, value in payloads.items() if value[0]}
+
+    def acknowledge_logs(self, payloads, sizes):
+        """ update tails from sizes returned by scheduler for payloads """
+        for key, (payload, token) in payloads.items():
+            size = sizes.get(key[: -len("_log")])
+            if size is not None:
+                self.logs[key].acknowledge(token, size)
+
+    def run_process(self, name, args, log_path, log_key, header="", mode="w"):
+        """ run args, output to log_path followed into self.logs[log_key]
+
+            waits for process to exit (or terminates it on stop request)
+            returns the process, with returncode set """
+        tail = self.logs[log_key] = LogTail(log_path, header=header)
+        with open(str(log_path), mode) as log_fd:
+            ps = subprocess.Popen(
+                args=args,
+                stdout=log_fd,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+                close_fds=True,
+            )
+
+        self.logger.info("{} started: {}".format(name, ps))
+        while True:
+            try:
+                ps.wait(timeout=Setting.process_poll_interval)
+                break
+            except subprocess.TimeoutExpired:
+                tail.read()
+
+            # kill upon request
+            if self.canceled:
+                self.logger.info("terminating {}…".format(name))
+                ps.terminate()
+                try:
+                    ps.wait(10)
+                except subprocess.TimeoutExpired:
+                    ps.kill()
+                    ps.wait(10)
+                break
+
+        self.logger.info("collecting full terminated log")
+        tail.read()
+        return ps
 
     def run(self):
         self.task, self.logger = self._args
@@ -12,7 +12,11 @@ from urllib.parse import urlparse
 from tasks.base import BaseTask
 from utils.setting import Setting
 from utils import get_checksum
-from utils.scheduler import authenticate, get_access_token
+from utils.scheduler import (
+    authenticate,
+    get_access_token,
+    TRANSFER_TOKEN_VALIDITY,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -140,31 +144,14 @@ class CreateTask(BaseTask):
             args = ["cp", str(Setting.installer_binary_path), str(self.img_path)]
         self.logger.info("Starting {args}\n".format(args=" ".join(args)))
 
-        self.logs["installer_log"] = "{args}\n".format(args=" ".join(args))
-        log_fd = open(str(self.log_path), "w")
-        ps = subprocess.Popen(
-            args=args,
-            stdout=log_fd,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            close_fds=True,
+        ps = self.run_process(
+            "installer",
+            args,
+            self.log_path,
+            "installer_log",
+            header="{args}\n".format(args=" ".join(args)),
         )
 
-        self.logger.info("installer started: {}".format(ps))
-        while ps.poll() is None:
-            self.logs["installer_log"] = self.read_log(self.log_path)
-
-            # kill upon request
-            if self.canceled:
-                self.logger.info("terminating installer…")
-                ps.terminate()
-                ps.wait(10)
-                ps.kill()
-                ps.wait(10)
-                break
-
-        ps.wait(10)
-
         successful = ps.returncode == 0 and self.img_path.exists()
 
         if successful:
@@ -178,9 +165,6 @@ class CreateTask(BaseTask):
         else:
             self.logger.error("installer failed: {}".format(ps.returncode))
 
-        self.logger.info("collecting full terminated log")
-        self.logs["installer_log"] = self.read_log(self.log_path)
-
         # clean up working folder
         self.remove_files()
 
@@ -190,8 +174,8 @@ class CreateTask(BaseTask):
     def upload_image(self):
         self.logger.info("Starting upload")
 
-        self.logger.info("re-authenticate to ensure token is still valid")
-        authenticate(force=True)
+        # token is used by the transfer tool for (re)connections
+        authenticate(min_validity=TRANSFER_TOKEN_VALIDITY)
 
         url = self.task["upload_uri"]
 
@@ -224,39 +208,19 @@ class CreateTask(BaseTask):
         log_args = args[:-4] + ["{}:xxxxx".format(Setting.username)] + args[-3:]
         self.logger.info("Starting {args}\n".format(args=" ".join(log_args)))
 
-        self.logs["uploader_log"] = "{args}\n".format(args=" ".join(log_args))
-        log_fd = open(str(self.uploader_log_path), "w")
-        ps = subprocess.Popen(
-            args=args,
-            stdout=log_fd,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            close_fds=True,
+        ps = self.run_process(
+            "uploader",
+            args,
+            self.uploader_log_path,
+            "uploader_log",
+            header="{args}\n".format(args=" ".join(log_args)),
         )
 
-        self.logger.info("uploader started: {}".format(ps))
-        while ps.poll() is None:
-            self.logs["uploader_log"] = self.read_log(self.uploader_log_path)
-
-            # kill upon request
-            if self.canceled:
-                self.logger.info("terminating uploader…")
-                ps.terminate()
-                ps.wait(10)
-                ps.kill()
-                ps.wait(10)
-                break
-
-        ps.wait(10)
-
         if ps.returncode == 0:
             self.logger.info("uploader ran successfuly.")
         else:
             self.logger.error("uploader failed: {}".format(ps.returncode))
 
-        self.logger.info("collecting full terminated log")
-        self.logs["uploader_log"] = self.read_log(self.uploader_log_path)
-
         # remove image
         try:
             self.logger.info("removing image file: {}".format(self.img_path.name))
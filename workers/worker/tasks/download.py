@@ -3,13 +3,16 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import os
-import time
 import subprocess
 from urllib.parse import urlparse
 
 from tasks.base import BaseTask
 from utils.setting import Setting
-from utils.scheduler import authenticate, get_access_token, get_task
+from utils.scheduler import (
+    authenticate,
+    get_access_token,
+    TRANSFER_TOKEN_VALIDITY,
+)
 
 
 class DownloadTask(BaseTask):
@@ -70,8 +73,8 @@ class DownloadTask(BaseTask):
 
         checksum_type, checksum_digest = self.task["image_checksum"].split(":", 1)
 
-        self.logger.info("re-authenticate to ensure token is still valid")
-        authenticate(force=True)
+        # token is used by the transfer tool for (re)connections
+        authenticate(min_validity=TRANSFER_TOKEN_VALIDITY)
 
         url = "{dl}/{fn}".format(
             dl=self.task["download_uri"], fn=self.task["image_fname"]
@@ -122,50 +125,26 @@ class DownloadTask(BaseTask):
         )
         self.logger.info("Starting {args}\n".format(args=" ".join(args)))
 
-        self.logs["downloader_log"] = "{args}\n".format(args=" ".join(log_args))
-        log_fd = open(str(self.log_path), "a")
-        ps = subprocess.Popen(
-            args=args,
-            stdout=log_fd,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            close_fds=True,
+        ps = self.run_process(
+            "downloader",
+            args,
+            self.log_path,
+            "downloader_log",
+            header="{args}\n".format(args=" ".join(log_args)),
+            mode="a",
         )
 
-        self.logger.info("installer started: {}".format(ps))
-        while ps.poll() is None:
-            self.logs["downloader_log"] = self.read_log(self.log_path)
-
-            # kill upon request
-            if self.canceled:
-                self.logger.info("terminating installer…")
-                ps.terminate()
-                ps.wait(10)
-                ps.kill()
-                ps.wait(10)
-                break
-
-        ps.wait(10)
-
         if ps.returncode == 0:
-            self.logger.info("installer ran successfuly.")
+            self.logger.info("downloader ran successfuly.")
         else:
-            self.logger.error("installer failed: {}".format(ps.returncode))
-
-        self.logger.info("collecting full terminated log")
-        self.logs["downloader_log"] = self.read_log(self.log_path)
+            self.logger.error("downloader failed: {}".format(ps.returncode))
 
         if ps.returncode != 0:
-            raise subprocess.SubprocessError("installer rc: {}".format(ps.returncode))
+            raise subprocess.SubprocessError("downloader rc: {}".format(ps.returncode))
 
     def idle(self):
         self.logger.info("idleing until all cards have been written")
-        while (
-            not self.canceled
-            and get_task(self.task["_id"])[1]["status"] == "pending_end_of_writes"
-        ):
-            self.logger.info("Idleing...")
-            time.sleep(2 * 60)
+        self.wait_while_status("pending_end_of_writes")
 
         self.logger.info("All SD-cards written !")
 
@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
-import time
 import subprocess
 
 import humanfriendly
@@ -10,7 +9,6 @@ import humanfriendly
 from tasks.base import BaseTask
 from utils.setting import Setting
 from utils import get_sdcard_bytes
-from utils.scheduler import get_task
 
 
 class WriteTask(BaseTask):
@@ -55,11 +53,7 @@ class WriteTask(BaseTask):
     def await_sdcard(self):
 
         self.logger.info("Starting await_sdcard on slot {}".format(Setting.usb_slot))
-        while (
-            not self.canceled and get_task(self.task["_id"])[1]["status"] == "waiting_for_card"
-        ):
-            self.logger.info("Waiting for the SD-card to be inserted...")
-            time.sleep(60)
+        self.wait_while_status("waiting_for_card")
 
         self.logger.info("SD-card inserted. Checking size")
         sd_card_size = get_sdcard_bytes(Setting.usb_path)
@@ -89,23 +83,13 @@ class WriteTask(BaseTask):
 
         self.logger.info("Starting {args}\n".format(args=" ".join(args)))
 
-        log_fd = open(str(self.wipe_log_path), "w")
-        ps = subprocess.run(
-            args=args,
-            stdout=log_fd,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            close_fds=True,
-        )
+        ps = self.run_process("wipe", args, self.wipe_log_path, "wipe_log")
 
         if ps.returncode == 0:
             self.logger.info("wipe ran successfuly.")
         else:
             self.logger.error("wipe failed: {}".format(ps.returncode))
 
-        self.logger.info("collecting full terminated log")
-        self.logs["wipe_log"] = self.read_log(self.wipe_log_path)
-
         if ps.returncode != 0:
             raise subprocess.SubprocessError("wipe rc: {}".format(ps.returncode))
 
@@ -125,37 +109,12 @@ class WriteTask(BaseTask):
         ]
         self.logger.info("Starting {args}\n".format(args=" ".join(args)))
 
-        log_fd = open(str(self.log_path), "w")
-        ps = subprocess.Popen(
-            args=args,
-            stdout=log_fd,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            close_fds=True,
-        )
-
-        self.logger.info("etcher started: {}".format(ps))
-        while ps.poll() is None:
-            self.logs["writer_log"] = self.read_log(self.log_path)
-
-            # kill upon request
-            if self.canceled:
-                self.logger.info("terminating etcher…")
-                ps.terminate()
-                ps.wait(10)
-                ps.kill()
-                ps.wait(10)
-                break
-
-        ps.wait(10)
+        ps = self.run_process("etcher", args, self.log_path, "writer_log")
 
         if ps.returncode == 0:
             self.logger.info("etcher ran successfuly.")
         else:
             self.logger.error("etcher failed: {}".format(ps.returncode))
 
-        self.logger.info("collecting full terminated log")
-        self.logs["writer_log"] = self.read_log(self.log_path)
-
         if ps.returncode != 0:
             raise subprocess.SubprocessError("etcher rc: {}".format(ps.returncode))
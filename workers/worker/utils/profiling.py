@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" time-boxed sampling profiler for the running process
+
+    the stacks of all threads (worker loop, task thread, log uploads) are
+    sampled every `interval` seconds. cProfile would only see the thread
+    enabling it. At the end of the session, two files are written:
+     - <name>.txt: functions with most samples (own and cumulative)
+     - <name>.collapsed: one line per stack with its count (flamegraph.pl,
+       speedscope) """
+
+import os
+import sys
+import time
+import logging
+import datetime
+import threading
+import collections
+
+logger = logging.getLogger(__name__)
+
+PROFILING_DIR = os.getenv(
+    "PROFILING_DIR", os.path.join(os.getenv("WORKING_DIR", "/data"), "profiles")
+)
+MAX_DURATION = int(os.getenv("PROFILING_MAX_DURATION", 300))  # seconds
+INTERVAL = float(os.getenv("PROFILING_INTERVAL", 0.01))  # seconds
+TOP_FUNCTIONS = 50
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return "{name} ({path}:{line})".format(
+        name=code.co_name,
+        path=os.sep.join(code.co_filename.rsplit(os.sep, 2)[-2:]),
+        line=code.co_firstlineno,
+    )
+
+
+class StackSampler(threading.Thread):
+    """ samples stacks of other threads for `duration` then writes results """
+
+    def __init__(self, name, duration, interval=INTERVAL, directory=PROFILING_DIR):
+        super().__init__(name="profiler", daemon=True)
+        self.profile_name = name
+        self.duration = duration
+        self.interval = interval
+        self.directory = directory
+        self.samples = 0
+        self.stacks = collections.Counter()
+
+    @property
+    def paths(self):
+        return [
+            os.path.join(self.directory, self.profile_name + extension)
+            for extension in (".txt", ".collapsed")
+        ]
+
+    def sample(self):
+        threads = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            stack.append(threads.get(ident, str(ident)))
+            self.stacks[tuple(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self):
+        ends_on = time.monotonic() + self.duration
+        while time.monotonic() < ends_on:
+            self.sample()
+            time.sleep(self.interval)
+        try:
+            self.write()
+        except Exception as exp:
+            logger.error("Unable to write profile {}: {}".format(self.paths[0], exp))
+        else:
+            logger.info("profile written to {}".format(self.paths[0]))
+
+    def summary(self):
+        own, cumulative = collections.Counter(), collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack[1:]):
+                cumulative[label] += count
+        lines = [
+            "{samples} samples every {interval}s over {duration}s, pid {pid}".format(
+                samples=self.samples,
+                interval=self.interval,
+                duration=self.duration,
+                pid=os.getpid(),
+            ),
+            "",
+        ]
+        for title, counter in (("own", own), ("cumulative", cumulative)):
+            lines.append("{:>8} {:>7}  function ({})".format("samples", "%", title))
+            for label, count in counter.most_common(TOP_FUNCTIONS):
+                lines.append(
+                    "{:>8} {:>6.1f}%  {}".format(
+                        count, count * 100 / max(self.samples, 1), label
+                    )
+                )
+            lines.append("")
+        return "\n".join(lines)
+
+    def write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        summary_path, collapsed_path = self.paths
+        with open(collapsed_path, "w") as fh:
+            for stack, count in self.stacks.most_common():
+                fh.write("{} {}\n".format(";".join(stack), count))
+        with open(summary_path, "w") as fh:
+            fh.write(self.summary())
+
+
+class Profiler:
+    """ single profiling session at a time in the current process """
+
+    lock = threading.Lock()
+    session = None
+
+    @classmethod
+    def start(cls, prefix, duration):
+        """ starts a session of duration (capped) or None if one is running """
+        duration = max(min(duration, MAX_DURATION), 1)
+        with cls.lock:
+            if cls.session is not None and cls.session.is_alive():
+                return None
+            name = "{prefix}-{pid}-{date}".format(
+                prefix=prefix,
+                pid=os.getpid(),
+                date=datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+            )
+            cls.session = StackSampler(name, duration)
+            cls.session.start()
+        logger.info("profiling for {}s into {}".format(duration, name))
+        return cls.session
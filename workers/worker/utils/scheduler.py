@@ -3,8 +3,10 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import json
+import time
 import logging
 import datetime
+import threading
 
 import requests
 
@@ -31,6 +33,12 @@ def get_url(path):
     return "/".join([Setting.api_url, path[1:] if path[0] == "/" else path])
 
 
+TOKEN_LOCK = threading.RLock()  # one token shared by all threads
+TOKEN_RENEWAL_MARGIN = datetime.timedelta(minutes=5)
+TRANSFER_TOKEN_VALIDITY = datetime.timedelta(minutes=30)
+TOKEN_RENEWAL_THREAD = None
+
+
 def get_access_token():
     global ACCESS_TOKEN
     return ACCESS_TOKEN
@@ -44,35 +52,87 @@ def get_token(username, password):
             "password": password,
             "Content-type": "application/json",
         },
+        timeout=30,
     )
     req.raise_for_status()
     return req.json().get("access_token"), req.json().get("refresh_token")
 
 
-def authenticate(force=False):
-    global ACCESS_TOKEN, REFRESH_TOKEN, ACCESS_TOKEN_EXPIRY, REFRESH_TOKEN_EXPIRY
+def refresh_token(token):
+    """ new (access_token, refresh_token) from a (single-use) refresh token """
+    req = requests.post(
+        url=get_url("/auth/token"),
+        headers={"refresh-token": token, "Content-type": "application/json"},
+        timeout=30,
+    )
+    req.raise_for_status()
+    return req.json().get("access_token"), req.json().get("refresh_token")
 
-    if (
-        not force
-        and ACCESS_TOKEN is not None
-        and ACCESS_TOKEN_EXPIRY
-        > datetime.datetime.now() + datetime.timedelta(minutes=2)
-    ):
-        return
 
-    logger.debug("authenticate() with force={}".format(force))
+def renew_tokens():
+    """ tokens from refresh token if still valid, from credentials otherwise """
+    if REFRESH_TOKEN is not None and REFRESH_TOKEN_EXPIRY > datetime.datetime.now():
+        try:
+            return refresh_token(REFRESH_TOKEN)
+        except Exception as exp:
+            logger.warning("unable to refresh token, logging-in: {}".format(exp))
+    return get_token(username=Setting.username, password=Setting.password)
 
-    try:
-        access_token, refresh_token = get_token(
-            username=Setting.username, password=Setting.password
-        )
-    except Exception as exp:
-        logger.error(exp)
-        ACCESS_TOKEN = REFRESH_TOKEN = ACCESS_TOKEN_EXPIRY = None
-    else:
-        ACCESS_TOKEN, REFRESH_TOKEN = access_token, refresh_token
-        ACCESS_TOKEN_EXPIRY = datetime.datetime.now() + datetime.timedelta(minutes=59)
-        REFRESH_TOKEN_EXPIRY = datetime.datetime.now() + datetime.timedelta(days=29)
+
+def authenticate(force=False, min_validity=TOKEN_RENEWAL_MARGIN):
+    """ ensure ACCESS_TOKEN is valid for at least min_validity """
+    global ACCESS_TOKEN, REFRESH_TOKEN, ACCESS_TOKEN_EXPIRY, REFRESH_TOKEN_EXPIRY
+
+    with TOKEN_LOCK:
+        if (
+            not force
+            and ACCESS_TOKEN is not None
+            and ACCESS_TOKEN_EXPIRY > datetime.datetime.now() + min_validity
+        ):
+            return
+
+        logger.debug("authenticate() with force={}".format(force))
+
+        try:
+            access_token, refresh_token = renew_tokens()
+        except Exception as exp:
+            logger.error(exp)
+            ACCESS_TOKEN = REFRESH_TOKEN = ACCESS_TOKEN_EXPIRY = None
+        else:
+            now = datetime.datetime.now()
+            ACCESS_TOKEN, REFRESH_TOKEN = access_token, refresh_token
+            ACCESS_TOKEN_EXPIRY = now + datetime.timedelta(minutes=59)
+            REFRESH_TOKEN_EXPIRY = now + datetime.timedelta(days=29)
+
+        start_token_renewal()
+
+
+def reauthenticate(rejected_token):
+    """ renew token rejected by scheduler, unless another thread already did """
+    with TOKEN_LOCK:
+        if ACCESS_TOKEN == rejected_token:
+            authenticate(force=True)
+
+
+def start_token_renewal():
+    """ renew token in background before it expires so requests never wait """
+    global TOKEN_RENEWAL_THREAD
+
+    def renew():
+        while True:
+            expiry = ACCESS_TOKEN_EXPIRY
+            if expiry is None:  # last renewal failed
+                delay = Setting.poll_interval
+            else:
+                delay = (
+                    expiry - TOKEN_RENEWAL_MARGIN - datetime.datetime.now()
+                ).total_seconds()
+            time.sleep(max(delay, 1))
+            authenticate(min_validity=TOKEN_RENEWAL_MARGIN * 2)
+
+    if TOKEN_RENEWAL_THREAD is None:
+        TOKEN_RENEWAL_THREAD = threading.Thread(target=renew, daemon=True)
+        TOKEN_RENEWAL_THREAD.start()
 
 
 def auth_required(func):
@@ -83,8 +143,8 @@ def auth_required(func):
     return wrapper
 
 
-def get_token_headers():
-    return {"token": ACCESS_TOKEN, "Content-type": "application/json"}
+def get_token_headers(token=None):
+    return {"token": token or ACCESS_TOKEN, "Content-type": "application/json"}
 
 
 def set_worker_type(worker_type):
@@ -93,13 +153,15 @@ def set_worker_type(worker_type):
 
 
 @auth_required
-def query_api(method, path, payload=None):
+def query_api(method, path, payload=None, params=None, timeout=None):
+    token = get_access_token()
     try:
         req = getattr(requests, method.lower(), "get")(
             url=get_url(path),
-            headers=get_token_headers(),
+            headers=get_token_headers(token),
             json=payload,
-            params={"slot": Setting.usb_slot},
+            params=dict(params or {}, slot=Setting.usb_slot),
+            timeout=timeout,
         )
     except Exception as exp:
         import traceback
@@ -125,9 +187,9 @@ def query_api(method, path, payload=None):
     if req.status_code in (200, 201):
         return True, req.status_code, resp
 
-    # Unauthorised error: attempt to re-auth as scheduler might have restarted?
+    # Unauthorised error: token might have been revoked or signing key retired
     if req.status_code == 401:
-        authenticate(True)
+        reauthenticate(token)
 
     return (False, req.status_code, resp["error"] if "error" in resp else str(resp))
 
@@ -159,6 +221,35 @@ def request_task(task_id):
     return success, response
 
 
+def long_poll_timeout(wait):
+    """ client timeout for a request held up to wait seconds by scheduler """
+    return (30, wait + 30)  # (connect, read)
+
+
+@auth_required
+def claim_task(wait=0):
+    """ next task assigned to us, waiting up to `wait` seconds for one """
+    success, code, response = query_api(
+        POST,
+        "/tasks/{type}/claim".format(type=WORKER_TYPE),
+        params={"wait": wait},
+        timeout=long_poll_timeout(wait),
+    )
+    return success, response
+
+
+@auth_required
+def wait_for_status_change(task_id, status, wait=0):
+    """ task once its status is not `status` (or after `wait` seconds) """
+    success, code, response = query_api(
+        GET,
+        "/tasks/{type}/{id}/wait".format(type=WORKER_TYPE, id=task_id),
+        params={"until_status_not": status, "wait": wait},
+        timeout=long_poll_timeout(wait),
+    )
+    return success, response
+
+
 @auth_required
 def update_task_status(task_id, status, log=None, extra={}):
     payload = {"status": status, "log": log, "extra": extra}
@@ -171,15 +262,14 @@ def update_task_status(task_id, status, log=None, extra={}):
 
 
 @auth_required
-def upload_logs(task_id, logs={}):
-    for key, value in logs.items():
-        if value is None:
-            del (logs[key])
+def upload_logs(task_id, logs):
+    """ logs values are either full logs (str) or {"offset": int, "data": str}
 
+        response["sizes"] holds the stored size of each log kind """
     success, code, response = query_api(
         POST,
         "/tasks/{type}/{id}/logs".format(type=WORKER_TYPE, id=task_id),
-        payload=logs,
+        payload={key: value for key, value in logs.items() if value is not None},
     )
     return success, response
 
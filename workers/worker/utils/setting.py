@@ -29,8 +29,10 @@ class Setting:
 
     proxy: str = None
 
-    poll_interval = 60  # 1mn
+    poll_interval = 60  # 1mn, between claims when scheduler is unreachable
+    long_poll_wait = 50  # max time scheduler holds claim/wait requests
     log_upload_interval = 60 * 2  # 2mn
+    process_poll_interval = 1  # log read and stop request check while running
 
     download_max_connections = 5
 